@@ -0,0 +1,68 @@
+import shutil
+import http.server
+
+from s3ts.treestore import CHUNKS_PATH
+
+class CacheServer(http.server.ThreadingHTTPServer):
+    """
+    Serves the chunks in a local cache over http, by chunk path, for
+    peers reading through a PeerFileStore.
+
+    Single Range requests of the form "bytes=N-" are honoured, so that
+    peers can resume interrupted transfers.
+    """
+
+    daemon_threads = True
+
+    def __init__( self, localCache, address ):
+        self.localCache = localCache
+        http.server.ThreadingHTTPServer.__init__( self, address, CacheRequestHandler )
+
+class CacheRequestHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_HEAD( self ):
+        self.__serve( False )
+
+    def do_GET( self ):
+        self.__serve( True )
+
+    def __serve( self, sendBody ):
+        localCache = self.server.localCache
+        elements = self.path.split('?')[0].strip('/').split('/')
+        if elements[0] != CHUNKS_PATH or any( e in ('', '.', '..') for e in elements ):
+            self.send_error( 404 )
+            return
+        path = localCache.joinPath( *elements )
+        try:
+            offset = self.__offset()
+            size = localCache.getMetadata( path ).size
+            if offset and offset >= size:
+                raise ValueError( offset )
+            src = localCache.getStream( path, offset )
+        except ValueError:
+            self.send_error( 416 )
+            return
+        except (KeyError, OSError):
+            self.send_error( 404 )
+            return
+
+        with src:
+            if offset:
+                self.send_response( 206 )
+                self.send_header( 'Content-Range', 'bytes {}-{}/{}'.format( offset, size-1, size ) )
+            else:
+                self.send_response( 200 )
+            self.send_header( 'Content-Type', 'application/octet-stream' )
+            self.send_header( 'Content-Length', str( size - offset ) )
+            self.end_headers()
+            if sendBody:
+                shutil.copyfileobj( src, self.wfile )
+
+    def __offset( self ):
+        """The start of the range requested, raising a ValueError for unsupported ranges"""
+        header = self.headers.get( 'Range' )
+        if header is None:
+            return 0
+        if not header.startswith( 'bytes=' ) or not header.endswith( '-' ):
+            raise ValueError( header )
+        return int( header[len('bytes='):-1] )
@@ -5,6 +5,7 @@ contains classes for configuration and settings
 import os, json, datetime
 
 from s3ts.utils import datetimeFromIso
+from s3ts import filewriter
 
 class S3Access(object):
     """Provide connection parameters for an s3m store"""
@@ -48,6 +49,55 @@ class TreeStoreConfigJS(object):
             'useCompression' : v.useCompression,
             }
 
+class LocalCacheConfig(object):
+    """Configuration data for a local cache"""
+
+    def __init__( self, decodeChunks ):
+        self.decodeChunks = decodeChunks
+
+class LocalCacheConfigJS(object):
+    """De/serialise LocalCacheConfig objects"""
+
+    def fromJson( self, jv ):
+        return LocalCacheConfig(
+            jv.get('decodeChunks', False)
+            )
+
+    def toJson( self, v ):
+        return {
+            'decodeChunks' : v.decodeChunks,
+            }
+
+class DownloadJournal(object):
+    """records the progress of an interrupted download into a local cache
+
+    completed is the set of sha1s of the chunks known to be cached, and
+    partial maps the sha1 of a partially transferred chunk to the number
+    of its bytes received.
+    """
+
+    def __init__( self, packageName, completed, partial ):
+        self.packageName = packageName
+        self.completed = completed
+        self.partial = partial
+
+class DownloadJournalJS(object):
+    """De/serialise DownloadJournal objects"""
+
+    def fromJson( self, jv ):
+        return DownloadJournal(
+            jv['packageName'],
+            set( jv['completed'] ),
+            dict( jv['partial'] )
+            )
+
+    def toJson( self, v ):
+        return {
+            'packageName' : v.packageName,
+            'completed' : sorted( v.completed ),
+            'partial' : v.partial,
+            }
+
 class InstallProperties(object):
     """records the details of an installation"""
 
@@ -73,13 +123,69 @@ class InstallPropertiesJS(object):
 S3TS_PROPERTIES = '.s3ts.properties'    
 
 
-def writeInstallProperties( installDir, props ):
-    with open( os.path.join( installDir, S3TS_PROPERTIES ), 'w' ) as f:
-        f.write( json.dumps( InstallPropertiesJS().toJson( props ) ) )
+def writeInstallProperties( installDir, props, sync=False ):
+    writeInstallJson( os.path.join( installDir, S3TS_PROPERTIES ), props, InstallPropertiesJS(), sync )
 
 def readInstallProperties( installDir ):
-    with open( os.path.join( installDir, S3TS_PROPERTIES ), 'r' ) as f:
-        return InstallPropertiesJS().fromJson( json.loads( f.read() ) )
+    return readInstallJson( os.path.join( installDir, S3TS_PROPERTIES ), InstallPropertiesJS() )
+
+class InstalledFile(object):
+    """records the stat signature of an installed file, when its content was known good"""
+
+    def __init__( self, path, sha1, size, mtimeNs, inode ):
+        self.path = path
+        self.sha1 = sha1
+        self.size = size
+        self.mtimeNs = mtimeNs
+        self.inode = inode
+
+    @classmethod
+    def fromStat( cls, path, sha1, st ):
+        return cls( path, sha1, st.st_size, st.st_mtime_ns, st.st_ino )
+
+    def matchesStat( self, st ):
+        return (self.size, self.mtimeNs, self.inode) == (st.st_size, st.st_mtime_ns, st.st_ino)
+
+class InstallManifest(object):
+    """records the installed files of an installation"""
+
+    def __init__( self, files ):
+        self.files = files
+
+class InstallManifestJS(object):
+    """De/serialise InstallManifest objects"""
+
+    # Files are written as arrays, to keep large manifests compact
+
+    def fromJson( self, jv ):
+        return InstallManifest( [ InstalledFile( *jv1 ) for jv1 in jv['files'] ] )
+
+    def toJson( self, v ):
+        return {
+            'files' : [ [f.path, f.sha1, f.size, f.mtimeNs, f.inode] for f in v.files ],
+            }
+
+S3TS_MANIFEST = '.s3ts.manifest'
+
+def writeInstallManifest( installDir, manifest, sync=False ):
+    writeInstallJson( os.path.join( installDir, S3TS_MANIFEST ), manifest, InstallManifestJS(), sync )
+
+def readInstallManifest( installDir ):
+    return readInstallJson( os.path.join( installDir, S3TS_MANIFEST ), InstallManifestJS() )
+
+def writeInstallJson( path, value, js, sync=False ):
+    """Replace the file at path atomically, so that it is never seen part written"""
+    with filewriter.atomicFileWriter( path, sync ) as f:
+        f.write( json.dumps( js.toJson( value ) ).encode('utf-8') )
+
+def readInstallJson( path, js ):
+    """Raises IOError if the file at path is missing or can't be parsed, as
+    may be left by an older version interrupted while writing it"""
+    with open( path, 'r' ) as f:
+        try:
+            return js.fromJson( json.loads( f.read() ) )
+        except ValueError as e:
+            raise IOError( "unable to parse {}: {}".format( path, e ) )
     
 
         
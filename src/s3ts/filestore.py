@@ -1,7 +1,30 @@
-import json, os
+import json, os, io, mmap, contextlib, threading
 
 from s3ts import filewriter
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# The directory within a LocalFileStore holding lock files
+LOCKS_PATH = 'locks'
+
+# The most directory file descriptors a LocalFileStore keeps open: enough
+# for every shard directory of a local cache (chunks/raw, chunks/zlib,
+# verified, partial/raw and partial/zlib, 256 each), as long as that is
+# within a quarter of the process's limit on open files
+MAX_DIR_FDS = 2048
+if resource is not None:
+    _openFilesLimit = resource.getrlimit( resource.RLIMIT_NOFILE )[0]
+    if _openFilesLimit != resource.RLIM_INFINITY:
+        MAX_DIR_FDS = min( MAX_DIR_FDS, _openFilesLimit // 4 )
+
 class FileStore(object):
 
     def exists( self, path ):
@@ -50,6 +73,62 @@ class FileStore(object):
     def getMetadata( self, path):
         raise RuntimeError("Not implemented")
 
+    def localPath( self, path ):
+        """Returns the local filesystem path holding the value for path
+
+        Returns None if the store doesn't keep its values as local files.
+        """
+        return None
+
+    @contextlib.contextmanager
+    def getBuffer( self, path ):
+        """Get the value associated with path, as a buffer that is only
+        valid within the context.
+
+        Stores may avoid copying the value by returning a memoryview.
+        Raises a KeyError if the path doesn't exist
+        """
+        yield self.get( path )
+
+    def getStream( self, path, offset=0 ):
+        """Get the value associated with path as a readable file object,
+        for use as a context manager, starting offset bytes in.
+
+        Raises a KeyError if the path doesn't exist
+        """
+        return io.BytesIO( self.get( path )[offset:] )
+
+    @contextlib.contextmanager
+    def putStream( self, path ):
+        """Store a value associated with path, written to the file object
+        yielded by the context.
+
+        The value is only stored if the context exits normally.
+        """
+        f = io.BytesIO()
+        yield f
+        self.put( path, f.getvalue() )
+
+    @contextlib.contextmanager
+    def lock( self, path, shared=False, blocking=True ):
+        """Hold an advisory lock named by path, shared between processes
+        using the store, for the duration of the context.
+
+        The context yields True if the lock is held, which is always the
+        case unless blocking is False. Stores that can't be shared
+        between processes needn't lock at all.
+        """
+        yield True
+
+    def removeLock( self, path ):
+        """Remove the resources of a lock, which must be held exclusively"""
+        pass
+
+    def sync( self ):
+        """Make the values stored so far durable, where the store batches
+        that up (see filewriter.DURABILITY_BATCH)"""
+        pass
+
 class FileMetaData:
     def __init__(self,size,lastModified):
         self.size = size
@@ -60,16 +139,76 @@ class FileMetaData:
         return "size:" + str(self.size) + " mtime:" + str(self.lastModified) 
 
 class LocalFileStore(FileStore):
-    """implements the FileStore interface using the local file system"""
+    """implements the FileStore interface using the local file system
 
-    def __init__( self, root ):
+    Where supported, the store keeps its (shard) directories open, and
+    names files relative to them, to save the kernel resolving the full
+    path of every file. So directories must not be removed from under
+    the store while it is in use.
+
+    durability is one of filewriter.DURABILITY_MODES. With DURABILITY_BATCH,
+    values are only durable once sync() has been called.
+    """
+
+    def __init__( self, root, durability=filewriter.DURABILITY_NONE ):
+        if durability not in filewriter.DURABILITY_MODES:
+            raise RuntimeError("unknown durability {}".format(durability))
         self.root = root
+        self.durability = durability
+        self.batch = filewriter.SyncBatch() if durability == filewriter.DURABILITY_BATCH else None
+        self.dirFds = {}
+        self.dirFdsLock = threading.Lock()
 
     def __path( self, path ):
         return os.path.join( self.root, path )
 
+    def close( self ):
+        """Release the directories held open by the store"""
+        with self.dirFdsLock:
+            for fd in self.dirFds.values():
+                os.close( fd )
+            self.dirFds = {}
+
+    def __del__( self ):
+        self.close()
+
+    def __dirFd( self, dir, create ):
+        """Returns an open fd for the directory dir, created if required.
+
+        Returns None if the directory doesn't exist (and create is False),
+        or it can't be kept open, in which case plain paths must be used.
+        """
+        fd = self.dirFds.get( dir )
+        if fd is not None or not filewriter.DIR_FDS_SUPPORTED:
+            return fd
+        if len(self.dirFds) >= MAX_DIR_FDS:
+            # Opening the directory just to close it again costs more than it saves
+            return None
+        path = self.__path( dir )
+        try:
+            fd = os.open( path, os.O_RDONLY | os.O_DIRECTORY )
+        except FileNotFoundError:
+            if not create:
+                return None
+            self.__makedirs( path )
+            fd = os.open( path, os.O_RDONLY | os.O_DIRECTORY )
+        with self.dirFdsLock:
+            if dir not in self.dirFds and len(self.dirFds) < MAX_DIR_FDS:
+                self.dirFds[dir] = fd
+                return fd
+        os.close( fd )
+        return self.dirFds.get( dir )
+
     def exists( self, path ):
-        return os.path.exists( self.__path(path)  )
+        dir,_,name = path.rpartition( os.sep )
+        dirFd = self.__dirFd( dir, False )
+        if dirFd is None:
+            return os.path.exists( self.__path(path)  )
+        try:
+            os.stat( name, dir_fd=dirFd )
+            return True
+        except FileNotFoundError:
+            return False
 
     def get( self, path ):
         try:
@@ -78,18 +217,87 @@ class LocalFileStore(FileStore):
         except IOError as e:
             raise KeyError(e)
 
-    def put( self, path, body ):
-        path = self.__path(path)
-        dir = os.path.dirname( path )
-        if not os.path.isdir( dir ):
-            os.makedirs( dir )
+    @contextlib.contextmanager
+    def getBuffer( self, path ):
+        try:
+            f = open( self.__path(path), 'rb' )
+        except IOError as e:
+            raise KeyError(e)
+        with f:
+            if os.fstat( f.fileno() ).st_size == 0:
+                yield b''
+                return
+            m = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+            try:
+                with memoryview(m) as buf:
+                    yield buf
+            finally:
+                m.close()
+
+    def getStream( self, path, offset=0 ):
+        try:
+            f = open( self.__path(path), 'rb' )
+        except IOError as e:
+            raise KeyError(e)
+        f.seek( offset )
+        return f
 
-        # Do our best to be atomic in our updates here, in case
-        # another process is simultaneously updating the file
-        with filewriter.atomicFileWriter(path) as f:
+    def put( self, path, body ):
+        with self.putStream( path ) as f:
             f.write(body)
 
+    def putStream( self, path ):
+        sync = self.durability == filewriter.DURABILITY_FILE
+        dir,_,name = path.rpartition( os.sep )
+        dirFd = self.__dirFd( dir, True )
+        if dirFd is not None:
+            writer = filewriter.DirAtomicFileWriter( dirFd, name, sync )
+        else:
+            dir = os.path.dirname( self.__path(path) )
+            if not os.path.isdir( dir ):
+                self.__makedirs( dir )
+
+            # Do our best to be atomic in our updates here, in case
+            # another process is simultaneously updating the file
+            writer = filewriter.atomicFileWriter( self.__path(path), sync )
+        if self.batch is None:
+            return writer
+        return self.__batched( writer, self.__path(path) )
+
+    @contextlib.contextmanager
+    def __batched( self, writer, path ):
+        with writer as f:
+            yield f
+        self.batch.add( path )
+
+    def __makedirs( self, path ):
+        """Create the directory path, and the entries for it in its parents
+        as durably as the store requires"""
+        created = []
+        dir = path
+        while dir and not os.path.isdir( dir ):
+            created.append( dir )
+            dir = os.path.dirname( dir )
+        os.makedirs( path, exist_ok=True )
+        for dir in created:
+            if self.batch is not None:
+                self.batch.add( dir )
+            elif self.durability == filewriter.DURABILITY_FILE:
+                filewriter.fsyncPath( os.path.dirname( dir ) )
+
+    def sync( self ):
+        if self.batch is not None:
+            self.batch.sync()
+
     def remove( self, path ):
+        dir,_,name = path.rpartition( os.sep )
+        dirFd = self.__dirFd( dir, False )
+        if dirFd is not None:
+            try:
+                os.unlink( name, dir_fd=dirFd )
+            except FileNotFoundError:
+                pass
+            return
         path = self.__path(path)
         if os.path.exists( path ):
             os.unlink(path)
@@ -116,5 +324,50 @@ class LocalFileStore(FileStore):
         statinfo = os.stat(self.__path(path))
         return FileMetaData(statinfo.st_size, statinfo.st_mtime)
 
+    def localPath( self, path ):
+        return self.__path(path)
+
+    @contextlib.contextmanager
+    def lock( self, path, shared=False, blocking=True ):
+        if fcntl is None:
+            yield True
+            return
+        lockPath = self.__path( os.path.join( LOCKS_PATH, path ) )
+        flags = (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | (0 if blocking else fcntl.LOCK_NB)
+        while True:
+            try:
+                fd = os.open( lockPath, os.O_RDWR | os.O_CREAT, 0o666 )
+            except FileNotFoundError:
+                os.makedirs( os.path.dirname( lockPath ), exist_ok=True )
+                continue
+            try:
+                fcntl.flock( fd, flags )
+            except BlockingIOError:
+                os.close( fd )
+                yield False
+                return
+
+            # Start again if the lock file was removed while we waited for it
+            try:
+                if os.stat( lockPath ).st_ino == os.fstat( fd ).st_ino:
+                    break
+            except FileNotFoundError:
+                pass
+            os.close( fd )
+        try:
+            yield True
+        finally:
+            # The last holder removes the lock file, so that lock files
+            # only exist for the locks in use
+            try:
+                fcntl.flock( fd, fcntl.LOCK_EX | fcntl.LOCK_NB )
+                os.unlink( lockPath )
+            except (BlockingIOError, FileNotFoundError):
+                pass
+            os.close( fd )
+
+    def removeLock( self, path ):
+        self.remove( os.path.join( LOCKS_PATH, path ) )
+
 
 
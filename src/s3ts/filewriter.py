@@ -1,37 +1,110 @@
-import os, sys, tempfile, shutil
+import os, sys, tempfile, shutil, mmap, itertools, threading, ctypes, ctypes.util
 
 # You wouldn't think that writing a file would be so hard!
 
+# How durably files are written:
+#   DURABILITY_NONE  - writes are left to the OS, so a crash may leave
+#                      files empty or partially written
+#   DURABILITY_FILE  - each file is fsynced as it is written, and its
+#                      directory after it is renamed into place
+#   DURABILITY_BATCH - files are written as for DURABILITY_NONE, and synced
+#                      together (see SyncBatch) when an operation completes
+DURABILITY_NONE = 'none'
+DURABILITY_FILE = 'file'
+DURABILITY_BATCH = 'batch'
+DURABILITY_MODES = [DURABILITY_NONE, DURABILITY_FILE, DURABILITY_BATCH]
+
+# The write buffer of a StreamingFileWriter (a multiple of the page size)
+STREAMING_BUFFER_SIZE = 4 * 1024 * 1024
+
+# How much a StreamingFileWriter writes before dropping it from the page cache
+STREAMING_DROP_SIZE = 64 * 1024 * 1024
+
 class InPlaceFileWriter(object):
     """
     Just write the file to where it needs to go.
     """
-    def __init__(self, filename):
+    def __init__(self, filename, sync=False):
         self.filename = filename
+        self.sync = sync
 
     def __enter__(self):
         self.file = open(self.filename,'wb')
         return self.file        
 
-    def __exit__(self, *args):
+    def __exit__(self, excType, *args):
+        if self.sync and excType is None:
+            fsyncFile(self.file)
         self.file.close()
 
+class StreamingFileWriter(InPlaceFileWriter):
+    """
+    Write a file of known size in one sequential pass, as InPlaceFileWriter,
+    but keeping it out of the page cache, so as not to evict the data of
+    other processes.
+
+    The file is preallocated (unless size is None), so that it isn't
+    fragmented, and written through a large buffer. Each time dropWritten()
+    is called, once STREAMING_DROP_SIZE bytes have been written, they are
+    flushed to the disk and dropped from the page cache.
+    """
+    def __init__(self, filename, size, sync=False):
+        InPlaceFileWriter.__init__(self, filename, sync)
+        self.size = size
+
+    def __enter__(self):
+        self.file = open(self.filename, 'wb', buffering=STREAMING_BUFFER_SIZE)
+        self.dropped = 0
+        if self.size:
+            preallocate(self.file.fileno(), self.size)
+        return self.file
+
+    def dropWritten(self, force=False):
+        """Drop what has been written from the page cache, if there's enough of it (or force is set)"""
+        end = self.file.tell()
+        if end - self.dropped < STREAMING_DROP_SIZE and not force:
+            return
+        self.file.flush()
+        # Without fadvise nothing can be dropped, and there's no point syncing
+        if hasattr(os, 'posix_fadvise'):
+            # Dirty pages can't be dropped, so they must be written out first
+            if hasattr(os, 'fdatasync'):
+                os.fdatasync(self.file.fileno())
+            else:
+                os.fsync(self.file.fileno())
+            adviseDontNeed(self.file.fileno(), self.dropped, end - self.dropped)
+        self.dropped = end
+
+    def __exit__(self, excType, *args):
+        if excType is None:
+            self.dropWritten(force=True)
+        InPlaceFileWriter.__exit__(self, excType, *args)
+
 class PosixAtomicFileWriter(object):
     """
     Rely on posix semantics to update a file atomically,
     by writing to a temp file in the same directory
     and moving it into place
     """
-    def __init__(self, filename):
+    def __init__(self, filename, sync=False):
         self.filename = filename
+        self.sync = sync
 
     def __enter__(self):
         self.tempfile = tempfile.NamedTemporaryFile(delete=False,dir=os.path.dirname(self.filename))
         return self.tempfile
 
-    def __exit__(self, *args):
+    def __exit__(self, excType, *args):
+        if self.sync and excType is None:
+            fsyncFile(self.tempfile)
         self.tempfile.close()
+        if excType is not None:
+            # Leave any existing file untouched
+            os.unlink(self.tempfile.name)
+            return
         os.rename(self.tempfile.name, self.filename)
+        if self.sync:
+            fsyncPath(os.path.dirname(self.filename))
 
 class ClunkySemiAtomicWindowsFileWriter(object):
     """
@@ -43,14 +116,20 @@ class ClunkySemiAtomicWindowsFileWriter(object):
     # as described here:
     #    http://stupidpythonideas.blogspot.com.au/2014/07/getting-atomic-writes-right.html
     
-    def __init__(self, filename):
+    def __init__(self, filename, sync=False):
+        # Files are always synced, as required for the rename
         self.filename = filename
 
     def __enter__(self):
         self.tempfile = tempfile.NamedTemporaryFile(delete=False,dir=os.path.dirname(self.filename))
         return self.tempfile
 
-    def __exit__(self, *args):
+    def __exit__(self, excType, *args):
+        if excType is not None:
+            self.tempfile.close()
+            os.unlink(self.tempfile.name)
+            return
+
         # Need to flush both at libc and kernel layers here to
         # ensure that the os.rename() below works correctly under
         # windows
@@ -62,8 +141,236 @@ class ClunkySemiAtomicWindowsFileWriter(object):
            os.unlink(self.filename)
         os.rename(self.tempfile.name, self.filename)
 
-def atomicFileWriter(filename):
+class DirAtomicFileWriter(object):
+    """
+    Update a file atomically, like PosixAtomicFileWriter, but with
+    the file named relative to an open directory, so that the kernel
+    doesn't resolve the directory's path for each operation.
+    """
+    tempCounter = itertools.count()
+
+    def __init__(self, dirFd, name, sync=False):
+        self.dirFd = dirFd
+        self.name = name
+        self.sync = sync
+
+    def __enter__(self):
+        # Unique within the directory, without needing random names and retries
+        self.tempName = '.{}.{}.{}.tmp'.format(self.name, os.getpid(), next(self.tempCounter))
+        fd = os.open(self.tempName, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666, dir_fd=self.dirFd)
+        self.file = os.fdopen(fd, 'wb')
+        return self.file
+
+    def __exit__(self, excType, *args):
+        if self.sync and excType is None:
+            fsyncFile(self.file)
+        self.file.close()
+        if excType is not None:
+            os.unlink(self.tempName, dir_fd=self.dirFd)
+            return
+        os.rename(self.tempName, self.name, src_dir_fd=self.dirFd, dst_dir_fd=self.dirFd)
+        if self.sync:
+            os.fsync(self.dirFd)
+
+# True if files can be named relative to open directories
+DIR_FDS_SUPPORTED = (
+    hasattr(os, 'O_DIRECTORY') and
+    {os.open, os.stat, os.rename, os.unlink} <= os.supports_dir_fd
+    )
+
+def atomicFileWriter(filename, sync=False):
     if sys.platform == 'win32':
-        return ClunkySemiAtomicWindowsFileWriter(filename)
+        return ClunkySemiAtomicWindowsFileWriter(filename, sync)
     else:
-        return PosixAtomicFileWriter(filename)
+        return PosixAtomicFileWriter(filename, sync)
+
+def fsyncFile(f):
+    """Flush an open file through to the disk"""
+    f.flush()
+    os.fsync(f.fileno())
+
+def fsyncPath(path):
+    """
+    Flush the file or directory at path through to the disk. Directories
+    can't be opened on windows, where renames are durable anyway.
+    """
+    if sys.platform == 'win32' and os.path.isdir(path):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class SyncBatch(object):
+    """
+    Collects the files written by an operation (and the directories
+    holding them), so that they can all be made durable at once, with
+    a single syncfs of each filesystem where that's available, or else
+    an fsync of each path.
+
+    With useSyncfs False, each path is always fsynced, which is cheaper
+    when only a few directories need syncing.
+    """
+    def __init__(self, useSyncfs=True):
+        self.useSyncfs = useSyncfs
+        self.paths = set()
+        self.lock = threading.Lock()
+
+    def add(self, path):
+        """Record a file (or directory) written, and the directory holding it"""
+        with self.lock:
+            self.paths.add(path)
+            self.paths.add(os.path.dirname(path))
+
+    def addDirectory(self, path):
+        """Record a directory whose entries have changed"""
+        with self.lock:
+            self.paths.add(path)
+
+    def sync(self):
+        with self.lock:
+            paths, self.paths = self.paths, set()
+        byDevice = {}
+        for path in paths:
+            try:
+                byDevice.setdefault(os.stat(path).st_dev, []).append(path)
+            except FileNotFoundError:
+                # Removed since it was written
+                pass
+        for devicePaths in byDevice.values():
+            if self.useSyncfs and syncFilesystem(devicePaths[0]):
+                continue
+            for path in sorted(devicePaths):
+                fsyncPath(path)
+
+_syncfs = None
+
+def syncFilesystem(path):
+    """
+    Flush everything written to the filesystem holding path through to the
+    disk, with the linux syncfs call. Returns False if that's not supported.
+    """
+    global _syncfs
+    if _syncfs is None:
+        _syncfs = False
+        if sys.platform.startswith('linux'):
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            if hasattr(libc, 'syncfs'):
+                _syncfs = libc.syncfs
+                _syncfs.argtypes = [ctypes.c_int]
+    if not _syncfs:
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _syncfs(fd) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+    finally:
+        os.close(fd)
+    return True
+
+# The linux FICLONE ioctl, from <linux/fs.h>
+FICLONE = 0x40049409
+
+def hardlinkFile(srcPath, targetPath):
+    """
+    Make targetPath a hard link to srcPath, falling back to a
+    copy if that's not possible (eg across filesystems).
+    """
+    try:
+        os.link(srcPath, targetPath)
+    except (OSError, AttributeError):
+        shutil.copyfile(srcPath, targetPath)
+
+def reflinkFile(srcPath, targetPath):
+    """
+    Make targetPath a copy-on-write clone of srcPath, falling back
+    to a copy where the filesystem doesn't support it.
+    """
+    try:
+        import fcntl
+        with open(srcPath, 'rb') as src:
+            with open(targetPath, 'wb') as target:
+                fcntl.ioctl(target.fileno(), FICLONE, src.fileno())
+    except (OSError, ImportError):
+        shutil.copyfile(srcPath, targetPath)
+
+def preallocate(fd, size):
+    """
+    Allocate the disk space for a file of size bytes up front, where the
+    platform and filesystem support it.
+    """
+    if not hasattr(os, 'posix_fallocate'):
+        return
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError:
+        # Not supported by the filesystem, or no space - which the writes will report
+        pass
+
+def adviseSequential(fd):
+    """Hint that fd will be read sequentially, where the platform supports it"""
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+def adviseDontNeed(fd, offset, length):
+    """Hint that the (clean) pages of a range of fd can be dropped from the page cache"""
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+
+def appendFromFile(srcPath, f, sha1, dropCache=False):
+    """
+    Append the content of srcPath to the open file f, updating sha1
+    with it. Returns the number of bytes appended.
+
+    The source is hashed through an mmap, and copied within the kernel
+    where the platform supports it, so the data never passes through
+    a python buffer. With dropCache set, the source is read sequentially
+    and then dropped from the page cache.
+    """
+    with open(srcPath, 'rb') as src:
+        size = os.fstat(src.fileno()).st_size
+        if size == 0:
+            return 0
+        if dropCache:
+            adviseSequential(src.fileno())
+        m = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            sha1.update(m)
+            f.flush()
+            offset = _kernelCopy(src.fileno(), f.fileno(), size)
+            if offset < size:
+                f.write(memoryview(m)[offset:])
+        finally:
+            m.close()
+        if dropCache:
+            adviseDontNeed(src.fileno(), 0, size)
+    return size
+
+def _kernelCopy(srcFd, targetFd, size):
+    """
+    Copy up to size bytes from the start of srcFd to the current position
+    of targetFd, without going through user space. Returns the number of
+    bytes copied, which is less than size if the kernel copies aren't
+    supported.
+    """
+    offset = 0
+    for copy in [_copyFileRange, _sendfile]:
+        try:
+            while offset < size:
+                n = copy(srcFd, targetFd, offset, size - offset)
+                if n == 0:
+                    break
+                offset += n
+        except (OSError, AttributeError):
+            pass
+        if offset == size:
+            break
+    return offset
+
+def _copyFileRange(srcFd, targetFd, offset, count):
+    return os.copy_file_range(srcFd, targetFd, count, offset)
+
+def _sendfile(srcFd, targetFd, offset, count):
+    return os.sendfile(targetFd, srcFd, offset, count)
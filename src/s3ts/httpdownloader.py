@@ -0,0 +1,133 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import requests
+import requests.adapters
+
+# Failures after which a request is retried
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+# Response codes after which a request is retried
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+
+class HttpDownloader(object):
+    """Fetches urls over a shared pool of persistent http connections.
+
+    Failed requests are retried with exponential backoff, and a transfer
+    that fails part way through is resumed from where it stopped with a
+    Range request. If hedgeAfter is set, a request that hasn't received a
+    response after that many seconds is issued a second time, and
+    whichever response arrives first is used.
+
+    Content is read from the network in pieces of readSize bytes, which
+    bounds the data lost when a connection drops. If a RateLimiter is
+    given, every request and every piece is subject to its limits.
+    """
+
+    def __init__( self, connections=8, retries=5, backoff=0.5, hedgeAfter=None, timeout=60, readSize=64*1024,
+                  rateLimiter=None ):
+        self.readSize = readSize
+        self.rateLimiter = rateLimiter
+        self.retries = retries
+        self.backoff = backoff
+        self.hedgeAfter = hedgeAfter
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter( pool_connections=connections, pool_maxsize=2*connections )
+        self.session.mount( 'http://', adapter )
+        self.session.mount( 'https://', adapter )
+        self.executor = ThreadPoolExecutor( 2*connections ) if hedgeAfter is not None else None
+
+    def close( self ):
+        if self.executor is not None:
+            self.executor.shutdown( wait=False )
+        self.session.close()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+    def iterContent( self, url ):
+        """Yields the content of url, in pieces of at most readSize bytes"""
+        offset = 0
+        failures = 0
+        while True:
+            try:
+                resp = self.__get( url, offset )
+                try:
+                    # A server that ignores the Range header sends everything again
+                    skip = offset if resp.status_code != 206 else 0
+                    for buf in resp.iter_content( self.readSize ):
+                        if skip:
+                            n = min( skip, len(buf) )
+                            skip -= n
+                            buf = buf[n:]
+                            if not buf:
+                                continue
+                        if self.rateLimiter is not None:
+                            self.rateLimiter.acquire( 0, len(buf) )
+                        offset += len(buf)
+                        failures = 0
+                        yield buf
+                    return
+                finally:
+                    resp.close()
+            except requests.RequestException as e:
+                failures += 1
+                if failures > self.retries or not isRetryable( e ):
+                    raise
+                time.sleep( self.backoff * 2 ** (failures-1) )
+
+    def __get( self, url, offset ):
+        headers = {'Range' : 'bytes={}-'.format(offset)} if offset else {}
+        if self.executor is None:
+            return self.__request( url, headers )
+        return self.__hedgedRequest( url, headers )
+
+    def __request( self, url, headers ):
+        if self.rateLimiter is not None:
+            self.rateLimiter.acquire( 1, 0 )
+        resp = self.session.get( url, headers=headers, stream=True, timeout=self.timeout )
+        try:
+            resp.raise_for_status()
+        except:
+            resp.close()
+            raise
+        return resp
+
+    def __hedgedRequest( self, url, headers ):
+        futures = [self.executor.submit( self.__request, url, headers )]
+        done, pending = wait( futures, timeout=self.hedgeAfter )
+        if not done:
+            futures.append( self.executor.submit( self.__request, url, headers ) )
+
+        pending = set( futures )
+        winner = None
+        while pending and winner is None:
+            done, pending = wait( pending, return_when=FIRST_COMPLETED )
+            for future in done:
+                if future.exception() is not None:
+                    continue
+                if winner is None:
+                    winner = future
+                else:
+                    future.result().close()
+
+        # Release the connections of the requests that lost
+        for future in pending:
+            future.add_done_callback( closeResponse )
+        if winner is None:
+            return futures[0].result()
+        return winner.result()
+
+def isRetryable( e ):
+    """Returns true if a failed request may succeed if it is repeated"""
+    if isinstance( e, requests.HTTPError ):
+        return e.response is not None and e.response.status_code in RETRY_STATUS_CODES
+    return isinstance( e, RETRY_EXCEPTIONS )
+
+def closeResponse( future ):
+    if not future.cancelled() and future.exception() is None:
+        future.result().close()
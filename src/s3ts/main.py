@@ -2,11 +2,21 @@ import os, sys, argparse, json, datetime, re
 
 import boto
 
-from s3ts.treestore import TreeStore, TreeStoreConfig
+from s3ts.config import LocalCacheConfig, TreeStoreConfig
+from s3ts.treestore import TreeStore, CHUNKS_PATH, INSTALL_COPY, INSTALL_MODES, VERIFY_ALWAYS, VERIFY_LEVELS
+from s3ts.treestore import IO_PROFILE_DEFAULT, IO_PROFILES
 from s3ts.filestore import FileStore, LocalFileStore
 from s3ts.s3filestore import S3FileStore
+from s3ts.shardedfilestore import ShardedFileStore
+from s3ts.packfilestore import PackFileStore
+from s3ts.peerfilestore import PeerFileStore
+from s3ts.cacheserver import CacheServer
+from s3ts.httpdownloader import HttpDownloader
+from s3ts.ratelimit import RateLimiter
+from s3ts.filewriter import DURABILITY_NONE, DURABILITY_MODES
 from s3ts.package import PackageJS, packageDiff, packageFilter
 from s3ts.metapackage import MetaPackage, SubPackage, MetaPackageJS
+from s3ts import staging
 
 def getEnv( name, desc ):
     try:
@@ -61,24 +71,55 @@ def connectToBucket(bucketName=None,s3PathPrefix=None):
     return s3c.get_bucket( bucketName ),s3PathPrefix
 
 def createTreeStore(chunksize):
-    localCacheDir = getEnv( 'S3TS_LOCALCACHE', 'the local directory used for caching'  )
+    localCache = openLocalCache()
     bucket,s3PathPrefix = connectToBucket()
     config = TreeStoreConfig( chunksize, True )
-    return TreeStore.create( S3FileStore(bucket,s3PathPrefix), LocalFileStore(localCacheDir), config )
-
-def openTreeStore(dryRun=False,verbose=False):
-    localCacheDir = getEnv( 'S3TS_LOCALCACHE', 'the local directory used for caching'  )
+    return TreeStore.create( S3FileStore(bucket,s3PathPrefix), localCache, config )
+
+def openLocalCache(durability=DURABILITY_NONE):
+    # The cache may be spread over several directories, separated as in $PATH,
+    # each optionally limited to a number of bytes with a "=BYTES" suffix,
+    # or held in pack files, with a "pack:" prefix
+    localCacheDirs = getEnv( 'S3TS_LOCALCACHE', 'the local directory (or directories) used for caching'  )
+    if localCacheDirs.startswith( 'pack:' ):
+        return PackFileStore( localCacheDirs[len('pack:'):], durability )
+    roots = []
+    capacities = []
+    for dir in localCacheDirs.split( os.pathsep ):
+        root,_,capacity = dir.partition( '=' )
+        roots.append( root )
+        capacities.append( int(capacity) if capacity else None )
+    if len(roots) == 1 and capacities[0] is None:
+        return LocalFileStore( roots[0], durability )
+    return ShardedFileStore( roots, capacities, durability )
+
+def openPackageStore():
     bucket,s3PathPrefix = connectToBucket()
-    treeStore = TreeStore.open( S3FileStore(bucket,s3PathPrefix), LocalFileStore(localCacheDir) )
+    store = S3FileStore(bucket,s3PathPrefix)
+
+    # Read chunks through any peer caches (or relays) before S3
+    peers = os.environ.get( 'S3TS_PEERS' )
+    if peers:
+        store = PeerFileStore( peers.split(','), store, [CHUNKS_PATH] )
+    return store
+
+def openTreeStore(dryRun=False,verbose=False,durability=DURABILITY_NONE):
+    treeStore = TreeStore.open( openPackageStore(), openLocalCache(durability) )
     treeStore.setDryRun(dryRun)
+    treeStore.setDurability(durability)
     if verbose:
         treeStore.setOutVerbose( outVerbose )
     return treeStore
 
-def nonS3TreeStore():
+def nonS3TreeStore(durability=DURABILITY_NONE):
     # Don't use or require S3 - some operations won't be available
-    localCacheDir = getEnv( 'S3TS_LOCALCACHE', 'the local directory used for caching'  )
-    return TreeStore( FileStore(), LocalFileStore(localCacheDir), None )
+    treeStore = TreeStore( FileStore(), openLocalCache(durability), None )
+    treeStore.setDurability(durability)
+    return treeStore
+
+def printThrottled( rateLimiter ):
+    if rateLimiter.throttledSecs > 0:
+        print( "\nThrottled for {:.1f} secs".format( rateLimiter.throttledSecs ) )
 
 def readPackageFile( packageFile ):
     with open( packageFile, 'r' ) as f:
@@ -139,11 +180,12 @@ def printMetaPackageInfo(name, pkg):
     for component in pkg.components:
         print('    ', component.info())
 
-def upload( treename, description, localdir, dryRun, verbose ):
+def upload( treename, description, localdir, dryRun, verbose, rateLimiter ):
     creationTime = datetime.datetime.now()
     treeStore = openTreeStore(dryRun=dryRun,verbose=verbose)
+    treeStore.setRateLimiter(rateLimiter)
     treeStore.upload( treename, description, creationTime, localdir, UploadProgress() )
-    print
+    printThrottled( rateLimiter )
 
 def uploadWritingPfile(packagefile, localdir, dryRun, verbose):
     creationTime = datetime.datetime.now()
@@ -178,11 +220,13 @@ def createMerged( treename, packageArgs, dryRun, verbose ):
     treeStore.createMerged( treename, creationTime, packageMap)
     print(               )
 
-def download( treename, dryRun, verbose, metadata ):
-    treeStore = openTreeStore(dryRun=dryRun,verbose=verbose)
+def download( treename, dryRun, verbose, metadata, verifyLevel, rateLimiter, durability ):
+    treeStore = openTreeStore(dryRun=dryRun,verbose=verbose,durability=durability)
+    treeStore.setVerifyLevel(verifyLevel)
+    treeStore.setRateLimiter(rateLimiter)
     pkg = treeStore.find( treename, metadata )
     treeStore.download( pkg, DownloadProgress(pkg) )
-    print
+    printThrottled( rateLimiter )
 
 def flush( dryRun, verbose ):
     treeStore = openTreeStore(dryRun=dryRun,verbose=verbose)
@@ -194,16 +238,31 @@ def flushCache( dryRun, verbose, packageNames ):
     treeStore.flushLocalCache(packageNames)
     print
     
-def install( treename, localdir, verbose, pathRegex, metadata ):
-    treeStore = openTreeStore(verbose=verbose)
+def install( treename, localdir, verbose, pathRegex, metadata, installMode, workers, verifyLevel, rateLimiter, durability, ioProfile, staged, keep, seedDirs ):
+    treeStore = openTreeStore(verbose=verbose,durability=durability)
+    treeStore.setVerifyLevel(verifyLevel)
+    treeStore.setSeedDirs(seedDirs)
+    treeStore.setIoProfile(ioProfile)
+    treeStore.setInstallMode(installMode)
+    treeStore.setWorkers(workers)
+    treeStore.setRateLimiter(rateLimiter)
     pkg = treeStore.find( treename, metadata )
     pkg = packageFilter(pkg,pathRegex)
-    treeStore.download( pkg, DownloadProgress(pkg) )
-    print
-    treeStore.verifyLocal( pkg )
-    treeStore.install( pkg, localdir, InstallProgress(pkg) )
+    # Files taken from the seeds needn't be in the local cache
+    fetchPkg = treeStore.unseeded( pkg )
+    treeStore.download( fetchPkg, DownloadProgress(fetchPkg) )
+    printThrottled( rateLimiter )
+    treeStore.verifyLocal( fetchPkg )
+    if staged:
+        treeStore.installStaged( pkg, localdir, InstallProgress(pkg), keep )
+    else:
+        treeStore.install( pkg, localdir, InstallProgress(pkg) )
     print
 
+def rollback( localdir ):
+    versionPath = staging.rollback( localdir, sync=True )
+    print("{} now refers to {}".format( localdir, versionPath ))
+
 def installReadingPfile( packagefile, localdir, verbose ):
     treeStore = openTreeStore(verbose=verbose)
     pkg = readPackageFile(packagefile)
@@ -213,21 +272,26 @@ def installReadingPfile( packagefile, localdir, verbose ):
     treeStore.install( pkg, localdir, InstallProgress(pkg) )
     print
 
-def verifyInstallPfile( packagefile, localdir, verbose ):
-    treeStore = openTreeStore(verbose=verbose)
+def verifyInstallPfile( packagefile, localdir, verbose, full, workers ):
+    treeStore = nonS3TreeStore()
+    treeStore.setWorkers(workers)
     pkg = readPackageFile(packagefile)
-    _verifyPackage(packagefile, pkg, localdir)
+    _verifyPackage(treeStore, packagefile, pkg, localdir, full)
 
-def verifyInstall( treename, localdir, verbose, metadata ):
+def verifyInstall( treename, localdir, verbose, metadata, full, workers ):
     treeStore = openTreeStore(verbose=verbose)
+    treeStore.setWorkers(workers)
     pkg = treeStore.find( treename, metadata )
-    result = treeStore.compareInstall( pkg, localdir )
+    _verifyPackage(treeStore, treename, pkg, localdir, full)
+
+def _verifyPackage( treeStore, name, pkg, localdir, full ):
+    result = treeStore.compareInstall( pkg, localdir, full )
     for path in result.missing:
         print("{} is missing".format(path))
     for path in result.diffs:
         print("{} is different".format(path))
     if len(result.missing) == 0 and len(result.diffs) == 0:
-        print("Package {} verified ok at {}".format(treename,localdir))
+        print("Package {} verified ok at {}".format(name,localdir))
     else:
         sys.exit(1)
 
@@ -237,23 +301,53 @@ def presign( treename, expirySecs, metadata ):
     treeStore.addUrls( pkg, expirySecs )
     print(json.dumps( PackageJS().toJson(pkg), sort_keys=True, indent=2, separators=(',', ': ') ))
 
-def downloadHttp( packageFile ):
-    treeStore = nonS3TreeStore()
+def downloadHttp( packageFile, verifyLevel, workers, retries, hedgeAfter, rateLimiter, durability ):
+    treeStore = nonS3TreeStore(durability)
+    treeStore.setVerifyLevel(verifyLevel)
+    treeStore.setWorkers(workers)
     pkg = readPackageFile( packageFile )
-    treeStore.downloadHttp( pkg, DownloadProgress(pkg) )
-    print
-
-def installHttp( packageFile, localdir ):
-    treeStore = nonS3TreeStore()
+    with HttpDownloader( workers, retries=retries, hedgeAfter=hedgeAfter, rateLimiter=rateLimiter ) as httpDownloader:
+        treeStore.setHttpDownloader( httpDownloader )
+        treeStore.downloadHttp( pkg, DownloadProgress(pkg) )
+    printThrottled( rateLimiter )
+
+def installHttp( packageFile, localdir, verifyLevel, durability, ioProfile, seedDirs ):
+    treeStore = nonS3TreeStore(durability)
+    treeStore.setVerifyLevel(verifyLevel)
+    treeStore.setSeedDirs(seedDirs)
+    treeStore.setIoProfile(ioProfile)
     pkg = readPackageFile( packageFile )
-    treeStore.verifyLocal( pkg )
+    treeStore.verifyLocal( treeStore.unseeded( pkg ) )
     treeStore.install( pkg, localdir, InstallProgress(pkg) )
     print
 
-def primeCache( localdir ):
-    treeStore = openTreeStore()
+def primeCache( localdir, durability ):
+    treeStore = openTreeStore(durability=durability)
     treeStore.prime( localdir, UploadProgress() )
 
+def cacheServe( host, port ):
+    server = CacheServer( openLocalCache(), (host, port) )
+    print("Serving {} on {}:{}".format( os.environ['S3TS_LOCALCACHE'], host, server.server_address[1] ))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def compactCache():
+    localCache = openLocalCache()
+    if not isinstance( localCache, PackFileStore ):
+        sys.stderr.write( 'Only pack file caches (with S3TS_LOCALCACHE=pack:DIR) can be compacted\n' )
+        sys.exit(1)
+    print("Reclaimed {} bytes".format( localCache.compact() ))
+
+def configureCache( decodeChunks ):
+    treeStore = nonS3TreeStore()
+    if decodeChunks is not None:
+        treeStore.configureLocalCache( LocalCacheConfig( decodeChunks ) )
+    print("decode chunks: {}".format(treeStore.cacheConfig.decodeChunks))
+
 def validateCache():
     treeStore = openTreeStore()
     print(treeStore.validateLocalCache())
@@ -337,6 +431,31 @@ def pathRegex(arg):
     else:
         return re.compile(arg)
 
+def addRateLimitArguments( p ):
+    p.add_argument('--max-bytes-per-sec', dest='maxBytesPerSec', action='store', type=float,
+                   default=os.environ.get('S3TS_MAX_BYTES_PER_SEC'),
+                   help='Limit transfers to this many bytes per second (defaults to $S3TS_MAX_BYTES_PER_SEC)')
+    p.add_argument('--max-requests-per-sec', dest='maxRequestsPerSec', action='store', type=float,
+                   default=os.environ.get('S3TS_MAX_REQUESTS_PER_SEC'),
+                   help='Limit requests to this many per second (defaults to $S3TS_MAX_REQUESTS_PER_SEC)')
+
+def addDurabilityArgument( p ):
+    p.add_argument('--durability', dest='durability', action='store', choices=DURABILITY_MODES,
+                   default=os.environ.get('S3TS_DURABILITY', DURABILITY_NONE),
+                   help='Sync nothing, each file as it is written, or all files once written (defaults to $S3TS_DURABILITY)')
+
+def addIoProfileArgument( p ):
+    p.add_argument('--io-profile', dest='ioProfile', action='store', choices=IO_PROFILES,
+                   default=os.environ.get('S3TS_IO_PROFILE', IO_PROFILE_DEFAULT),
+                   help='With "streaming", preallocate files and keep them out of the page cache (defaults to $S3TS_IO_PROFILE)')
+
+def addSeedArgument( p ):
+    p.add_argument('--seed', dest='seedDirs', action='append', default=[],
+                   help='An existing installation from which unchanged files are taken (may be repeated)')
+
+def rateLimiter( args ):
+    return RateLimiter( args.maxBytesPerSec, args.maxRequestsPerSec )
+
 parser = argparse.ArgumentParser()
 
 subparsers = parser.add_subparsers(help='commands',dest='commandName')
@@ -364,6 +483,7 @@ p.set_defaults(dryRun=False,verbose=False,description='')
 p.add_argument('--dry-run', dest='dryRun', action='store_true')
 p.add_argument('--verbose', dest='verbose', action='store_true')
 p.add_argument('--description', dest='description', action='store')
+addRateLimitArguments(p)
 p.add_argument('treename', action='store', help='The name of the tree')
 p.add_argument('localdir', action='store', help='The local directory path')
 
@@ -372,6 +492,10 @@ p.set_defaults(dryRun=False,verbose=False)
 p.add_argument('--dry-run', dest='dryRun', action='store_true')
 p.add_argument('--verbose', dest='verbose', action='store_true')
 p.add_argument('--meta', dest='meta', action='append')
+p.add_argument('--verify', dest='verifyLevel', action='store', default=VERIFY_ALWAYS, choices=VERIFY_LEVELS,
+               help='How often content integrity is checked')
+addRateLimitArguments(p)
+addDurabilityArgument(p)
 p.add_argument('treename', action='store', help='The name of the tree')
 
 p = subparsers.add_parser('flush', help='Flush chunks from the store that are no longer referenced')
@@ -390,11 +514,32 @@ p.set_defaults(verbose=False)
 p.add_argument('--verbose', dest='verbose', action='store_true')
 p.add_argument('--meta', dest='meta', action='append')
 p.add_argument('--path-regex', dest='pathRegex', action='store')
+p.add_argument('--install-mode', dest='installMode', action='store', default=INSTALL_COPY, choices=INSTALL_MODES,
+               help='How single chunk files are materialised (hardlinked files must be treated as read only)')
+p.add_argument('--workers', dest='workers', action='store', default=8, type=int,
+               help='The number of files to be written concurrently')
+p.add_argument('--verify', dest='verifyLevel', action='store', default=VERIFY_ALWAYS, choices=VERIFY_LEVELS,
+               help='How often content integrity is checked')
+addRateLimitArguments(p)
+addDurabilityArgument(p)
+addIoProfileArgument(p)
+addSeedArgument(p)
+p.add_argument('--staged', dest='staged', action='store_true',
+               help='Install a new version alongside the current one, and switch the localdir symlink to it once complete')
+p.add_argument('--keep', dest='keep', action='store', default=2, type=int,
+               help='The number of previous versions of a staged install kept for rollback')
 p.add_argument('treename', action='store', help='The name of the tree')
 p.add_argument('localdir', action='store', help='The local directory path')
 
+p = subparsers.add_parser('rollback', help='Switch a staged install back to its previous version')
+p.add_argument('localdir', action='store', help='The local directory path')
+
 p = subparsers.add_parser('verify-install', help='Confirm a tree has been correctly installed')
 p.add_argument('--verbose', dest='verbose', action='store_true')
+p.add_argument('--workers', dest='workers', action='store', default=8, type=int,
+               help='The number of files to be verified concurrently')
+p.add_argument('--full', dest='full', action='store_true',
+               help='Check the content of every file, even those unchanged since installation')
 p.add_argument('--meta', dest='meta', action='append')
 p.add_argument('treename', action='store', help='The name of the tree')
 p.add_argument('localdir', action='store', help='The local directory path')
@@ -406,13 +551,29 @@ p.add_argument('--expirySecs', action='store', default=3600, type=int,
 p.add_argument('--meta', dest='meta', action='append')
 
 p = subparsers.add_parser('download-http', help='Download a tree to the local cache using a presigned package file')
+p.add_argument('--verify', dest='verifyLevel', action='store', default=VERIFY_ALWAYS, choices=VERIFY_LEVELS,
+               help='How often content integrity is checked')
+p.add_argument('--workers', dest='workers', action='store', default=8, type=int,
+               help='The number of chunks to be downloaded concurrently')
+p.add_argument('--retries', dest='retries', action='store', default=5, type=int,
+               help='The number of times a failed request is retried')
+p.add_argument('--hedge-after', dest='hedgeAfter', action='store', default=None, type=float,
+               help='Seconds to wait for a response before issuing a second request for the same chunk')
+addRateLimitArguments(p)
+addDurabilityArgument(p)
 p.add_argument('pkgfile', action='store', help='The file containing the package definition')
 
 p = subparsers.add_parser('install-http', help='Install a tree from local cache using a presigned package file')
+p.add_argument('--verify', dest='verifyLevel', action='store', default=VERIFY_ALWAYS, choices=VERIFY_LEVELS,
+               help='How often content integrity is checked')
+addDurabilityArgument(p)
+addIoProfileArgument(p)
+addSeedArgument(p)
 p.add_argument('pkgfile', action='store', help='The file containing the package definition')
 p.add_argument('localdir', action='store', help='The local directory path')
 
 p = subparsers.add_parser('prime-cache', help='Prime the local cache with the contents of a local directory')
+addDurabilityArgument(p)
 p.add_argument('localdir', action='store', help='The local directory path')
 
 p = subparsers.add_parser('upload-many', help='Upload multiple trees from the local filesystem')
@@ -459,10 +620,29 @@ p.add_argument('localdir', action='store', help='The local directory path')
 
 p = subparsers.add_parser('verify-install-pfile', help='Confirm a package file has been correctly installed')
 p.add_argument('--verbose', dest='verbose', action='store_true')
+p.add_argument('--workers', dest='workers', action='store', default=8, type=int,
+               help='The number of files to be verified concurrently')
+p.add_argument('--full', dest='full', action='store_true',
+               help='Check the content of every file, even those unchanged since installation')
 p.add_argument('packagefile', action='store', help='The package filepath')
 p.add_argument('localdir', action='store', help='The local directory path')
 
 
+p = subparsers.add_parser('configure-cache', help='Show or change the configuration of the local cache')
+p.set_defaults(decodeChunks=None)
+p.add_argument('--decode-chunks', dest='decodeChunks', action='store_true',
+               help='Hold chunks decoded in the cache, using more disk but less CPU on install')
+p.add_argument('--no-decode-chunks', dest='decodeChunks', action='store_false',
+               help='Hold chunks in the cache as they are stored')
+
+p = subparsers.add_parser('cache-serve', help='Serve the chunks in the local cache over http, to peers listed in their $S3TS_PEERS')
+p.add_argument('--host', dest='host', action='store', default='0.0.0.0',
+               help='The address to listen on')
+p.add_argument('--port', dest='port', action='store', default=8780, type=int,
+               help='The port to listen on')
+
+p = subparsers.add_parser('compact-cache', help='Reclaim the space of removed chunks in a pack file local cache')
+
 validate_local_cache_parser = subparsers.add_parser('validate-local-cache', help='Validates the local cache')
 
 def main():
@@ -478,31 +658,39 @@ def main():
     elif args.commandName == 'info':
         info( args.treename, pathRegex(args.pathRegex) )
     elif args.commandName == 'upload':
-        upload( args.treename, args.description, args.localdir, args.dryRun, args.verbose )
+        upload( args.treename, args.description, args.localdir, args.dryRun, args.verbose, rateLimiter(args) )
     elif args.commandName == 'download':
-        download( args.treename, args.dryRun, args.verbose, metaDataDictionary(args.meta) )
+        download( args.treename, args.dryRun, args.verbose, metaDataDictionary(args.meta), args.verifyLevel, rateLimiter(args), args.durability )
     elif args.commandName == 'flush':
         flush( args.dryRun, args.verbose )
     elif args.commandName == 'flush-cache':
         flushCache( args.dryRun, args.verbose, args.packagenames )
     elif args.commandName == 'install':
-        install( args.treename, args.localdir, args.verbose, pathRegex(args.pathRegex), metaDataDictionary(args.meta) )
+        install( args.treename, args.localdir, args.verbose, pathRegex(args.pathRegex), metaDataDictionary(args.meta), args.installMode, args.workers, args.verifyLevel, rateLimiter(args), args.durability, args.ioProfile, args.staged, args.keep, args.seedDirs )
+    elif args.commandName == 'rollback':
+        rollback( args.localdir )
     elif args.commandName == 'verify-install':
-        verifyInstall( args.treename, args.localdir, args.verbose, metaDataDictionary(args.meta) )
+        verifyInstall( args.treename, args.localdir, args.verbose, metaDataDictionary(args.meta), args.full, args.workers )
     elif args.commandName == 'presign':
         presign( args.treename, args.expirySecs, metaDataDictionary(args.meta) )
     elif args.commandName == 'download-http':
-        downloadHttp( args.pkgfile )
+        downloadHttp( args.pkgfile, args.verifyLevel, args.workers, args.retries, args.hedgeAfter, rateLimiter(args), args.durability )
     elif args.commandName == 'install-http':
-        installHttp( args.pkgfile, args.localdir )
+        installHttp( args.pkgfile, args.localdir, args.verifyLevel, args.durability, args.ioProfile, args.seedDirs )
     elif args.commandName == 'prime-cache':
-        primeCache( args.localdir )
+        primeCache( args.localdir, args.durability )
     elif args.commandName == 'upload-many':
         uploadMany(args.treename, args.description, args.localdir, args.local_variant_dir)
     elif args.commandName == 'create-merged':
         createMerged(args.treename, args.package_args, args.dryRun, args.verbose)
     elif args.commandName == 'validate-local-cache':
         validateCache()
+    elif args.commandName == 'compact-cache':
+        compactCache()
+    elif args.commandName == 'cache-serve':
+        cacheServe( args.host, args.port )
+    elif args.commandName == 'configure-cache':
+        configureCache(args.decodeChunks)
     elif args.commandName == 'compare-packages':
         comparePackages(args.package1, args.package2, metaDataDictionary(args.meta))
     elif args.commandName == 'new-metapackage':
@@ -515,8 +703,8 @@ def main():
         uploadWritingPfile(args.packagefile, args.localdir, args.dryRun, args.verbose )
     elif args.commandName == 'install-reading-pfile':
         installReadingPfile(args.packagefile, args.localdir, args.verbose )
-    elif args.commandName == 'verify-pfile':
-        verifyInstallPfile(args.packagefile, args.localdir, args.verbose )
+    elif args.commandName == 'verify-install-pfile':
+        verifyInstallPfile(args.packagefile, args.localdir, args.verbose, args.full, args.workers )
 
 if __name__ == '__main__':
     main()
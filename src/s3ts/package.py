@@ -2,10 +2,14 @@ import json, datetime, os
 
 from collections import OrderedDict
 from s3ts.utils import datetimeFromIso
+from s3ts import filewriter
 
 ENCODING_RAW = 'raw'
 ENCODING_ZLIB = 'zlib'
 
+# A chunk of all zero bytes, which has no stored object
+ENCODING_ZERO = 'zero'
+
 class Package(object):
     """represents a collection of files to be downloaded."""
     
@@ -149,13 +153,34 @@ def packageDiff(package1, package2):
             diffPackage.files.append(files2[p])
 
     return diffPackage,removedPaths
+
+def packageRelocations(package1, diffPackage):
+    """
+    Find the files in diffPackage whose content is already present in
+    package1, at some other path. Returns a dictionary mapping each such
+    path in diffPackage to the path in package1 with the same content.
+    """
+    pathsBySha1 = {}
+    for f in package1.files:
+        pathsBySha1.setdefault(f.sha1, f.path)
+
+    relocations = {}
+    for f in diffPackage.files:
+        if f.sha1 in pathsBySha1:
+            relocations[f.path] = pathsBySha1[f.sha1]
+    return relocations
             
 S3TS_PACKAGEFILE = '.s3ts.package' 
 
-def writeInstallPackage( installDir, pkg ):
-    with open( os.path.join( installDir, S3TS_PACKAGEFILE ), 'w' ) as f:
-        f.write( json.dumps( PackageJS().toJson( pkg ) ) )
+def writeInstallPackage( installDir, pkg, sync=False ):
+    with filewriter.atomicFileWriter( os.path.join( installDir, S3TS_PACKAGEFILE ), sync ) as f:
+        f.write( json.dumps( PackageJS().toJson( pkg ) ).encode('utf-8') )
 
 def readInstallPackage( installDir ):
-    with open( os.path.join( installDir, S3TS_PACKAGEFILE ), 'r' ) as f:
-        return PackageJS().fromJson( json.loads( f.read() ) )
+    path = os.path.join( installDir, S3TS_PACKAGEFILE )
+    with open( path, 'r' ) as f:
+        try:
+            return PackageJS().fromJson( json.loads( f.read() ) )
+        except ValueError as e:
+            # Treated as absent, like a file that was never written
+            raise IOError( "unable to parse {}: {}".format( path, e ) )
@@ -0,0 +1,458 @@
+import os, struct, hashlib, threading, contextlib, mmap, time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from s3ts.filestore import FileStore, FileMetaData, LocalFileStore
+from s3ts import filewriter
+
+PACKS_PATH = 'packs'
+INDEX_PATH = 'index'
+LOCK_PATH = 'lock'
+
+# Packs are appended to until they reach this size
+MAX_PACK_SIZE = 1024 * 1024 * 1024
+
+# Each record in a pack is a header, the path, then the value
+RECORD = struct.Struct( '<4sBHQd' )
+RECORD_MAGIC = b'S3PK'
+RECORD_PUT = 0
+RECORD_REMOVE = 1
+
+# The index is an open addressed hash table of fixed size slots, each
+# mapping the (truncated) sha1 of a path to the location of its value.
+# Its header records the pack appended to, and the offset of its end.
+INDEX_HEADER = struct.Struct( '<8sQQQIQ' )
+INDEX_MAGIC = b'S3TSIDX2'
+INDEX_SLOT = struct.Struct( '<16sIQQH' )
+SLOT_EMPTY = 0
+SLOT_REMOVED = 0xffffffff
+MIN_SLOTS = 1024
+MAX_LOAD = 0.7
+
+# Locks on paths are striped over this many lock files for each top level
+# directory, rather than taking an inode for each path locked
+LOCK_STRIPES = 256
+LOCK_STRIPES_PATH = 'stripes'
+
+class PackFileStore(FileStore):
+    """
+    implements the FileStore interface with values appended to a few large
+    pack files, rather than a file per value, so that millions of small
+    values use few inodes, and can be listed without walking directories.
+
+    An mmapped on-disk hash index maps each path to its latest value.
+    Removals append a record to the packs and free the index slot, but
+    the space is only reclaimed by compact(). The index can be rebuilt
+    from the packs, and is if it is missing or damaged. A record left
+    incomplete by a crash is truncated from its pack, by the rebuild or
+    by the next append, as it lies beyond the end recorded in the index.
+
+    Processes sharing the store are serialised by a lock file. Locks on
+    paths share a fixed set of lock files, so a lock may be held by a
+    process using an unrelated path.
+
+    With DURABILITY_FILE each record is synced before the index refers to
+    it. With DURABILITY_BATCH the packs written are synced by sync(). In
+    both cases sync() then syncs the index, which is otherwise left to be
+    written back with the mapped pages.
+    """
+
+    def __init__( self, root, durability=filewriter.DURABILITY_NONE ):
+        if durability not in filewriter.DURABILITY_MODES:
+            raise RuntimeError("unknown durability {}".format(durability))
+        self.root = root
+        self.durability = durability
+        self.unsyncedPacks = set()
+        self.indexDirty = False
+        self.locks = LocalFileStore( root )
+        self.threadLock = threading.RLock()
+        self.lockFd = None
+        self.index = None
+        self.indexIno = None
+        self.packFds = {}
+        os.makedirs( os.path.join( root, PACKS_PATH ), exist_ok=True )
+        with self.__locked( True ):
+            pass
+
+    def exists( self, path ):
+        with self.__locked( False ):
+            return self.__lookup( path )[2] is not None
+
+    def get( self, path ):
+        with self.__locked( False ):
+            pack, valueOffset, size, keyLen = self.__existing( path )
+            return self.__read( pack, valueOffset, size )
+
+    def getStream( self, path, offset=0 ):
+        with self.__locked( False ):
+            pack, valueOffset, size, keyLen = self.__existing( path )
+            offset = min( offset, size )
+            return PackValueReader( os.dup( self.__packFd( pack ) ), valueOffset + offset, size - offset )
+
+    def put( self, path, body ):
+        with self.__locked( True ):
+            self.__append( path, RECORD_PUT, body )
+
+    def remove( self, path ):
+        with self.__locked( True ):
+            slot, hash, existing = self.__lookup( path )
+            if existing is None:
+                return
+            self.__append( path, RECORD_REMOVE, b'' )
+
+    def list( self, pathPrefix ):
+        prefix = pathPrefix + os.sep if pathPrefix else ''
+        with self.__locked( False ):
+            results = []
+            for hash, pack, valueOffset, size, keyLen in sorted( self.__slots(), key=lambda s: (s[1],s[2]) ):
+                path = self.__read( pack, valueOffset - keyLen, keyLen ).decode('utf-8')
+                if path.startswith( prefix ):
+                    results.append( path[len(prefix):] )
+            return results
+
+    def joinPath( self, *elements):
+        return os.path.join(*elements)
+
+    def splitPath( self, path):
+        return path.split(os.sep)
+
+    def getMetadata( self, path):
+        with self.__locked( False ):
+            pack, valueOffset, size, keyLen = self.__existing( path )
+            header = RECORD.unpack( self.__read( pack, valueOffset - keyLen - RECORD.size, RECORD.size ) )
+            return FileMetaData( size, header[4] )
+
+    def lock( self, path, shared=False, blocking=True ):
+        # Each top level directory has its own stripes, so that a lock can be
+        # taken while holding one on a path in another directory
+        stripe = int.from_bytes( pathHash( path.encode('utf-8') )[:4], 'little' ) % LOCK_STRIPES
+        return self.locks.lock( os.path.join( LOCK_STRIPES_PATH, path.split( os.sep )[0], '{:02x}'.format( stripe ) ), shared, blocking )
+
+    def removeLock( self, path ):
+        # The lock file is shared with other paths, and removed once released
+        pass
+
+    def sync( self ):
+        with self.threadLock:
+            if self.unsyncedPacks:
+                for pack in sorted( self.unsyncedPacks ):
+                    if pack in self.packFds:
+                        os.fsync( self.packFds[pack] )
+                    elif os.path.exists( self.__packPath( pack ) ):
+                        filewriter.fsyncPath( self.__packPath( pack ) )
+                filewriter.fsyncPath( os.path.join( self.root, PACKS_PATH ) )
+                self.unsyncedPacks = set()
+            # The index is synced after the packs it refers to
+            if self.indexDirty and self.index is not None:
+                self.index.flush()
+            self.indexDirty = False
+
+    def compact( self ):
+        """Rewrite the live values into new packs, and remove the old ones.
+        Returns the number of bytes reclaimed."""
+        with self.__locked( True ):
+            oldPacks = self.__packNumbers()
+            oldSize = sum( os.path.getsize( self.__packPath( n ) ) for n in oldPacks )
+            slots = sorted( self.__slots(), key=lambda s: (s[1],s[2]) )
+
+            # Start a new pack, so that no old pack is appended to
+            packEnd = (max( oldPacks or [0] ) + 1, 0)
+            entries = []
+            for hash, pack, valueOffset, size, keyLen in slots:
+                key = self.__read( pack, valueOffset - keyLen, keyLen )
+                body = self.__read( pack, valueOffset, size )
+                newPack, newOffset, packEnd = self.__appendRecord( key, RECORD_PUT, body, packEnd )
+                entries.append( (hash, newPack, newOffset, size, keyLen) )
+            for fd in self.packFds.values():
+                os.fsync( fd )
+
+            self.__writeIndex( entries, packEnd )
+            self.__refreshIndex()
+            for n in oldPacks:
+                os.unlink( self.__packPath( n ) )
+            newSize = sum( os.path.getsize( self.__packPath( n ) ) for n in self.__packNumbers() )
+            return oldSize - newSize
+
+    def rebuildIndex( self ):
+        """Rebuild the index by scanning the packs"""
+        with self.__locked( True ):
+            self.__rebuildIndex()
+
+    @contextlib.contextmanager
+    def __locked( self, exclusive ):
+        """Hold the store lock, shared for reads and exclusive for writes"""
+        with self.threadLock:
+            if self.lockFd is not None:
+                # Already held by this thread
+                yield
+                return
+            self.lockFd = os.open( os.path.join( self.root, LOCK_PATH ), os.O_RDWR | os.O_CREAT, 0o666 )
+            try:
+                if fcntl is not None:
+                    fcntl.flock( self.lockFd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH )
+                if not self.__refreshIndex():
+                    if fcntl is not None and not exclusive:
+                        fcntl.flock( self.lockFd, fcntl.LOCK_EX )
+                    self.__rebuildIndex()
+                    if not self.__refreshIndex():
+                        raise RuntimeError( "can't map the index of {}".format( self.root ) )
+                yield
+            finally:
+                os.close( self.lockFd )
+                self.lockFd = None
+
+    def __refreshIndex( self ):
+        """Map the index, if it has been replaced since it was last mapped.
+        Returns False if the index is missing or damaged."""
+        indexPath = os.path.join( self.root, INDEX_PATH )
+        try:
+            ino = os.stat( indexPath ).st_ino
+        except FileNotFoundError:
+            return False
+        if self.index is not None and ino == self.indexIno:
+            return True
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+        # Packs may have been replaced along with the index
+        for fd in self.packFds.values():
+            os.close( fd )
+        self.packFds = {}
+        with open( indexPath, 'r+b' ) as f:
+            header = f.read( INDEX_HEADER.size )
+            if len(header) < INDEX_HEADER.size:
+                return False
+            magic, nSlots = INDEX_HEADER.unpack( header )[:2]
+            st = os.fstat( f.fileno() )
+            if magic != INDEX_MAGIC or nSlots == 0 or st.st_size != slotOffset( nSlots ):
+                return False
+            self.index = mmap.mmap( f.fileno(), 0 )
+        self.indexIno = st.st_ino
+        return True
+
+    def __rebuildIndex( self ):
+        latest = {}
+        packs = self.__packNumbers()
+        for n in packs:
+            for key, kind, valueOffset, size in self.__scanPack( n, 0 ):
+                if kind == RECORD_PUT:
+                    latest[key] = (n, valueOffset, size, len(key))
+                else:
+                    latest.pop( key, None )
+        entries = [(pathHash( key ),) + location for key, location in latest.items()]
+        lastPack = packs[-1] if packs else 1
+        self.__writeIndex( entries, (lastPack, os.path.getsize( self.__packPath( lastPack ) ) if packs else 0) )
+
+    def __scanPack( self, n, offset ):
+        """Yields (key, kind, valueOffset, size) for each complete record in
+        pack n from offset. Anything after the last complete record was never
+        completely written, and is cut off, so that records appended later
+        follow on from the others."""
+        with open( self.__packPath( n ), 'r+b' ) as f:
+            packSize = os.fstat( f.fileno() ).st_size
+            f.seek( offset )
+            while offset < packSize:
+                header = f.read( RECORD.size )
+                if len(header) < RECORD.size:
+                    break
+                magic, kind, keyLen, size, mtime = RECORD.unpack( header )
+                key = f.read( keyLen )
+                valueOffset = offset + RECORD.size + keyLen
+                if magic != RECORD_MAGIC or kind not in (RECORD_PUT, RECORD_REMOVE) or len(key) < keyLen or valueOffset + size > packSize:
+                    break
+                yield key, kind, valueOffset, size
+                offset = valueOffset + size
+                f.seek( offset )
+            if offset < packSize:
+                f.truncate( offset )
+
+    def __writeIndex( self, entries, packEnd ):
+        """Atomically replace the index with one holding entries, recording
+        packEnd as the (pack, offset) at which the next record is appended"""
+        nSlots = MIN_SLOTS
+        while len(entries) > nSlots * MAX_LOAD / 2:
+            nSlots *= 2
+        buf = bytearray( INDEX_HEADER.size + nSlots * INDEX_SLOT.size )
+        INDEX_HEADER.pack_into( buf, 0, INDEX_MAGIC, nSlots, len(entries), len(entries), *packEnd )
+        for entry in entries:
+            i = slotFor( entry[0], nSlots )
+            while INDEX_SLOT.unpack_from( buf, slotOffset( i ) )[1] != SLOT_EMPTY:
+                i = (i + 1) % nSlots
+            INDEX_SLOT.pack_into( buf, slotOffset( i ), *entry )
+        indexPath = os.path.join( self.root, INDEX_PATH )
+        with open( indexPath + '.tmp', 'wb' ) as f:
+            f.write( buf )
+            f.flush()
+            os.fsync( f.fileno() )
+        os.replace( indexPath + '.tmp', indexPath )
+        if self.durability != filewriter.DURABILITY_NONE:
+            filewriter.fsyncPath( self.root )
+
+    def __lookup( self, path ):
+        """Returns (slot, hash, (pack, valueOffset, size, keyLen)) for path, or
+        (slot, hash, None) with the slot it would be inserted at"""
+        hash = pathHash( path.encode('utf-8') )
+        nSlots = INDEX_HEADER.unpack_from( self.index, 0 )[1]
+        i = slotFor( hash, nSlots )
+        free = None
+        while True:
+            slotHash, pack, valueOffset, size, keyLen = INDEX_SLOT.unpack_from( self.index, slotOffset( i ) )
+            if pack == SLOT_EMPTY:
+                return (i if free is None else free), hash, None
+            if pack == SLOT_REMOVED:
+                if free is None:
+                    free = i
+            elif slotHash == hash:
+                return i, hash, (pack, valueOffset, size, keyLen)
+            i = (i + 1) % nSlots
+
+    def __existing( self, path ):
+        location = self.__lookup( path )[2]
+        if location is None:
+            raise KeyError( path )
+        return location
+
+    def __slots( self ):
+        """The contents of all occupied index slots"""
+        nSlots = INDEX_HEADER.unpack_from( self.index, 0 )[1]
+        for i in range( nSlots ):
+            slot = INDEX_SLOT.unpack_from( self.index, slotOffset( i ) )
+            if slot[1] not in (SLOT_EMPTY, SLOT_REMOVED):
+                yield slot
+
+    def __append( self, path, kind, body ):
+        """Append a record to the packs, and update the index to match"""
+        self.__recoverTail()
+        packEnd = INDEX_HEADER.unpack_from( self.index, 0 )[4:]
+        pack, valueOffset, packEnd = self.__appendRecord( path.encode('utf-8'), kind, body, packEnd )
+        self.__indexRecord( path, kind, pack, valueOffset, len(body), packEnd )
+
+    def __recoverTail( self ):
+        """Index any complete records after the end of the packs recorded in
+        the index, left by a writer that failed part way through an append,
+        and cut off the rest"""
+        pack, end = INDEX_HEADER.unpack_from( self.index, 0 )[4:]
+        packSize = os.fstat( self.__packFd( pack ) ).st_size
+        if packSize == end:
+            return
+        if packSize < end:
+            # Records the index refers to have been lost
+            self.__rebuildIndex()
+            self.__refreshIndex()
+            return
+        for key, kind, valueOffset, size in self.__scanPack( pack, end ):
+            self.__indexRecord( key.decode('utf-8'), kind, pack, valueOffset, size, (pack, valueOffset + size) )
+        header = INDEX_HEADER.unpack_from( self.index, 0 )[:4]
+        INDEX_HEADER.pack_into( self.index, 0, *(header + (pack, os.fstat( self.__packFd( pack ) ).st_size)) )
+
+    def __indexRecord( self, path, kind, pack, valueOffset, size, packEnd ):
+        """Update the index for a record appended to the packs, which now end at packEnd"""
+        slot, hash, existing = self.__lookup( path )
+        magic, nSlots, live, used = INDEX_HEADER.unpack_from( self.index, 0 )[:4]
+        slotEmpty = INDEX_SLOT.unpack_from( self.index, slotOffset( slot ) )[1] == SLOT_EMPTY
+        if kind == RECORD_PUT:
+            if slotEmpty:
+                used += 1
+            if existing is None:
+                live += 1
+        elif existing is not None:
+            live -= 1
+        # The end of the packs is moved on first, so that the index never
+        # refers to a record beyond it
+        INDEX_HEADER.pack_into( self.index, 0, magic, nSlots, live, used, *packEnd )
+        if kind == RECORD_PUT:
+            INDEX_SLOT.pack_into( self.index, slotOffset( slot ), hash, pack, valueOffset, size, len(path.encode('utf-8')) )
+        elif existing is not None:
+            INDEX_SLOT.pack_into( self.index, slotOffset( slot ), hash, SLOT_REMOVED, 0, 0, 0 )
+        self.indexDirty = True
+
+        if used > nSlots * MAX_LOAD:
+            self.__writeIndex( list( self.__slots() ), packEnd )
+            self.__refreshIndex()
+
+    def __appendRecord( self, key, kind, body, packEnd ):
+        """Append a record at packEnd, the (pack, offset) at which the last record
+        ended, starting a new pack if that one is full. Returns the pack and offset
+        of the value, and the new end of the packs."""
+        pack, offset = packEnd
+        if offset > 0 and offset + len(body) > MAX_PACK_SIZE:
+            pack, offset = pack + 1, 0
+        fd = self.__packFd( pack )
+        if offset == 0:
+            # Clear out anything left by a writer that failed to start the pack
+            os.ftruncate( fd, 0 )
+        record = RECORD.pack( RECORD_MAGIC, kind, len(key), len(body), time.time() ) + key
+        writeAll( fd, record, offset )
+        writeAll( fd, body, offset + len(record) )
+        if self.durability == filewriter.DURABILITY_FILE:
+            os.fsync( fd )
+            if offset == 0:
+                filewriter.fsyncPath( os.path.join( self.root, PACKS_PATH ) )
+        elif self.durability == filewriter.DURABILITY_BATCH:
+            self.unsyncedPacks.add( pack )
+        valueOffset = offset + len(record)
+        return pack, valueOffset, (pack, valueOffset + len(body))
+
+    def __packNumbers( self ):
+        return sorted( int( name.split('.')[0] ) for name in os.listdir( os.path.join( self.root, PACKS_PATH ) )
+                       if name.endswith( '.pack' ) )
+
+    def __packPath( self, n ):
+        return os.path.join( self.root, PACKS_PATH, '{:08d}.pack'.format( n ) )
+
+    def __packFd( self, n ):
+        if n not in self.packFds:
+            self.packFds[n] = os.open( self.__packPath( n ), os.O_RDWR | os.O_CREAT, 0o666 )
+        return self.packFds[n]
+
+    def __read( self, pack, offset, size ):
+        buf = os.pread( self.__packFd( pack ), size, offset )
+        if len(buf) != size:
+            raise RuntimeError( "pack {} is truncated".format( self.__packPath( pack ) ) )
+        return buf
+
+class PackValueReader(object):
+    """A readable file object over a value in a pack"""
+
+    def __init__( self, fd, offset, size ):
+        self.fd = fd
+        self.offset = offset
+        self.remaining = size
+
+    def read( self, n=-1 ):
+        if n < 0 or n > self.remaining:
+            n = self.remaining
+        buf = os.pread( self.fd, n, self.offset )
+        self.offset += len(buf)
+        self.remaining -= len(buf)
+        return buf
+
+    def close( self ):
+        if self.fd is not None:
+            os.close( self.fd )
+            self.fd = None
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *args ):
+        self.close()
+
+def pathHash( key ):
+    return hashlib.sha1( key ).digest()[:16]
+
+def slotFor( hash, nSlots ):
+    return int.from_bytes( hash[:8], 'little' ) % nSlots
+
+def slotOffset( i ):
+    return INDEX_HEADER.size + i * INDEX_SLOT.size
+
+def writeAll( fd, buf, offset ):
+    view = memoryview( buf )
+    while view:
+        n = os.pwrite( fd, view, offset )
+        view = view[n:]
+        offset += n
@@ -0,0 +1,80 @@
+import time
+
+import requests
+import requests.adapters
+
+from s3ts.filestore import FileStore
+
+class PeerFileStore(FileStore):
+    """
+    A read through FileStore that tries to read values from peers serving
+    their local caches (see s3ts.cacheserver), before falling back to
+    another store.
+
+    Only reads of paths starting with one of prefixes are tried on the
+    peers. Everything else, including all writes, goes to the fallback.
+    A peer that can't be reached is skipped for retryAfter seconds.
+    """
+
+    def __init__( self, peerUrls, fallback, prefixes, timeout=10, retryAfter=60 ):
+        self.peerUrls = [url.rstrip('/') for url in peerUrls]
+        self.fallback = fallback
+        self.prefixes = tuple( prefixes )
+        self.timeout = timeout
+        self.retryAfter = retryAfter
+        self.downUntil = {}
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter( pool_maxsize=32 )
+        self.session.mount( 'http://', adapter )
+        self.session.mount( 'https://', adapter )
+
+    def exists( self, path ):
+        return self.fallback.exists( path )
+
+    def get( self, path ):
+        with self.getStream( path ) as f:
+            return f.read()
+
+    def getStream( self, path, offset=0 ):
+        for peerUrl in self.__peersFor( path ):
+            headers = {'Range' : 'bytes={}-'.format(offset)} if offset else {}
+            try:
+                resp = self.session.get( peerUrl + '/' + path.replace('\\', '/'), headers=headers,
+                                         stream=True, timeout=self.timeout )
+            except requests.RequestException:
+                self.downUntil[peerUrl] = time.time() + self.retryAfter
+                continue
+            if resp.status_code == (206 if offset else 200):
+                return resp.raw
+            resp.close()
+        return self.fallback.getStream( path, offset )
+
+    def put( self, path, body ):
+        self.fallback.put( path, body )
+
+    def putStream( self, path ):
+        return self.fallback.putStream( path )
+
+    def remove( self, path ):
+        self.fallback.remove( path )
+
+    def list( self, pathPrefix ):
+        return self.fallback.list( pathPrefix )
+
+    def url( self, path, expiresInSecs ):
+        return self.fallback.url( path, expiresInSecs )
+
+    def joinPath( self, *elements):
+        return self.fallback.joinPath( *elements )
+
+    def splitPath( self, path):
+        return self.fallback.splitPath( path )
+
+    def getMetadata( self, path):
+        return self.fallback.getMetadata( path )
+
+    def __peersFor( self, path ):
+        if not path.startswith( self.prefixes ):
+            return []
+        now = time.time()
+        return [url for url in self.peerUrls if self.downUntil.get( url, 0 ) <= now]
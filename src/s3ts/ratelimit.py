@@ -0,0 +1,55 @@
+import time, threading
+
+class TokenBucket(object):
+    """Tokens accumulate at rate per second, up to burst.
+
+    Taking more tokens than are available puts the bucket into debt,
+    which the taker must wait to be repaid. Not thread safe.
+    """
+
+    def __init__( self, rate, burst ):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take( self, n ):
+        """Take n tokens, returning the seconds to wait before using them"""
+        now = time.monotonic()
+        self.tokens = min( self.burst, self.tokens + (now - self.updated) * self.rate )
+        self.updated = now
+        self.tokens -= n
+        return max( 0.0, -self.tokens / self.rate )
+
+class RateLimiter(object):
+    """Limits the rate of requests and of bytes transferred, across all the
+    threads sharing it. A limit of None is unlimited.
+
+    throttledSecs accumulates the time callers have spent waiting.
+    """
+
+    def __init__( self, bytesPerSec=None, requestsPerSec=None ):
+        self.bytesPerSec = bytesPerSec
+        self.requestsPerSec = requestsPerSec
+        self.byteBucket = TokenBucket( bytesPerSec, bytesPerSec ) if bytesPerSec else None
+        self.requestBucket = TokenBucket( requestsPerSec, max( requestsPerSec, 1 ) ) if requestsPerSec else None
+        self.lock = threading.Lock()
+        self.throttledSecs = 0.0
+
+    def acquire( self, nRequests, nBytes ):
+        """Wait until nRequests requests transferring nBytes are within the limits"""
+        delay = 0.0
+        with self.lock:
+            if self.requestBucket and nRequests:
+                delay = max( delay, self.requestBucket.take( nRequests ) )
+            if self.byteBucket and nBytes:
+                delay = max( delay, self.byteBucket.take( nBytes ) )
+            self.throttledSecs += delay
+        if delay > 0:
+            time.sleep( delay )
+
+    def limitPieces( self, pieces ):
+        """Yields each of pieces once its bytes are within the limits"""
+        for buf in pieces:
+            self.acquire( 0, len(buf) )
+            yield buf
@@ -1,4 +1,4 @@
-import os
+import os, io, tempfile, contextlib
 
 from s3ts.filestore import FileStore
 
@@ -23,10 +23,36 @@ class S3FileStore(FileStore):
                 raise KeyError(e)
             raise
 
+    @contextlib.contextmanager
+    def getStream( self, path, offset=0 ):
+        k = self._key(path)
+        headers = {'Range' : 'bytes={}-'.format(offset)} if offset else None
+        try:
+            k.open_read( headers=headers )
+        except S3ResponseError as e:
+            if e.status == 404:
+                raise KeyError(e)
+            if e.status != 416:
+                raise
+            # offset is at the end of the value, so there's nothing left to read
+            k = io.BytesIO()
+        try:
+            yield k
+        finally:
+            k.close()
+
     def put( self, path, body ):
         k = self._key(path)
         k.set_contents_from_string( body )
 
+    @contextlib.contextmanager
+    def putStream( self, path ):
+        # S3 needs the content length up front, so spool to disk first
+        with tempfile.TemporaryFile() as f:
+            yield f
+            f.seek(0)
+            self._key(path).set_contents_from_file( f )
+
     def list( self, pathPrefix ):
         return [os.path.relpath(key.name,pathPrefix) for key in self.bucket.list(prefix=pathPrefix)]
 
@@ -0,0 +1,171 @@
+import os, shutil, hashlib, tempfile, threading, contextlib
+
+from s3ts.filestore import FileStore, LocalFileStore
+from s3ts import filewriter
+
+SPOOL_SIZE = 1024 * 1024
+
+class ShardedFileStore(FileStore):
+    """
+    implements the FileStore interface over several local directories,
+    typically on separate devices, so that their bandwidth is combined.
+
+    Each path is placed by rendezvous hashing on the directory paths, so
+    adding a directory only moves the values that now belong on it.
+    capacities optionally limits the bytes stored in each directory. A
+    value that doesn't fit is placed in the next directory in its ranking,
+    so reads search the directories in ranked order.
+
+    durability applies to each directory, as for LocalFileStore.
+    """
+
+    def __init__( self, roots, capacities=None, durability=filewriter.DURABILITY_NONE ):
+        self.roots = [os.path.abspath(root) for root in roots]
+        self.stores = [LocalFileStore(root, durability) for root in self.roots]
+        self.capacities = capacities or [None] * len(roots)
+        self.usage = [None] * len(roots)
+        self.usageLock = threading.RLock()
+
+    def exists( self, path ):
+        return self.__find( path ) is not None
+
+    def get( self, path ):
+        return self.__existing( path ).get( path )
+
+    def getBuffer( self, path ):
+        return self.__existing( path ).getBuffer( path )
+
+    def getStream( self, path, offset=0 ):
+        return self.__existing( path ).getStream( path, offset )
+
+    def put( self, path, body ):
+        i, reserved = self.__placement( path, len(body) )
+        previousSize = self.__size( i, path )
+        try:
+            self.stores[i].put( path, body )
+        except:
+            self.__addUsage( i, -reserved )
+            raise
+        self.__addUsage( i, len(body) - previousSize - reserved )
+
+    @contextlib.contextmanager
+    def putStream( self, path ):
+        if all( capacity is None for capacity in self.capacities ):
+            with self.stores[self.__placement( path, 0 )[0]].putStream( path ) as f:
+                yield f
+            return
+        # The size isn't known up front, so spool the value to find where it fits
+        with tempfile.SpooledTemporaryFile( max_size=SPOOL_SIZE ) as spool:
+            yield spool
+            size = spool.tell()
+            spool.seek( 0 )
+            i, reserved = self.__placement( path, size )
+            previousSize = self.__size( i, path )
+            try:
+                with self.stores[i].putStream( path ) as f:
+                    shutil.copyfileobj( spool, f )
+            except:
+                self.__addUsage( i, -reserved )
+                raise
+            self.__addUsage( i, size - previousSize - reserved )
+
+    def remove( self, path ):
+        for i,store in enumerate( self.stores ):
+            if store.exists( path ):
+                size = self.__size( i, path )
+                store.remove( path )
+                self.__addUsage( i, -size )
+
+    def list( self, pathPrefix ):
+        paths = set()
+        for store in self.stores:
+            paths.update( store.list( pathPrefix ) )
+        return sorted( paths )
+
+    def joinPath( self, *elements):
+        return os.path.join(*elements)
+
+    def splitPath( self, path):
+        return path.split(os.sep)
+
+    def getMetadata( self, path):
+        return self.__existing( path ).getMetadata( path )
+
+    def localPath( self, path ):
+        i = self.__find( path )
+        if i is None:
+            i, _ = self.__placement( path, 0 )
+        return self.stores[i].localPath( path )
+
+    def lock( self, path, shared=False, blocking=True ):
+        # Locks ignore capacity, so that every process agrees on their placement
+        return self.stores[self.__ranked( path )[0]].lock( path, shared, blocking )
+
+    def removeLock( self, path ):
+        self.stores[self.__ranked( path )[0]].removeLock( path )
+
+    def sync( self ):
+        for store in self.stores:
+            store.sync()
+
+    def __ranked( self, path ):
+        """The indexes of the directories, in order of preference for path"""
+        key = path.replace( os.sep, '/' ).encode('utf-8')
+        weights = [hashlib.sha1( root.encode('utf-8') + b'\0' + key ).digest() for root in self.roots]
+        return sorted( range(len(self.roots)), key=lambda i: weights[i], reverse=True )
+
+    def __find( self, path ):
+        """The index of the directory holding path, or None"""
+        for i in self.__ranked( path ):
+            if self.stores[i].exists( path ):
+                return i
+        return None
+
+    def __existing( self, path ):
+        i = self.__find( path )
+        if i is None:
+            raise KeyError( path )
+        return self.stores[i]
+
+    def __placement( self, path, size ):
+        """
+        The index of the directory to write path to, and the bytes reserved
+        there, so that concurrent writers can't overfill it between the
+        capacity check and the write
+        """
+        # Overwrite an existing value in place, so that no stale copy is left to shadow it
+        i = self.__find( path )
+        if i is not None:
+            return i, 0
+        with self.usageLock:
+            for i in self.__ranked( path ):
+                capacity = self.capacities[i]
+                if capacity is None:
+                    return i, 0
+                if self.__usage( i ) + size <= capacity:
+                    self.usage[i] += size
+                    return i, size
+        raise RuntimeError( "No space for {} within the capacities of {}".format( path, ', '.join(self.roots) ) )
+
+    def __usage( self, i ):
+        with self.usageLock:
+            if self.usage[i] is None:
+                total = 0
+                for dir0, dirs, files in os.walk( self.roots[i] ):
+                    for file in files:
+                        total += os.path.getsize( os.path.join( dir0, file ) )
+                self.usage[i] = total
+            return self.usage[i]
+
+    def __size( self, i, path ):
+        """The size of path in directory i, where its capacity is limited"""
+        if self.capacities[i] is None or not self.stores[i].exists( path ):
+            return 0
+        return self.stores[i].getMetadata( path ).size
+
+    def __addUsage( self, i, size ):
+        if self.capacities[i] is None:
+            return
+        self.__usage( i )
+        with self.usageLock:
+            self.usage[i] += size
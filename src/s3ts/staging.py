@@ -0,0 +1,94 @@
+"""
+A staged installation is a symlink to the current version of the installed
+tree, each version being a complete tree in a numbered directory alongside
+it. A new version is built without touching the current one, and switched
+to by atomically replacing the symlink, so the installation is never seen
+part way through an update, and can be rolled back just as quickly.
+
+A version is complete once its package file has been written.
+"""
+
+import os, shutil
+
+from s3ts import filewriter, package
+
+# The sibling directory of a staged installation, holding its versions
+VERSIONS_SUFFIX = '.s3ts-versions'
+
+# The temporary symlink through which a staged installation is switched
+SWITCH_SUFFIX = '.s3ts-switch'
+
+def versionsDir( localPath ):
+    # Resolved, so that version paths compare equal to the resolved symlink
+    localPath = os.path.abspath( localPath )
+    return os.path.join( os.path.realpath( os.path.dirname( localPath ) ), os.path.basename( localPath ) + VERSIONS_SUFFIX )
+
+def isStaged( localPath ):
+    return os.path.islink( localPath )
+
+def listVersions( localPath ):
+    """Returns the (number, path) of every version, oldest first"""
+    dir = versionsDir( localPath )
+    if not os.path.isdir( dir ):
+        return []
+    return sorted( (int(name), os.path.join( dir, name )) for name in os.listdir( dir ) if name.isdigit() )
+
+def isComplete( versionPath ):
+    return os.path.exists( os.path.join( versionPath, package.S3TS_PACKAGEFILE ) )
+
+def currentVersion( localPath ):
+    """Returns the path of the current version, or None if there isn't one"""
+    if not isStaged( localPath ):
+        return None
+    return os.path.realpath( localPath )
+
+def newVersion( localPath ):
+    """Create the directory for a new version, clearing out any left incomplete"""
+    if os.path.lexists( localPath ) and not isStaged( localPath ):
+        raise RuntimeError("{} is not a staged installation".format(localPath))
+    current = currentVersion( localPath )
+    versions = listVersions( localPath )
+    for n,path in versions:
+        if path != current and not isComplete( path ):
+            shutil.rmtree( path )
+    versionPath = os.path.join( versionsDir( localPath ), '{:06d}'.format( versions[-1][0] + 1 if versions else 1 ) )
+    os.makedirs( versionPath )
+    return versionPath
+
+def switchVersion( localPath, versionPath, sync=False ):
+    """Atomically point localPath at versionPath, syncing the change if sync is set"""
+    parent = os.path.dirname( os.path.abspath( localPath ) )
+    switchPath = os.path.abspath( localPath ) + SWITCH_SUFFIX
+    if os.path.lexists( switchPath ):
+        os.unlink( switchPath )
+    # A relative link, so that the installation can be moved as a whole. It is
+    # resolved from the real parent directory, as the versions directory is
+    os.symlink( os.path.relpath( versionPath, os.path.realpath( parent ) ), switchPath )
+    os.replace( switchPath, localPath )
+    if sync:
+        filewriter.fsyncPath( parent )
+
+def pruneVersions( localPath, keep ):
+    """Remove all but the current version and the keep versions before it"""
+    current = currentVersion( localPath )
+    previous = [path for n,path in listVersions( localPath ) if path != current]
+    for path in previous[:max( 0, len(previous) - keep )]:
+        shutil.rmtree( path )
+
+def rollback( localPath, sync=False ):
+    """Switch back to the last complete version before the current one, removing
+    the versions after it, so that a later rollback goes further back. Returns
+    the path of the version now current."""
+    current = currentVersion( localPath )
+    if current is None:
+        raise RuntimeError("{} is not a staged installation".format(localPath))
+    versions = listVersions( localPath )
+    currentN = [n for n,path in versions if path == current]
+    previous = [path for n,path in versions if currentN and n < currentN[0] and isComplete( path )]
+    if not previous:
+        raise RuntimeError("{} has no previous version".format(localPath))
+    switchVersion( localPath, previous[-1], sync )
+    for n,path in versions:
+        if n > currentN[0] or path == current:
+            shutil.rmtree( path )
+    return previous[-1]
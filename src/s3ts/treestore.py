@@ -1,16 +1,63 @@
-import os, hashlib, zlib, tempfile, datetime, time, shutil
-import requests
+import os, hashlib, zlib, datetime, time, shutil, mmap, contextlib
             
-from s3ts.config import TreeStoreConfig, TreeStoreConfigJS, InstallProperties, writeInstallProperties, S3TS_PROPERTIES
-from s3ts import package, filewriter, utils, metapackage
+from s3ts.config import TreeStoreConfigJS, InstallProperties, writeInstallProperties, S3TS_PROPERTIES
+from s3ts.config import LocalCacheConfig, LocalCacheConfigJS, DownloadJournal, DownloadJournalJS
+from s3ts.config import InstalledFile, InstallManifest, writeInstallManifest, readInstallManifest, S3TS_MANIFEST
+from s3ts import package, filewriter, utils, metapackage, staging
+from s3ts.httpdownloader import HttpDownloader
+from s3ts.ratelimit import RateLimiter
 
 CONFIG_PATH = 'config'
 TREES_PATH = 'trees'
 META_TREES_PATH = 'meta'
 CHUNKS_PATH = 'chunks'
+VERIFIED_PATH = 'verified'
+JOURNALS_PATH = 'journals'
+PARTIAL_PATH = 'partial'
 RAW_PATH = 'raw'
 ZLIB_PATH = 'zlib'
 
+# Ways in which installed files are materialised
+INSTALL_COPY = 'copy'
+INSTALL_HARDLINK = 'hardlink'
+INSTALL_REFLINK = 'reflink'
+INSTALL_MODES = [INSTALL_COPY, INSTALL_HARDLINK, INSTALL_REFLINK]
+
+# How often content integrity is checked:
+#   VERIFY_ALWAYS - chunks are checked on download, and files on install
+#   VERIFY_ONCE   - as above, but chunks known to be good are marked as
+#                   verified in the local cache, and files made only of
+#                   verified chunks are not checked on install
+#   VERIFY_FILE   - only files are checked, on install
+VERIFY_ALWAYS = 'always'
+VERIFY_ONCE = 'once'
+VERIFY_FILE = 'file'
+VERIFY_LEVELS = [VERIFY_ALWAYS, VERIFY_ONCE, VERIFY_FILE]
+
+# The largest buffer used to hash runs of zeros
+ZERO_BUFFER_SIZE = 1024 * 1024
+
+# The largest piece of a chunk decoded at once
+DECODE_PIECE_SIZE = 1024 * 1024
+
+# The size of the pieces in which chunks are transferred
+STREAM_PIECE_SIZE = 1024 * 1024
+
+# The longest time between updates to a download journal
+JOURNAL_INTERVAL_SECS = 10
+
+# How install and sync use the disk and page cache:
+#   IO_PROFILE_DEFAULT   - files are written through the page cache as usual
+#   IO_PROFILE_STREAMING - files are preallocated and written with large
+#                          buffers, and what is written (and read from the
+#                          local cache) is dropped from the page cache
+IO_PROFILE_DEFAULT = 'default'
+IO_PROFILE_STREAMING = 'streaming'
+IO_PROFILES = [IO_PROFILE_DEFAULT, IO_PROFILE_STREAMING]
+
+# Directory within an installation where sync holds relocated files
+SYNC_STAGING_DIR = '.s3ts.staging'
+
 
 class TreeStore(object):
     """implements a directory tree store
@@ -44,8 +91,24 @@ class TreeStore(object):
         self.pkgStore = pkgStore
         self.localCache = localCache
         self.config = config
+        try:
+            self.cacheConfig = localCache.getFromJson( CONFIG_PATH, LocalCacheConfigJS() )
+        except KeyError:
+            self.cacheConfig = LocalCacheConfig( False )
         self.dryRun = False
         self.outVerbose = lambda *args : None
+        self.installMode = INSTALL_COPY
+        self.workers = 1
+        self.httpDownloader = None
+        self.rateLimiter = RateLimiter()
+        self.verifyLevel = VERIFY_ALWAYS
+        self.durability = filewriter.DURABILITY_NONE
+        self.ioProfile = IO_PROFILE_DEFAULT
+        self.seedDirs = []
+        self.findStrays = True
+        self.unsyncedVerified = []
+        self.zeroSha1s = {}
+
     def setDryRun( self, dryRun ):
         """Set the dryRun flag.
 
@@ -62,6 +125,91 @@ class TreeStore(object):
         """
         self.outVerbose = outVerbose
 
+    def setInstallMode( self, installMode ):
+        """Set how files are materialised on install.
+
+        With INSTALL_HARDLINK or INSTALL_REFLINK, single chunk files are
+        linked from a decoded copy kept in the local cache, rather than being
+        written out. Hard linked files share storage with the cache, and so
+        must be treated as read only.
+        """
+        if installMode not in INSTALL_MODES:
+            raise RuntimeError("unknown install mode {}".format(installMode))
+        self.installMode = installMode
+
+    def setWorkers( self, workers ):
+        """Set the number of files that install and sync write concurrently,
+        and the number of chunks that downloadHttp fetches concurrently."""
+        self.workers = max( 1, workers )
+
+    def setRateLimiter( self, rateLimiter ):
+        """Set the RateLimiter applied to requests to the package store, and by downloadHttp"""
+        self.rateLimiter = rateLimiter
+
+    def setHttpDownloader( self, httpDownloader ):
+        """Set the HttpDownloader used by downloadHttp"""
+        self.httpDownloader = httpDownloader
+
+    def setVerifyLevel( self, verifyLevel ):
+        """Set how often content integrity is checked (one of VERIFY_LEVELS)"""
+        if verifyLevel not in VERIFY_LEVELS:
+            raise RuntimeError("unknown verify level {}".format(verifyLevel))
+        self.verifyLevel = verifyLevel
+
+    def setDurability( self, durability ):
+        """Set how durably install and sync write files (one of filewriter.DURABILITY_MODES).
+
+        With DURABILITY_FILE each file is synced as it is written. With
+        DURABILITY_BATCH the files are synced together once written. Either
+        way, the files recording the installation are written and synced
+        last. The durability of the local cache is set on its FileStore.
+        """
+        if durability not in filewriter.DURABILITY_MODES:
+            raise RuntimeError("unknown durability {}".format(durability))
+        self.durability = durability
+
+    def setIoProfile( self, ioProfile ):
+        """Set how install and sync use the disk and page cache (one of IO_PROFILES).
+
+        IO_PROFILE_STREAMING suits hosts that are also serving traffic: the
+        installed files are less fragmented, and don't evict the page cache
+        of other processes, at the cost of flushing each file as it is written.
+        """
+        if ioProfile not in IO_PROFILES:
+            raise RuntimeError("unknown io profile {}".format(ioProfile))
+        self.ioProfile = ioProfile
+
+    def setSeedDirs( self, seedDirs ):
+        """Set installations on this host from which install and sync take
+        files, rather than writing them out from the local cache.
+
+        A seed file is used where its sha1 matches, according to the seed's
+        manifest, and its stat signature shows it unchanged since it was
+        installed. It is hard linked under INSTALL_HARDLINK, and otherwise
+        reflinked (or copied). Its content is checked, unless the verify
+        level is VERIFY_ONCE.
+        """
+        self.seedDirs = list( seedDirs )
+
+    def setFindStrays( self, findStrays ):
+        """Set whether sync walks the installation for stray files (those not
+        installed from its previous package) to remove.
+
+        Otherwise only the files of the previous package are considered,
+        which saves walking the whole tree for a small update.
+        """
+        self.findStrays = findStrays
+
+    def configureLocalCache( self, cacheConfig ):
+        """Change the configuration of the local cache.
+
+        With cacheConfig.decodeChunks set, chunks are held in the cache in decoded
+        (ie raw) form once verified, trading disk space for the CPU needed to
+        decompress them on every install. Chunks already cached are unchanged.
+        """
+        self.localCache.putToJson( CONFIG_PATH, cacheConfig, LocalCacheConfigJS() )
+        self.cacheConfig = cacheConfig
+
     def upload( self, treeName, description, creationTime, localPath, progressCB ):
         """Creates a package for the content of localPath.
 
@@ -167,6 +315,16 @@ class TreeStore(object):
         """confirms that all data for the given package is present in the store"""
         self.__verifyStore( self.pkgStore, pkg )
 
+    def unseeded( self, pkg ):
+        """Returns the package without the files that a seed installation can
+        supply (see setSeedDirs), which needn't be downloaded to install it.
+
+        Should a seed file change before it is installed, the install fails
+        rather than downloading it.
+        """
+        seeds = self.__seeds()
+        return package.Package( pkg.name, pkg.description, pkg.creationTime, [pf for pf in pkg.files if pf.sha1 not in seeds] )
+
     def verifyLocal( self, pkg ):
         """confirms that all data for the given package is present in the local cache"""
         self.__verifyStore( self.localCache, pkg )
@@ -176,21 +334,121 @@ class TreeStore(object):
 
         progressCB will be called with parameters (bytesDownloaded,bytesFromCache) as the download progresses
 
+        Progress is recorded in a journal in the local cache, so that a rerun of
+        an interrupted download needn't check the cache for the chunks already
+        downloaded, and resumes any partially transferred chunk.
         """
-        for pf in pkg.files:
-            for chunk in pf.chunks:
-                cpath = self.__chunkPath( self.pkgStore, chunk.sha1, chunk.encoding )
-                lpath = self.__chunkPath( self.localCache, chunk.sha1, chunk.encoding )
+        # The journal is locked while in use, so that it isn't flushed
+        with self.localCache.lock( self.__journalPath( pkg.name ), shared=True ):
+            self.__download( pkg, progressCB )
 
-                if self.localCache.exists( lpath ):
-                    progressCB( 0, chunk.size )
-                else:
-                    if not self.dryRun:
-                        self.outVerbose( "Fetching chunk {} to local cache", chunk.sha1 )
-                        buf = self.pkgStore.get( cpath )
-                        self.__checkSha1( self.__decompress( buf, chunk.encoding ), chunk.sha1, cpath )
-                        self.localCache.put( lpath, buf )
-                    progressCB( chunk.size, 0 )
+    def __download( self, pkg, progressCB ):
+        journal = self.__readJournal( pkg )
+        lastWrite = time.time()
+
+        def checkpoint():
+            nonlocal lastWrite
+            if time.time() - lastWrite >= JOURNAL_INTERVAL_SECS:
+                self.__writeJournal( journal )
+                lastWrite = time.time()
+
+        try:
+            for pf in pkg.files:
+                for chunk in pf.chunks:
+                    if chunk.encoding == package.ENCODING_ZERO:
+                        progressCB( 0, chunk.size )
+                        continue
+                    cpath = self.__chunkPath( self.pkgStore, chunk.sha1, chunk.encoding )
+
+                    if chunk.sha1 in journal.completed or self.__cachedChunk( chunk ):
+                        journal.completed.add( chunk.sha1 )
+                        progressCB( 0, chunk.size )
+                    elif self.dryRun:
+                        progressCB( chunk.size, 0 )
+                    else:
+                        with self.__chunkLock( chunk.sha1 ):
+                            # Another process may have fetched the chunk while we waited
+                            if self.__cachedChunk( chunk ):
+                                progressCB( 0, chunk.size )
+                            else:
+                                self.outVerbose( "Fetching chunk {} to local cache", chunk.sha1 )
+                                self.__fetchChunk( chunk, cpath, journal, checkpoint )
+                                progressCB( chunk.size, 0 )
+                        journal.completed.add( chunk.sha1 )
+                        checkpoint()
+        except BaseException:
+            if not self.dryRun:
+                self.__writeJournal( journal )
+            raise
+
+        # The download is complete, so the journal is no longer needed
+        if not self.dryRun:
+            self.__syncCache()
+            self.localCache.remove( self.__journalPath( pkg.name ) )
+
+    def __fetchChunk( self, chunk, cpath, journal, checkpoint ):
+        """Fetch a chunk from the package store into the local cache.
+
+        Where the local cache is on the local filesystem, the bytes received are
+        also kept in a partial file, and counted in the journal, so that an
+        interrupted transfer can be resumed with a ranged get.
+        """
+        partialPath = self.localCache.localPath( self.__partialPath( chunk ) )
+        self.rateLimiter.acquire( 1, 0 )
+        if partialPath is None:
+            with self.pkgStore.getStream( cpath ) as src:
+                pieces = iter( lambda: src.read( STREAM_PIECE_SIZE ), b'' )
+                self.__storeDownloaded( chunk, self.rateLimiter.limitPieces( pieces ), cpath )
+            return
+
+        os.makedirs( os.path.dirname( partialPath ), exist_ok=True )
+        with open( partialPath, 'a+b' ) as partial:
+            # Only trust bytes both recorded in the journal and present in the file
+            offset = min( journal.partial.get( chunk.sha1, 0 ), partial.seek( 0, os.SEEK_END ) )
+            partial.truncate( offset )
+
+            def pieces():
+                nonlocal offset
+                partial.seek( 0 )
+                for buf in iter( lambda: partial.read( STREAM_PIECE_SIZE ), b'' ):
+                    yield buf
+                with self.pkgStore.getStream( cpath, offset ) as src:
+                    for buf in self.rateLimiter.limitPieces( iter( lambda: src.read( STREAM_PIECE_SIZE ), b'' ) ):
+                        partial.write( buf )
+                        partial.flush()
+                        offset += len(buf)
+                        journal.partial[chunk.sha1] = offset
+                        checkpoint()
+                        yield buf
+
+            try:
+                self.__storeDownloaded( chunk, pieces(), cpath )
+            except (RuntimeError, zlib.error):
+                # The bytes received are corrupt, so don't resume from them
+                journal.partial.pop( chunk.sha1, None )
+                raise
+        try:
+            os.unlink( partialPath )
+        except FileNotFoundError:
+            pass
+        journal.partial.pop( chunk.sha1, None )
+
+    def __journalPath( self, packageName ):
+        return self.localCache.joinPath( JOURNALS_PATH, hashlib.sha1( packageName.encode('utf-8') ).hexdigest() )
+
+    def __partialPath( self, chunk ):
+        return self.localCache.joinPath( PARTIAL_PATH, chunk.encoding, chunk.sha1[:2], chunk.sha1[2:] )
+
+    def __readJournal( self, pkg ):
+        try:
+            return self.localCache.getFromJson( self.__journalPath( pkg.name ), DownloadJournalJS() )
+        except KeyError:
+            return DownloadJournal( pkg.name, set(), {} )
+
+    def __writeJournal( self, journal ):
+        # The journal mustn't record chunks that could yet be lost
+        self.__syncCache()
+        self.localCache.putToJson( self.__journalPath( journal.packageName ), journal, DownloadJournalJS() )
 
     def downloadHttp( self, pkg, progressCB ):
         """downloads all data not already present to the local cache, using http.
@@ -199,20 +457,74 @@ class TreeStore(object):
         progressCB will be called with parameters (bytesDownloaded,bytesFromCache) as the download progresses
 
         """
+        if self.httpDownloader is None:
+            # A downloader of our own is closed when we are done with it
+            with HttpDownloader( self.workers, rateLimiter=self.rateLimiter ) as httpDownloader:
+                self.__downloadHttp( pkg, progressCB, httpDownloader )
+        else:
+            self.__downloadHttp( pkg, progressCB, self.httpDownloader )
+
+    def __downloadHttp( self, pkg, progressCB, httpDownloader ):
+        progressCB = utils.LockedCallback( progressCB )
+
+        toFetch = {}
         for pf in pkg.files:
             for chunk in pf.chunks:
-                lpath = self.__chunkPath( self.localCache, chunk.sha1, chunk.encoding )
-
-                if self.localCache.exists( lpath ):
+                if chunk.encoding == package.ENCODING_ZERO:
+                    progressCB( 0, chunk.size )
+                elif (chunk.sha1, chunk.encoding) in toFetch or self.__cachedChunk( chunk ):
                     progressCB( 0, chunk.size )
                 else:
-                    resp = requests.get( chunk.url )
-                    resp.raise_for_status()
-                    buf = resp.content
-                    self.__checkSha1( self.__decompress( buf, chunk.encoding ), chunk.sha1, lpath )
-                    self.localCache.put( lpath, buf )
-                    progressCB( chunk.size, 0 )
+                    toFetch[(chunk.sha1, chunk.encoding)] = chunk
+
+        def fetch( chunk ):
+            lpath = self.__chunkPath( self.localCache, chunk.sha1, chunk.encoding )
+            with self.__chunkLock( chunk.sha1 ):
+                # Another process may have fetched the chunk while we waited
+                if self.__cachedChunk( chunk ):
+                    progressCB( 0, chunk.size )
+                    return
+                with contextlib.closing( httpDownloader.iterContent( chunk.url ) ) as pieces:
+                    self.__storeDownloaded( chunk, pieces, lpath )
+            progressCB( chunk.size, 0 )
+
+        try:
+            utils.parallelMap( fetch, list( toFetch.values() ), self.workers )
+        finally:
+            self.__syncCache()
+
+    def __storeDownloaded( self, chunk, pieces, cpath ):
+        """Stream a downloaded chunk into the local cache, checking it as required.
 
+        The chunk arrives as an iterable of pieces, which are decoded and hashed
+        incrementally, so memory use doesn't depend on the chunk size.
+        """
+        decode = self.cacheConfig.decodeChunks
+        check = self.verifyLevel != VERIFY_FILE
+        lpath = self.__chunkPath( self.localCache, chunk.sha1, package.ENCODING_RAW if decode else chunk.encoding )
+        decompressor = self.__decompressor( chunk.encoding )
+        csha1 = hashlib.sha1()
+        with self.localCache.putStream( lpath ) as f:
+            for buf in pieces:
+                if decode or check:
+                    for piece in self.__decodePiece( decompressor, buf ):
+                        csha1.update( piece )
+                        if decode:
+                            f.write( piece )
+                if not decode:
+                    f.write( buf )
+            if check and csha1.hexdigest() != chunk.sha1:
+                raise RuntimeError("sha1 for {0} doesn't match".format( cpath ))
+        if self.verifyLevel == VERIFY_ONCE:
+            # Marked once the chunk is known to be durable
+            self.unsyncedVerified.append( chunk )
+
+    def __syncCache( self ):
+        """Sync the chunks downloaded to the local cache, and then mark
+        those that were checked as verified"""
+        self.localCache.sync()
+        verified, self.unsyncedVerified = self.unsyncedVerified, []
+        self.__markVerified( verified )
 
     def sync( self, pkg, localPath, progressCB ):
         """synchronise the content of localpath with the given package,
@@ -225,6 +537,13 @@ class TreeStore(object):
         except IOError:
             existingPkg = None
 
+        relocated = []
+        existingFiles = {}
+        manifestFiles = {}
+        unchangedFiles = {}
+        changedPaths = None
+        emptyDirs = []
+        batch = self.__syncBatch()
         if not existingPkg:
             # Start from scratch
             syncPkg,pathsToRemove = pkg,[]
@@ -235,68 +554,476 @@ class TreeStore(object):
             # Synchronise the existing content. To ensure the
             # drectory is clean, we remove every exising file that
             # is not present in the new pkg
-            syncPkg,_ = package.packageDiff( existingPkg, pkg )
-            localPaths = set( utils.allFilePaths(localPath) )
+            syncPkg,removedPaths = package.packageDiff( existingPkg, pkg )
+
+            # The recorded signatures of files that won't be touched remain valid
+            changedPaths = set( [f.path for f in syncPkg.files] )
+            try:
+                manifestFiles = dict( [(f.path,f) for f in readInstallManifest(localPath).files] )
+            except IOError:
+                pass
+            unchangedFiles = dict( [(path,f) for path,f in manifestFiles.items() if path not in changedPaths] )
 
             # normpath is required here to turn a package path (delimited by '/')
             # into a local filesystem path (delimited by '\' on windows)
-            targetPaths = set( [os.path.normpath(f.path) for f in pkg.files] )
-            pathsToRemove = localPaths.difference(targetPaths)
-            pathsToRemove.discard(package.S3TS_PACKAGEFILE)
+            if self.findStrays:
+                targetPaths = set( [os.path.normpath(f.path) for f in pkg.files] )
+                localPaths,emptyDirs = utils.scanTree(localPath)
+                pathsToRemove = set(localPaths).difference(targetPaths)
+                pathsToRemove.discard(package.S3TS_PACKAGEFILE)
+                pathsToRemove.discard(S3TS_MANIFEST)
+            else:
+                pathsToRemove = set( [os.path.normpath(path) for path in removedPaths] )
+                pathsToRemove = set( [path for path in pathsToRemove if os.path.lexists( os.path.join( localPath, path ) )] )
+            # Directories that may be left empty by the removals
+            prunePaths = set(pathsToRemove).union(emptyDirs)
             
             # Remove the existing package from disk, so that if anything
             # fails during the sync, we start from scratch next time
             os.unlink( os.path.join( localPath, package.S3TS_PACKAGEFILE ) )
+            if os.path.exists( os.path.join( localPath, S3TS_MANIFEST ) ):
+                os.unlink( os.path.join( localPath, S3TS_MANIFEST ) )
+            if batch is not None:
+                filewriter.fsyncPath( localPath )
+
+            # Files whose content is already installed at another path are
+            # moved aside before any removals, rather than rebuilt from the cache
+            relocated = self.__stageRelocations( existingPkg, syncPkg, localPath, pathsToRemove, manifestFiles )
+            relocatedPaths = set( [path for stagedPath,path in relocated] )
+            syncPkg = package.Package( syncPkg.name, syncPkg.description, syncPkg.creationTime,
+                                       [f for f in syncPkg.files if f.path not in relocatedPaths] )
+
+            # Modified files may be patched in place, given their previous content
+            existingFiles = dict( [(f.path,f) for f in existingPkg.files] )
 
         installTime = datetime.datetime.now()
-        # Remove existing files first, and any empty directories
-        # to ensure that if we replace a directory with a file,
+        # Remove existing files first, and any directories they leave
+        # empty, to ensure that if we replace a directory with a file,
         # it's gone by the time we install it
         for path in pathsToRemove:
             path = os.path.join( localPath, path )
             self.outVerbose( "removing {}", path )
             os.unlink( path )
-        utils.removeEmptyDirectories(localPath, removeRoot=False)
-        self.__install( syncPkg, localPath, progressCB )
+        for dir in emptyDirs:
+            try:
+                os.rmdir( os.path.join( localPath, dir ) )
+            except FileNotFoundError:
+                # An empty staging directory will have been removed already
+                pass
+        if existingPkg:
+            utils.removeEmptyParents( localPath, prunePaths )
+            self.__clearObstructions( localPath, [f.path for f in syncPkg.files] + [path for stagedPath,path in relocated] )
+        for stagedPath,path in relocated:
+            targetPath = os.path.join( localPath, os.path.normpath(path) )
+            if not os.path.exists( os.path.dirname(targetPath) ):
+                os.makedirs( os.path.dirname(targetPath) )
+            os.replace( stagedPath, targetPath )
+            self.__written( batch, targetPath, False )
+        if relocated:
+            os.rmdir( os.path.join( localPath, SYNC_STAGING_DIR ) )
+        self.__install( syncPkg, localPath, progressCB, existingFiles, batch )
+        self.__syncWritten( batch, localPath, [] )
+        self.__writeManifest( pkg, localPath, unchangedFiles, changedPaths )
         package.writeInstallPackage( localPath, pkg )
         writeInstallProperties( localPath, InstallProperties( pkg.name, installTime ) )
+        self.__syncWritten( batch, localPath, [S3TS_MANIFEST, package.S3TS_PACKAGEFILE, S3TS_PROPERTIES] )
             
+    def __stageRelocations( self, existingPkg, syncPkg, localPath, pathsToRemove, manifestFiles ):
+        """Move or copy installed files that are needed at new paths into the staging directory.
+
+        Only files whose content is unchanged since they were installed are
+        relocated, according to their entries in manifestFiles, or else their
+        sha1. A file that is to be removed is renamed (after any copies of it
+        have been made), and no longer needs removal. Returns a list of
+        (stagedPath, packagePath) pairs.
+        """
+        filesByPath = dict( [(f.path,f) for f in syncPkg.files] )
+        targetsBySource = {}
+        for path,sourcePath in package.packageRelocations( existingPkg, syncPkg ).items():
+            targetsBySource.setdefault( sourcePath, [] ).append( path )
+
+        # Clear out anything left by an earlier failed sync
+        stagingDir = os.path.join( localPath, SYNC_STAGING_DIR )
+        if os.path.exists( stagingDir ):
+            shutil.rmtree( stagingDir )
+        for path in [path for path in pathsToRemove if path.startswith( SYNC_STAGING_DIR + os.sep )]:
+            pathsToRemove.discard( path )
+
+        relocated = []
+        for sourcePath,paths in sorted(targetsBySource.items()):
+            paths = sorted(paths)
+            installedFile = manifestFiles.get( sourcePath )
+            sourcePath = os.path.normpath(sourcePath)
+            srcPath = os.path.join( localPath, sourcePath )
+            if not self.__isUnmodified( srcPath, filesByPath[paths[0]], installedFile ):
+                continue
+            for path in paths:
+                if not relocated:
+                    os.makedirs( stagingDir )
+                stagedPath = os.path.join( stagingDir, str(len(relocated)) )
+                if path == paths[-1] and sourcePath in pathsToRemove:
+                    self.outVerbose( "moving {} to {}", sourcePath, path )
+                    os.rename( srcPath, stagedPath )
+                    pathsToRemove.discard( sourcePath )
+                else:
+                    self.outVerbose( "copying {} to {}", sourcePath, path )
+                    shutil.copyfile( srcPath, stagedPath )
+                relocated.append( (stagedPath,path) )
+        return relocated
+
+    def __clearObstructions( self, localPath, paths ):
+        """Remove anything in the way of installing files at paths (relative to
+        localPath): a file where one of their directories goes, or a directory
+        where one of them goes. Unless strays are found, these can be left
+        behind by the removals, holding files that aren't in either package."""
+        dirs = set()
+        for path in paths:
+            dir = os.path.dirname( os.path.normpath(path) )
+            while dir and dir not in dirs:
+                dirs.add( dir )
+                dir = os.path.dirname( dir )
+        # Shallowest first, as nothing below a file removed needs checking
+        for dir in sorted( dirs, key=lambda dir: dir.count(os.sep) ):
+            dirPath = os.path.join( localPath, dir )
+            if os.path.lexists( dirPath ) and not os.path.isdir( dirPath ):
+                self.outVerbose( "removing {}", dirPath )
+                os.unlink( dirPath )
+        for path in paths:
+            targetPath = os.path.join( localPath, os.path.normpath(path) )
+            if os.path.isdir( targetPath ) and not os.path.islink( targetPath ):
+                self.outVerbose( "removing directory {}", targetPath )
+                shutil.rmtree( targetPath )
+
+    def __isUnmodified( self, path, pf, installedFile ):
+        """Returns True if the file at path has the content of pf, trusting the
+        manifest entry installedFile if its stat signature still matches"""
+        if not os.path.isfile( path ):
+            return False
+        st = os.stat( path )
+        if st.st_size != pf.size():
+            return False
+        if installedFile is not None and installedFile.sha1 == pf.sha1 and installedFile.matchesStat( st ):
+            return True
+        return self.__fileSha1( path ) == pf.sha1
+
     def install( self, pkg, localPath, progressCB ):
         """installs the given package into the local path
 
         progressCB will be called with parameters (nBytes) as the installation progresses,
         """
         installTime = datetime.datetime.now()
-        self.__install( pkg, localPath, progressCB )
+        batch = self.__syncBatch()
+        self.__install( pkg, localPath, progressCB, {}, batch )
+        self.__syncWritten( batch, localPath, [] )
+        self.__writeManifest( pkg, localPath )
         writeInstallProperties( localPath, InstallProperties( pkg.name, installTime ) )
+        self.__syncWritten( batch, localPath, [S3TS_MANIFEST, S3TS_PROPERTIES] )
 
-    def __install( self, pkg, localPath, progressCB ):
+    def installStaged( self, pkg, localPath, progressCB, keep=2 ):
+        """installs the given package as a new version of the staged installation
+        at localPath (see s3ts.staging), keeping keep previous versions.
 
-        for pf in pkg.files:
-            targetPath = os.path.join( localPath, pf.path )
-            targetDir = os.path.dirname(targetPath)
+        Files unchanged since they were installed in the current version are hard
+        linked from it, so they must be treated as read only. The new version is
+        only switched to once it is complete. Returns the path of the new version.
 
+        progressCB will be called with parameters (nBytes) as the installation progresses,
+        """
+        current = staging.currentVersion( localPath )
+        versionPath = staging.newVersion( localPath )
+        try:
+            installTime = datetime.datetime.now()
+            batch = self.__syncBatch()
+            reusable = self.__reusableFiles( current ) if current else {}
+            toInstall = []
+            for pf in pkg.files:
+                srcPath = reusable.get( pf.sha1 )
+                if srcPath is None:
+                    toInstall.append( pf )
+                    continue
+                targetPath = os.path.join( versionPath, os.path.normpath(pf.path) )
+                os.makedirs( os.path.dirname( targetPath ), exist_ok=True )
+                self.outVerbose( "Linking {} from {}", targetPath, srcPath )
+                filewriter.hardlinkFile( srcPath, targetPath )
+                self.__written( batch, targetPath, False )
+                progressCB( pf.size() )
+            self.__install( package.Package( pkg.name, pkg.description, pkg.creationTime, toInstall ), versionPath, progressCB, {}, batch )
+            self.__syncWritten( batch, versionPath, [] )
+            self.__writeManifest( pkg, versionPath )
+            writeInstallProperties( versionPath, InstallProperties( pkg.name, installTime ) )
+            # Written last, as it marks the version as complete
+            package.writeInstallPackage( versionPath, pkg )
+            self.__syncWritten( batch, versionPath, [S3TS_MANIFEST, S3TS_PROPERTIES, package.S3TS_PACKAGEFILE] )
+        except BaseException:
+            shutil.rmtree( versionPath, ignore_errors=True )
+            raise
+        staging.switchVersion( localPath, versionPath, self.durability != filewriter.DURABILITY_NONE )
+        staging.pruneVersions( localPath, keep )
+        return versionPath
+
+    def __seeds( self ):
+        """Returns {sha1: path} for the files the seed installations can supply"""
+        seeds = {}
+        for seedDir in self.seedDirs:
+            for sha1,path in self.__reusableFiles( seedDir ).items():
+                seeds.setdefault( sha1, path )
+        return seeds
+
+    def __reusableFiles( self, installPath ):
+        """Returns {sha1: path} for the files of an installation that are
+        unchanged since they were installed, according to its manifest"""
+        try:
+            manifest = readInstallManifest( installPath )
+        except IOError:
+            return {}
+        reusable = {}
+        for installedFile in manifest.files:
+            path = os.path.join( installPath, os.path.normpath(installedFile.path) )
+            try:
+                if installedFile.matchesStat( os.stat( path ) ):
+                    reusable.setdefault( installedFile.sha1, path )
+            except FileNotFoundError:
+                pass
+        return reusable
+
+    def __syncBatch( self ):
+        """A SyncBatch for the files written by an install, or None if they needn't be synced"""
+        if self.durability == filewriter.DURABILITY_NONE:
+            return None
+        # Under DURABILITY_FILE the batch only holds directories, for which fsyncs are cheaper than a syncfs
+        return filewriter.SyncBatch( useSyncfs=self.durability == filewriter.DURABILITY_BATCH )
+
+    def __written( self, batch, path, synced ):
+        """Record a file written by an install, for syncing. synced is True
+        if its content has been synced as required by DURABILITY_FILE"""
+        if batch is None:
+            return
+        if self.durability == filewriter.DURABILITY_FILE:
+            if not synced:
+                filewriter.fsyncPath( path )
+            batch.addDirectory( os.path.dirname( path ) )
+        else:
+            batch.add( path )
+
+    def __syncWritten( self, batch, localPath, names ):
+        """Sync the files written by an install so far, including those named in localPath"""
+        if batch is None:
+            return
+        for name in names:
+            self.__written( batch, os.path.join( localPath, name ), False )
+        batch.sync()
+
+    def __writeManifest( self, pkg, localPath, unchangedFiles={}, writtenPaths=None ):
+        """Record the stat signature of each installed file.
+
+        If writtenPaths is given, only those files were written, and the
+        others keep their entries from unchangedFiles. Those without one are
+        left out, as their content has never been checked.
+        """
+        files = []
+        for pf in pkg.files:
+            if writtenPaths is None or pf.path in writtenPaths:
+                st = os.stat( os.path.join( localPath, os.path.normpath(pf.path) ) )
+                installedFile = InstalledFile.fromStat( pf.path, pf.sha1, st )
+            else:
+                installedFile = unchangedFiles.get( pf.path )
+                if installedFile is None or installedFile.sha1 != pf.sha1:
+                    continue
+            files.append( installedFile )
+        writeInstallManifest( localPath, InstallManifest( files ) )
+
+    def __install( self, pkg, localPath, progressCB, existingFiles={}, batch=None ):
+        # Create all of the directories up front, so the
+        # workers only need to write files
+        targetDirs = set( [os.path.dirname( os.path.join( localPath, pf.path ) ) for pf in pkg.files] )
+        for targetDir in sorted(targetDirs):
             if not os.path.exists( targetDir ):
                 os.makedirs( targetDir )
-
-            filesha1 = hashlib.sha1()
-            # We can update the file in place, because we never install
-            # to a directory tree that is in use.
-            with filewriter.InPlaceFileWriter(targetPath) as f:
-                for chunk in pf.chunks:
-                    cpath = self.__chunkPath( self.localCache, chunk.sha1, chunk.encoding )
-                    buf = self.localCache.get( cpath )
-                    buf = self.__decompress( buf, chunk.encoding )
+                if batch is not None:
+                    # The entries of new directories are synced with the rest
+                    batch.add( targetDir )
+
+        seeds = self.__seeds()
+        progressCB = utils.LockedCallback( progressCB )
+        utils.parallelMap( lambda pf: self.__installFile( pf, localPath, progressCB, existingFiles.get(pf.path), batch, seeds.get(pf.sha1) ), pkg.files, self.workers )
+
+    def __installFile( self, pf, localPath, progressCB, existingFile, batch, seedPath ):
+        targetPath = os.path.join( localPath, pf.path )
+
+        if existingFile and self.__patchFile( existingFile, pf, targetPath ):
+            self.__written( batch, targetPath, False )
+            progressCB( pf.size() )
+            self.outVerbose( "Patched {}", targetPath )
+            return
+
+        # Never write through an existing file, as it may be
+        # a link to content in the local cache
+        if os.path.isfile( targetPath ):
+            os.unlink( targetPath )
+
+        if seedPath is not None and self.__seedFile( pf, seedPath, targetPath ):
+            self.__written( batch, targetPath, False )
+            progressCB( pf.size() )
+            self.outVerbose( "Seeded {} from {}", targetPath, seedPath )
+            return
+
+        if self.installMode != INSTALL_COPY and self.__linkFile( pf, targetPath ):
+            self.__written( batch, targetPath, False )
+            progressCB( pf.size() )
+            self.outVerbose( "Linked {}", targetPath )
+            return
+
+        # Files made only of chunks already verified don't need checking again
+        verifyFile = self.verifyLevel != VERIFY_ONCE or not self.__isVerified( pf.chunks )
+        filesha1 = hashlib.sha1() if verifyFile else utils.NullHash()
+        # We can update the file in place, because we never install
+        # to a directory tree that is in use.
+        sync = self.durability == filewriter.DURABILITY_FILE
+        streaming = self.ioProfile == IO_PROFILE_STREAMING
+        if streaming:
+            # Preallocating would fill in the holes left for zero chunks
+            hasHoles = any( chunk.encoding == package.ENCODING_ZERO for chunk in pf.chunks )
+            writer = filewriter.StreamingFileWriter( targetPath, None if hasHoles else pf.size(), sync )
+        else:
+            writer = filewriter.InPlaceFileWriter( targetPath, sync )
+        with writer as f:
+            for chunk in pf.chunks:
+                if streaming:
+                    writer.dropWritten()
+                if chunk.encoding == package.ENCODING_ZERO:
+                    # Leave a hole, rather than writing the zeros out
+                    self.__updateZeroSha1( filesha1, chunk.size )
+                    f.seek( chunk.size, os.SEEK_CUR )
+                    progressCB( chunk.size )
+                    continue
+                with self.__chunkLock( chunk.sha1, shared=True ):
+                    cpath,encoding = self.__cachedChunk( chunk ) or (None,None)
+                    srcPath = None
+                    if encoding == package.ENCODING_RAW:
+                        srcPath = self.localCache.localPath( cpath )
+                    if srcPath is not None:
+                        # Raw chunks are copied straight from the cache file
+                        progressCB( filewriter.appendFromFile( srcPath, f, filesha1, streaming ) )
+                        continue
+                for buf in self.__readChunkPieces( chunk ):
                     filesha1.update( buf )
                     f.write( buf )
                     progressCB( len(buf) )
+            # Set the size, in case the file ends with a hole
+            f.truncate( pf.size() )
 
+        if verifyFile:
             if filesha1.hexdigest() != pf.sha1:
                 raise RuntimeError("sha1 for {0} doesn't match".format(pf.path))
+            if self.verifyLevel == VERIFY_ONCE:
+                self.__markVerified( pf.chunks )
 
-            self.outVerbose( "Wrote {}", targetPath )
+        self.__written( batch, targetPath, True )
+        self.outVerbose( "Wrote {}", targetPath )
 
-    def compareInstall( self, pkg, localPath ):
+    def __patchFile( self, existingFile, pf, targetPath ):
+        """Update an installed file by rewriting only the chunks that have changed.
+
+        A chunk is kept where the existing file has the same content at the same
+        offset. The patched file's sha1 is checked. Returns False if the file must
+        be written out in full instead. Progress is left to the caller, so that
+        it isn't counted twice when the file is written out after all.
+        """
+        # Files linked from the cache (or elsewhere) must not be modified
+        if not os.path.isfile( targetPath ) or os.stat( targetPath ).st_nlink != 1:
+            return False
+        if os.path.getsize( targetPath ) != existingFile.size():
+            return False
+
+        existingChunks = {}
+        offset = 0
+        for chunk in existingFile.chunks:
+            existingChunks[offset] = chunk.sha1
+            offset += chunk.size
+
+        changedChunks = []
+        offset = 0
+        for chunk in pf.chunks:
+            if existingChunks.get(offset) != chunk.sha1:
+                changedChunks.append( (offset,chunk) )
+            offset += chunk.size
+        if len(changedChunks) == len(pf.chunks):
+            return False
+
+        with open( targetPath, 'r+b' ) as f:
+            for offset,chunk in changedChunks:
+                f.seek( offset )
+                for buf in self.__readChunkPieces( chunk ):
+                    f.write( buf )
+            f.truncate( pf.size() )
+
+        return self.__fileSha1( targetPath ) == pf.sha1
+
+    def __fileSha1( self, path ):
+        filesha1 = hashlib.sha1()
+        with open( path, 'rb' ) as f:
+            if os.fstat( f.fileno() ).st_size > 0:
+                m = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+                try:
+                    filesha1.update( m )
+                finally:
+                    m.close()
+        return filesha1.hexdigest()
+
+    def __seedFile( self, pf, seedPath, targetPath ):
+        """Materialise a file from a seed installation (see setSeedDirs).
+        Returns False if the file must be written out instead."""
+        try:
+            if self.installMode == INSTALL_HARDLINK:
+                filewriter.hardlinkFile( seedPath, targetPath )
+            else:
+                filewriter.reflinkFile( seedPath, targetPath )
+        except OSError:
+            # The seed has changed since its manifest was read
+            if os.path.isfile( targetPath ):
+                os.unlink( targetPath )
+            return False
+        if self.verifyLevel != VERIFY_ONCE and self.__fileSha1( targetPath ) != pf.sha1:
+            os.unlink( targetPath )
+            return False
+        return True
+
+    def __linkFile( self, pf, targetPath ):
+        """Materialise a file by linking it from the local cache.
+
+        Only single chunk files can be linked: the decoded chunk is the
+        whole file. The linked file is checked as a written one would be,
+        and removed if its sha1 doesn't match. Returns False if the file
+        must be written out instead.
+        """
+        if len(pf.chunks) != 1 or pf.chunks[0].encoding == package.ENCODING_ZERO:
+            return False
+        chunk = pf.chunks[0]
+        rpath = self.__chunkPath( self.localCache, chunk.sha1, package.ENCODING_RAW )
+        if self.localCache.localPath( rpath ) is None:
+            return False
+        with self.__chunkLock( chunk.sha1, shared=True ):
+            if not self.localCache.exists( rpath ):
+                # Keep a decoded copy of the file in the cache, so that this and
+                # subsequent installs can link to it
+                with self.localCache.putStream( rpath ) as f:
+                    for buf in self.__readChunkPieces( chunk ):
+                        f.write( buf )
+            # Only known once written: the store may place it by size
+            srcPath = self.localCache.localPath( rpath )
+            if self.installMode == INSTALL_HARDLINK:
+                filewriter.hardlinkFile( srcPath, targetPath )
+            else:
+                filewriter.reflinkFile( srcPath, targetPath )
+        if self.verifyLevel != VERIFY_ONCE or not self.__isVerified( pf.chunks ):
+            if self.__fileSha1( targetPath ) != pf.sha1:
+                os.unlink( targetPath )
+                raise RuntimeError("sha1 for {0} doesn't match".format(pf.path))
+            if self.verifyLevel == VERIFY_ONCE:
+                self.__markVerified( pf.chunks )
+        return True
+
+    def compareInstall( self, pkg, localPath, full=True ):
         """
         Compares the package against the files installed in the given directory.
         Returns an object with 3 fields:
@@ -304,6 +1031,9 @@ class TreeStore(object):
                result.missing - paths of files present in the package but missing on disk
                result.extra   - paths of files present on disk, but missing in the package
                result.diffs   - paths with different content
+
+        If full is False, files whose size, mtime and inode are unchanged since
+        they were installed are assumed to be correct, and are not read.
         """
         
         # 1) check that the list of files installed matches the list in the package
@@ -314,6 +1044,7 @@ class TreeStore(object):
         installedFiles = set(installedFiles)
         installedFiles.discard( S3TS_PROPERTIES )
         installedFiles.discard( package.S3TS_PACKAGEFILE )
+        installedFiles.discard( S3TS_MANIFEST )
 
         packageFiles = [os.path.normpath(f.path) for f in pkg.files]
         packageFiles = set(packageFiles)
@@ -325,43 +1056,73 @@ class TreeStore(object):
         result.extra = installedFiles.difference(packageFiles)
         result.diffs = set()
 
-        # 2) verify the contents of each file
-        for pf in pkg.files:
+        # 2) verify the contents of each file, in parallel
+        manifestFiles = {}
+        if not full:
+            try:
+                manifestFiles = dict( [(f.path,f) for f in readInstallManifest(localPath).files] )
+            except IOError:
+                pass
+
+        def compareFile( pf ):
             ppath = os.path.normpath(pf.path)
-            if ppath in installedFiles:
-                path = os.path.join(localPath, ppath)
-                filesha1 = hashlib.sha1()
-                i = 0
-                with open( path, 'rb' ) as f:
-                    for chunk in pf.chunks:
-                        buf = f.read( self.config.chunkSize )
-                        chunksha1 = hashlib.sha1()
-                        chunksha1.update(buf)
-                        filesha1.update(buf)
-                        if chunksha1.hexdigest() != chunk.sha1:
-                            result.diffs.add( ppath )
-                        i += len(buf)
-                if filesha1.hexdigest() != pf.sha1:
-                    result.diffs.add( ppath )
+            path = os.path.join(localPath, ppath)
+            installedFile = manifestFiles.get( pf.path )
+            if installedFile and installedFile.sha1 == pf.sha1 and installedFile.matchesStat( os.stat(path) ):
+                return None
+            if not self.__compareFile( pf, path ):
+                return ppath
+        toCompare = [pf for pf in pkg.files if os.path.normpath(pf.path) in installedFiles]
+        result.diffs = set( [ppath for ppath in utils.parallelMap( compareFile, toCompare, self.workers ) if ppath] )
 
         return result
 
+    def __compareFile( self, pf, path ):
+        """Returns True if the file at path has the content of pf.
+
+        Each chunk is checked against its recorded size and sha1, stopping at
+        the first mismatch. Together the chunks cover the whole file, so matching
+        chunks imply a matching file sha1.
+        """
+        with open( path, 'rb' ) as f:
+            size = os.fstat( f.fileno() ).st_size
+            if size != pf.size():
+                return False
+            if size == 0:
+                return hashlib.sha1().hexdigest() == pf.sha1
+            m = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+            try:
+                with memoryview(m) as mv:
+                    offset = 0
+                    for chunk in pf.chunks:
+                        # Holes need not be read to know they are zero
+                        if not (chunk.encoding == package.ENCODING_ZERO and utils.isHole( f.fileno(), offset, chunk.size )):
+                            if hashlib.sha1( mv[offset:offset+chunk.size] ).hexdigest() != chunk.sha1:
+                                return False
+                        offset += chunk.size
+            finally:
+                m.close()
+        return True
+
     def addUrls( self, pkg, expiresInSecs ):
         """Update the given package so that it can be accessed directly via pre-signed http urls"""
         for pf in pkg.files:
             for chunk in pf.chunks:
+                if chunk.encoding == package.ENCODING_ZERO:
+                    continue
                 cpath = self.__chunkPath( self.pkgStore, chunk.sha1, chunk.encoding )
                 chunk.url = self.pkgStore.url( cpath, expiresInSecs )
 
     def prime( self, localPath, progressCB ):
         """Walk a local directory tree and ensure that all chunks of all files are present in the local cache"""
         self.__storeFiles( self.localCache, localPath, progressCB )
+        self.localCache.sync()
 
     def validateLocalCache(self):
         return self.__validateStore( self.localCache )
 
     def validateStore(self):
-        return self.__validateStore( self.store )
+        return self.__validateStore( self.pkgStore )
 
     def flushLocalCache(self, packageNames ):
         """
@@ -383,27 +1144,32 @@ class TreeStore(object):
         return self.__flushStore( self.pkgStore, packages )
 
     def __validateStore( self, fileStore ):
-        """Walk a fileStore and ensure that all chunks are valid sha1 """
-        fileList = fileStore.list("")
-        corruptedFiles = []
-        for fileName in fileList:
-            token = fileName.rsplit('/', 2)
-            sha1 = token[1] + token[2]
-            encoding = package.ENCODING_RAW
-            if "zlib" in fileName:
-                encoding = package.ENCODING_ZLIB
+        """Walk a fileStore and ensure that all chunks are valid sha1
 
-            buf = fileStore.get(fileName)
+        This always rehashes every chunk, and removes the verified
+        marker of any corrupted chunk in the local cache.
+        """
+        corruptedFiles = []
+        for path in fileStore.list( CHUNKS_PATH ):
+            encoding,s1,s2 = fileStore.splitPath(path)
+            fileName = self.__chunkPath( fileStore, s1+s2, encoding )
             try:
-                self.__checkSha1(self.__decompress(buf, encoding), sha1, fileName)
+                with fileStore.getBuffer(fileName) as buf:
+                    self.__checkDecodedSha1(buf, encoding, s1+s2, fileName)
             except:
                 corruptedFiles.append({fileName, fileStore.getMetadata(fileName)})
+                if fileStore is self.localCache:
+                    fileStore.remove( self.__verifiedPath( s1+s2 ) )
         return corruptedFiles
 
     def __verifyStore( self, fileStore, pkg ):
         """Walk a fileStore and ensure that all chunks for the given package are present"""
         for pf in pkg.files:
             for chunk in pf.chunks:
+                if chunk.encoding == package.ENCODING_ZERO:
+                    continue
+                if fileStore is self.localCache and self.__cachedChunk( chunk ):
+                    continue
                 cpath = self.__chunkPath( fileStore, chunk.sha1, chunk.encoding )
                 if not fileStore.exists( cpath ):
                     raise RuntimeError("{0} not found".format(cpath))
@@ -417,6 +1183,9 @@ class TreeStore(object):
             for pf in pkg.files:
                 for chunk in pf.chunks:
                     keysToKeep.add( (chunk.encoding,chunk.sha1) )
+                    if fileStore is self.localCache:
+                        # The local cache may hold chunks decoded
+                        keysToKeep.add( (package.ENCODING_RAW,chunk.sha1) )
 
         # Generate the set of all keys currently in the store
         allKeys = set()
@@ -432,8 +1201,34 @@ class TreeStore(object):
 
         # remove them
         if not self.dryRun:
-            for encoding,sha1 in keysToRemove:
-                fileStore.remove( self.__chunkPath(fileStore, sha1, encoding) )
+            for encoding,sha1 in sorted( keysToRemove ):
+                if fileStore is not self.localCache:
+                    fileStore.remove( self.__chunkPath(fileStore, sha1, encoding) )
+                    continue
+                # Leave chunks being read or fetched by other processes
+                with self.__chunkLock( sha1, blocking=False ) as locked:
+                    if not locked:
+                        self.outVerbose( "Chunk {} is in use, not removing it", sha1 )
+                        keysToRemove.discard( (encoding,sha1) )
+                        continue
+                    fileStore.remove( self.__chunkPath(fileStore, sha1, encoding) )
+                    fileStore.remove( self.__verifiedPath(sha1) )
+                    fileStore.removeLock( self.__chunkLockPath( sha1 ) )
+
+            # Download journals may record removed chunks as present. Those of
+            # downloads in progress are left, as are the partial transfers of
+            # chunks being fetched.
+            if fileStore is self.localCache:
+                for path in fileStore.list( JOURNALS_PATH ):
+                    path = fileStore.joinPath( JOURNALS_PATH, path )
+                    with fileStore.lock( path, blocking=False ) as locked:
+                        if locked:
+                            fileStore.remove( path )
+                for path in fileStore.list( PARTIAL_PATH ):
+                    encoding, prefix, rest = fileStore.splitPath( path )
+                    with self.__chunkLock( prefix + rest, blocking=False ) as locked:
+                        if locked:
+                            fileStore.remove( fileStore.joinPath( PARTIAL_PATH, path ) )
         return keysToRemove
             
     def __storeFiles( self, store, localPath, progressCB ):
@@ -443,7 +1238,7 @@ class TreeStore(object):
         for root, dirs, files in os.walk(localPath):
             for file in files:
                 rpath = os.path.relpath( os.path.join(root, file), localPath )
-                if rpath == S3TS_PROPERTIES:
+                if rpath == S3TS_PROPERTIES or rpath == S3TS_MANIFEST:
                   continue
                 packageFiles.append( self.__storeFile( store, localPath, rpath, progressCB ) )
         return packageFiles
@@ -457,9 +1252,13 @@ class TreeStore(object):
                 buf = f.read( self.config.chunkSize )
                 if not buf:
                     break
+                filesha1.update( buf )
+                if buf.count(0) == len(buf):
+                    progressCB( 0, len(buf) )
+                    chunks.append( package.FileChunk( self.__zeroSha1( len(buf) ), len(buf), package.ENCODING_ZERO, None ) )
+                    continue
                 chunksha1 = hashlib.sha1()
                 chunksha1.update( buf )
-                filesha1.update( buf )
                 chunks.append( self.__storeChunk( store, chunksha1.hexdigest(), buf, progressCB ) )
         self.outVerbose( "file {} has hash {}", rpath, filesha1.hexdigest() )
         rpath = package.pathFromFileSystem( rpath )
@@ -467,10 +1266,12 @@ class TreeStore(object):
 
     def __storeChunk( self, store, sha1, buf, progressCB ):
         size = len(buf)
+        self.__limitRequests( store, 1, 0 )
         if store.exists( self.__chunkPath( store, sha1, package.ENCODING_RAW ) ):
             progressCB( 0, size )
             return package.FileChunk( sha1, size, package.ENCODING_RAW, None )
-        elif store.exists( self.__chunkPath( store, sha1, package.ENCODING_ZLIB ) ):
+        self.__limitRequests( store, 1, 0 )
+        if store.exists( self.__chunkPath( store, sha1, package.ENCODING_ZLIB ) ):
             progressCB( 0, size )
             return package.FileChunk( sha1, size, package.ENCODING_ZLIB, None )
         else:
@@ -479,10 +1280,16 @@ class TreeStore(object):
                 buf,encoding = self.__compress( buf )
             if not self.dryRun:
                 self.outVerbose( "Uploading {} chunk with hash {}", encoding, sha1  )
+                self.__limitRequests( store, 1, len(buf) )
                 store.put( self.__chunkPath( store, sha1, encoding ), buf )
             progressCB( size, 0 )
             return package.FileChunk( sha1, size, encoding, None )
 
+    def __limitRequests( self, store, nRequests, nBytes ):
+        """Apply the rate limits to requests to the package store"""
+        if store is self.pkgStore:
+            self.rateLimiter.acquire( nRequests, nBytes )
+
     def __treeNamePath( self, store, treeName ):
         return store.joinPath( TREES_PATH, treeName )
 
@@ -496,6 +1303,84 @@ class TreeStore(object):
         }[encoding]
         return store.joinPath( CHUNKS_PATH, enc, sha1[:2], sha1[2:] )
 
+    def __verifiedPath( self, sha1 ):
+        """The path of the marker recording that a chunk in the local cache has been verified"""
+        return self.localCache.joinPath( VERIFIED_PATH, sha1[:2], sha1[2:] )
+
+    def __markVerified( self, chunks ):
+        for chunk in chunks:
+            if chunk.encoding != package.ENCODING_ZERO:
+                self.localCache.put( self.__verifiedPath( chunk.sha1 ), b'' )
+
+    def __isVerified( self, chunks ):
+        for chunk in chunks:
+            if chunk.encoding != package.ENCODING_ZERO and not self.localCache.exists( self.__verifiedPath( chunk.sha1 ) ):
+                return False
+        return True
+
+    def __cachedChunk( self, chunk ):
+        """Returns the (path,encoding) of a chunk in the local cache, or None if it's not present.
+
+        As well as in its package encoding, a chunk may be held decoded.
+        """
+        encodings = [chunk.encoding]
+        if chunk.encoding != package.ENCODING_RAW:
+            encodings.append( package.ENCODING_RAW )
+            if self.cacheConfig.decodeChunks:
+                encodings.reverse()
+        for encoding in encodings:
+            cpath = self.__chunkPath( self.localCache, chunk.sha1, encoding )
+            if self.localCache.exists( cpath ):
+                return cpath,encoding
+        return None
+
+    def __readChunkPieces( self, chunk ):
+        """Yields the decoded content of a chunk from the local cache, in pieces of bounded size
+
+        Each piece is only valid until the next is requested.
+        """
+        if chunk.encoding == package.ENCODING_ZERO:
+            zeros = bytes( min( chunk.size, ZERO_BUFFER_SIZE ) )
+            for offset in range( 0, chunk.size, len(zeros) ):
+                yield memoryview(zeros)[:chunk.size-offset]
+            return
+        cached = self.__cachedChunk( chunk )
+        if cached is None:
+            raise KeyError( "chunk {} is not in the local cache".format( chunk.sha1 ) )
+        cpath,encoding = cached
+        with self.__chunkLock( chunk.sha1, shared=True ):
+            with self.localCache.getBuffer( cpath ) as buf:
+                for piece in self.__decode( buf, encoding ):
+                    yield piece
+
+    def __chunkLock( self, sha1, shared=False, blocking=True ):
+        """Lock a chunk in the local cache against other processes.
+
+        Processes fetching a chunk hold the lock exclusively, so that only one
+        transfers it, and processes reading a chunk hold it shared, so that it
+        isn't flushed from under them.
+        """
+        return self.localCache.lock( self.__chunkLockPath( sha1 ), shared, blocking )
+
+    def __chunkLockPath( self, sha1 ):
+        return self.localCache.joinPath( CHUNKS_PATH, sha1[:2], sha1[2:] )
+
+    def __zeroSha1( self, size ):
+        """Returns the sha1 of size zero bytes"""
+        if size not in self.zeroSha1s:
+            zerosha1 = hashlib.sha1()
+            self.__updateZeroSha1( zerosha1, size )
+            self.zeroSha1s[size] = zerosha1.hexdigest()
+        return self.zeroSha1s[size]
+
+    def __updateZeroSha1( self, sha1, size ):
+        """Updates sha1 with size zero bytes, without allocating them all"""
+        zeros = bytes( min( size, ZERO_BUFFER_SIZE ) )
+        while size > 0:
+            n = min( size, len(zeros) )
+            sha1.update( memoryview(zeros)[:n] )
+            size -= n
+
     def __compress( self, buf ):
         bufz = zlib.compress( buf )
         if len( bufz ) < len( buf ):
@@ -503,14 +1388,32 @@ class TreeStore(object):
         else:
             return buf,package.ENCODING_RAW
 
-    def __decompress( self, buf, encoding ):
-        if encoding == package.ENCODING_ZLIB:
-            return zlib.decompress( buf )
-        else:
-            return buf
+    def __decode( self, buf, encoding ):
+        """Yields the decoded content of buf, in pieces of bounded size"""
+        return self.__decodePiece( self.__decompressor( encoding ), buf )
 
-    def __checkSha1( self, buf, sha1, cpath ):
+    def __decompressor( self, encoding ):
+        """Returns an object to decode a chunk incrementally with __decodePiece"""
+        if encoding == package.ENCODING_ZLIB:
+            return zlib.decompressobj()
+        return None
+
+    def __decodePiece( self, decompressor, buf ):
+        """Yields the decoded content of the next piece of a chunk, in pieces of bounded size"""
+        if decompressor is None:
+            yield buf
+            return
+        while True:
+            piece = decompressor.decompress( buf, DECODE_PIECE_SIZE )
+            buf = decompressor.unconsumed_tail
+            if piece:
+                yield piece
+            elif not buf:
+                break
+
+    def __checkDecodedSha1( self, buf, encoding, sha1, cpath ):
         csha1 = hashlib.sha1()
-        csha1.update( buf )
+        for piece in self.__decode( buf, encoding ):
+            csha1.update( piece )
         if csha1.hexdigest() != sha1:
             raise RuntimeError("sha1 for {0} doesn't match".format( cpath ))
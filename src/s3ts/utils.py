@@ -1,4 +1,6 @@
-import datetime, os
+import datetime, os, threading, errno
+
+from concurrent.futures import ThreadPoolExecutor
 
 def datetimeFromIso( s ):
     """parse (a subset of ) valid ISO 8601 dates"""
@@ -10,28 +12,88 @@ def datetimeFromIso( s ):
         return datetime.datetime.strptime( s, '%Y-%m-%dT%H:%M:%S' )
         
 
-def allFilePaths(path):
-    """Find all of the files below path"""
-    result = []
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            result.append(os.path.normpath(os.path.join(os.path.relpath(root,path), file)))
-    return result
-
-def removeEmptyDirectories(path, removeRoot):
-  """Remove empty directories recursively"""
-
-  if not os.path.isdir(path):
-    return
-
-  files = os.listdir(path)
-  if len(files):
-    for f in files:
-      fullpath = os.path.join(path, f)
-      if os.path.isdir(fullpath):
-        removeEmptyDirectories(fullpath, True)
-
-  files = os.listdir(path)
-  if len(files) == 0 and removeRoot:
-    os.rmdir(path)        
-    
+def scanTree(path):
+    """Find all of the files below path, and the directories below it that
+    are empty, as paths relative to path.
+
+    This uses os.scandir, which saves a stat of each entry on most
+    platforms. As with os.walk, symlinks to directories are not followed.
+    """
+    files = []
+    emptyDirs = []
+    def scan(rpath):
+        empty = True
+        with os.scandir(os.path.join(path, rpath)) as entries:
+            for entry in entries:
+                empty = False
+                entryPath = os.path.join(rpath, entry.name)
+                if not entry.is_dir():
+                    files.append(entryPath)
+                elif not entry.is_symlink():
+                    scan(entryPath)
+        if empty and rpath:
+            emptyDirs.append(rpath)
+    scan('')
+    return files, emptyDirs
+
+def removeEmptyParents(path, rpaths):
+    """Remove the directories holding rpaths (relative to path) that are
+    empty, and then their parents in turn, stopping short of path itself"""
+    dirs = set()
+    for rpath in rpaths:
+        dir = os.path.dirname(rpath)
+        while dir and dir not in dirs:
+            dirs.add(dir)
+            dir = os.path.dirname(dir)
+    # Deepest first, so that each directory is tried after its children
+    for dir in sorted(dirs, key=lambda dir: dir.count(os.sep), reverse=True):
+        try:
+            os.rmdir(os.path.join(path, dir))
+        except OSError:
+            # Not empty, or already gone
+            pass
+
+def isHole(fd, offset, size):
+    """Returns true if the given range of an open file is known to be a hole"""
+    try:
+        return os.lseek(fd, offset, os.SEEK_DATA) >= offset + size
+    except OSError as e:
+        # ENXIO means there is no data after offset
+        return e.errno == errno.ENXIO
+    except AttributeError:
+        return False
+
+def parallelMap(fn, items, workers):
+    """
+    Apply fn to each of items, using a pool of worker threads, and
+    return the results in order. The first exception raised by fn is
+    re-raised, once outstanding work has been cancelled.
+    """
+    if workers <= 1:
+        return [fn(item) for item in items]
+    executor = ThreadPoolExecutor(workers)
+    try:
+        futures = [executor.submit(fn, item) for item in items]
+        return [future.result() for future in futures]
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+class LockedCallback(object):
+    """wraps a progress callback so that it may be called from multiple threads"""
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.lock = threading.Lock()
+
+    def __call__(self, *args):
+        with self.lock:
+            self.callback(*args)
+
+class NullHash(object):
+    """a stand in for a hashlib object, when no hash is required"""
+
+    def update(self, buf):
+        pass
+
+    def hexdigest(self):
+        return None
@@ -1,11 +1,23 @@
-import os, tempfile, unittest, shutil, subprocess, datetime, time
+import os, errno, contextlib, hashlib, tempfile, unittest, shutil, subprocess, datetime, time, threading
+import http.server
+import requests
 
 from s3ts.filestore import LocalFileStore
+from s3ts import treestore as treestoreModule
+from s3ts import filewriter
 from s3ts.s3filestore import S3FileStore
-from s3ts.config import TreeStoreConfig, readInstallProperties, S3TS_PROPERTIES
-from s3ts.treestore import TreeStore
+from s3ts.shardedfilestore import ShardedFileStore
+from s3ts.packfilestore import PackFileStore, RECORD, RECORD_MAGIC, RECORD_PUT
+from s3ts.config import TreeStoreConfig, LocalCacheConfig, readInstallProperties, S3TS_PROPERTIES, S3TS_MANIFEST
+from s3ts.httpdownloader import HttpDownloader
+from s3ts.filewriter import DURABILITY_BATCH, DURABILITY_MODES
+from s3ts import staging
+from s3ts.peerfilestore import PeerFileStore
+from s3ts.cacheserver import CacheServer
+from s3ts.ratelimit import RateLimiter
+from s3ts.treestore import TreeStore, CHUNKS_PATH, INSTALL_HARDLINK, INSTALL_REFLINK, VERIFY_ALWAYS, VERIFY_ONCE, VERIFY_FILE, IO_PROFILE_STREAMING
 from s3ts.utils import datetimeFromIso
-from s3ts.package import PackageJS, S3TS_PACKAGEFILE
+from s3ts.package import PackageJS, S3TS_PACKAGEFILE, ENCODING_RAW, ENCODING_ZLIB
 from s3ts.metapackage import MetaPackage, SubPackage
 
 import boto
@@ -42,6 +54,127 @@ class EmptyS3Bucket:
         # Clean the bucket (ok, as we know it started empty)
         self.bucket.delete_keys( self.bucket.list() )
 
+class FlakyFileServer:
+    """Serves files over http, dropping the connection part way through
+    the first response for each path, and honouring Range requests"""
+
+    def __init__( self, root ):
+        served = set()
+        self.requests = []
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(handler):
+                self.requests.append( (handler.path, handler.headers.get('Range')) )
+                try:
+                    with open( os.path.join( root, handler.path.lstrip('/') ), 'rb' ) as f:
+                        body = f.read()
+                except IOError:
+                    handler.send_error( 404 )
+                    return
+                offset = 0
+                if handler.headers.get('Range'):
+                    offset = int( handler.headers['Range'][len('bytes='):-1] )
+                    handler.send_response( 206 )
+                    handler.send_header( 'Content-Range', 'bytes {}-{}/{}'.format( offset, len(body)-1, len(body) ) )
+                else:
+                    handler.send_response( 200 )
+                handler.send_header( 'Content-Length', str( len(body) - offset ) )
+                handler.end_headers()
+                if handler.path in served:
+                    handler.wfile.write( body[offset:] )
+                else:
+                    served.add( handler.path )
+                    handler.wfile.write( body[offset:offset + (len(body)-offset)//2] )
+                    handler.close_connection = True
+
+            def log_message(handler, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer( ('127.0.0.1', 0), Handler )
+        self.url = 'http://127.0.0.1:{}/'.format( self.server.server_address[1] )
+
+    def __enter__(self):
+        threading.Thread( target=self.server.serve_forever, daemon=True ).start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.server.shutdown()
+        self.server.server_close()
+
+class InterruptingFileStore(LocalFileStore):
+    """A LocalFileStore whose streams can be made to fail part way through,
+    recording the offsets they are read from"""
+
+    def __init__( self, root ):
+        LocalFileStore.__init__( self, root )
+        self.failAfter = None
+        self.offsets = []
+
+    def getStream( self, path, offset=0 ):
+        self.offsets.append( offset )
+        f = LocalFileStore.getStream( self, path, offset )
+        if self.failAfter is None:
+            return f
+        store = self
+        class Interrupted(object):
+            def read( self, n ):
+                if store.failAfter <= 0:
+                    raise IOError("connection lost")
+                buf = f.read( min( n, store.failAfter ) )
+                store.failAfter -= len(buf)
+                return buf
+            def __enter__( self ):
+                return self
+            def __exit__( self, *args ):
+                f.close()
+        return Interrupted()
+
+class SlowFileStore(LocalFileStore):
+    """A LocalFileStore that is slow to open streams, counting them"""
+
+    def __init__( self, root ):
+        LocalFileStore.__init__( self, root )
+        self.streams = 0
+
+    def getStream( self, path, offset=0 ):
+        self.streams += 1
+        time.sleep( 0.05 )
+        return LocalFileStore.getStream( self, path, offset )
+
+class FailingFileStore(LocalFileStore):
+    """A LocalFileStore whose streams fail for the given paths"""
+
+    def __init__( self, root ):
+        LocalFileStore.__init__( self, root )
+        self.failing = set()
+
+    def getStream( self, path, offset=0 ):
+        if path in self.failing:
+            raise IOError("{} is unavailable".format(path))
+        return LocalFileStore.getStream( self, path, offset )
+
+class CheckRecordingFileStore(LocalFileStore):
+    """A LocalFileStore that records the paths checked for existence"""
+
+    def __init__( self, root ):
+        LocalFileStore.__init__( self, root )
+        self.checked = []
+
+    def exists( self, path ):
+        self.checked.append( path )
+        return LocalFileStore.exists( self, path )
+
+
+class SyncRecordingFileStore(LocalFileStore):
+    """A LocalFileStore that records the number of verified chunks at each sync"""
+
+    def __init__( self, root, durability ):
+        LocalFileStore.__init__( self, root, durability )
+        self.synced = []
+
+    def sync( self ):
+        self.synced.append( len(self.list( 'verified' )) )
+        LocalFileStore.sync( self )
 
 class TestTreeStore(unittest.TestCase):
 
@@ -140,7 +273,7 @@ class TestTreeStore(unittest.TestCase):
         treestore.install( pkg, destTree, CaptureInstallProgress() )
 
         # Check that the installed tree is the same as the source tree
-        self.assertEqual( subprocess.call( 'diff -r -x {0} {1} {2}'.format(S3TS_PROPERTIES,self.srcTree,destTree), shell=True ), 0 )
+        self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree,destTree), shell=True ), 0 )
 
         # Rename the tree, and check that installing that is the same
         treestore.rename( 'v1.0', 'v1.0x' )
@@ -148,7 +281,7 @@ class TestTreeStore(unittest.TestCase):
         treestore.download( pkg, CaptureDownloadProgress() )
         destTree = os.path.join( self.workdir, 'dest-2' )
         treestore.install( pkg, destTree, CaptureInstallProgress() )
-        self.assertEqual( subprocess.call( 'diff -r -x {0} {1} {2}'.format(S3TS_PROPERTIES,self.srcTree,destTree), shell=True ), 0 )
+        self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree,destTree), shell=True ), 0 )
 
         # Test the flushStore function has nothing to remove)
         treestore.upload( 'extra', '', creationTime, self.srcTree2, CaptureUploadProgress() )
@@ -180,6 +313,7 @@ class TestTreeStore(unittest.TestCase):
         fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
         localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
         treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 10, True ) )
+        treestore.setWorkers( 3 )
 
         creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
         treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
@@ -259,6 +393,14 @@ class TestTreeStore(unittest.TestCase):
         assertExists( S3TS_PACKAGEFILE )
         assertInstalled( pkg, testdir )
 
+        # Partly written package and manifest files are treated as missing
+        for name in [S3TS_PACKAGEFILE, S3TS_MANIFEST]:
+            with open( os.path.join( testdir, name ), 'r+' ) as f:
+                f.truncate( os.path.getsize( f.name ) // 2 )
+        treestore.sync( pkg, testdir, CaptureInstallProgress() )
+        assertInstalled( pkg, testdir )
+        self.assertEqual( treestore.compareInstall( pkg, testdir, full=False ).diffs, set() )
+
         # Add an extra file not in the package, and ensure
         # that syncing deletes it
         with open( os.path.join(testdir, "debug.log"), 'w') as f:
@@ -267,13 +409,868 @@ class TestTreeStore(unittest.TestCase):
         treestore.sync( pkg, testdir, CaptureInstallProgress() )
         assertInstalled( pkg, testdir )
 
-        # Sync to test replacing a directory with a file
+        # Sync to test replacing a directory with a file. Files that have
+        # moved should be renamed rather than rewritten.
+        inode = os.stat( os.path.join(testdir, "code/file1.py") ).st_ino
         pkg = treestore.findPackage('v1.4')
         treestore.download( pkg, CaptureDownloadProgress() ) 
         treestore.sync( pkg, testdir, CaptureInstallProgress() )
         assertContains( "text", self.FILE5 )
+        assertContains( "file1.py", self.FILE1 )
+        assertDoesntExist( "code/file1.py" )
+        self.assertEqual( os.stat( os.path.join(testdir, "file1.py") ).st_ino, inode )
         assertInstalled( pkg, testdir )
 
+    def test_sync_removals(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 100, True ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg3 = treestore.upload( 'v1.2', '', creationTime, self.srcTree3, CaptureUploadProgress() )
+        pkg4 = treestore.upload( 'v1.3', '', creationTime, self.srcTree4, CaptureUploadProgress() )
+        treestore.download( pkg3, CaptureDownloadProgress() )
+        treestore.download( pkg4, CaptureDownloadProgress() )
+
+        for findStrays in [False, True]:
+            treestore.setFindStrays( findStrays )
+            destTree = os.path.join( self.workdir, 'dest-{}'.format( findStrays ) )
+            treestore.sync( pkg3, destTree, CaptureInstallProgress() )
+            makeEmptyDir( os.path.join( destTree, 'empty', 'dir' ) )
+            with open( os.path.join( destTree, 'code', 'stray.py' ), 'wb' ) as f:
+                f.write( self.FILE5 )
+            with open( os.path.join( destTree, 'text', 'stray.txt' ), 'wb' ) as f:
+                f.write( self.FILE5 )
+
+            # The directory text is replaced by a file, whether or not strays are found
+            treestore.sync( pkg4, destTree, CaptureInstallProgress() )
+            self.assertTrue( os.path.isfile( os.path.join( destTree, 'text' ) ) )
+            self.assertEqual( os.path.exists( os.path.join( destTree, 'code', 'stray.py' ) ), not findStrays )
+            self.assertEqual( os.path.exists( os.path.join( destTree, 'empty' ) ), not findStrays )
+            result = treestore.compareInstall( pkg4, destTree )
+            self.assertEqual( (result.missing, result.diffs), (set(), set()) )
+
+    def test_sync_modified(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 100, True ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg3 = treestore.upload( 'v1.2', '', creationTime, self.srcTree3, CaptureUploadProgress() )
+        pkg4 = treestore.upload( 'v1.3', '', creationTime, self.srcTree4, CaptureUploadProgress() )
+        treestore.download( pkg3, CaptureDownloadProgress() )
+        treestore.download( pkg4, CaptureDownloadProgress() )
+
+        destTree = os.path.join( self.workdir, 'dest' )
+        treestore.sync( pkg3, destTree, CaptureInstallProgress() )
+        def modify( path ):
+            path = os.path.join( destTree, path )
+            with open( path, 'r+b' ) as f:
+                data = f.read()
+                f.seek( 0 )
+                f.write( data.swapcase() )
+
+        # A modified file isn't relocated, but written out from the cache
+        modify( os.path.join( 'code', 'file1.py' ) )
+        treestore.sync( pkg4, destTree, CaptureInstallProgress() )
+        with open( os.path.join( destTree, 'file1.py' ), 'rb' ) as f:
+            self.assertEqual( f.read(), self.FILE1 )
+        self.assertEqual( treestore.compareInstall( pkg4, destTree, full=False ).diffs, set() )
+
+        # Without a manifest, untouched files are left out of the new one, so
+        # that their content is still checked
+        treestore.sync( pkg3, destTree, CaptureInstallProgress() )
+        os.unlink( os.path.join( destTree, S3TS_MANIFEST ) )
+        modify( os.path.join( 'code', 'file4.py' ) )
+        treestore.sync( pkg4, destTree, CaptureInstallProgress() )
+        self.assertEqual( treestore.compareInstall( pkg4, destTree, full=False ).diffs, set([os.path.join( 'code', 'file4.py' )]) )
+
+    def test_sync_patch(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 10, True ) )
+
+        DATA1 = bytes(range(100))
+        DATA2 = DATA1[:30] + b'0123456789' + DATA1[40:] + b'extra'
+        fs = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'src-a' ) ) )
+        fs.put( 'data.bin', DATA1 )
+        fs = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'src-b' ) ) )
+        fs.put( 'data.bin', DATA2 )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg1 = treestore.upload( 'v1', '', creationTime, os.path.join( self.workdir, 'src-a' ), CaptureUploadProgress() )
+        pkg2 = treestore.upload( 'v2', '', creationTime, os.path.join( self.workdir, 'src-b' ), CaptureUploadProgress() )
+        treestore.download( pkg1, CaptureDownloadProgress() )
+        treestore.download( pkg2, CaptureDownloadProgress() )
+
+        testdir = makeEmptyDir( os.path.join( self.workdir, 'test' ) )
+        path = os.path.join( testdir, 'data.bin' )
+        def contents():
+            with open( path, 'rb' ) as f:
+                return f.read()
+
+        # Only the changed and additional chunks are written, in place
+        treestore.sync( pkg1, testdir, CaptureInstallProgress() )
+        inode = os.stat( path ).st_ino
+        cb = CaptureInstallProgress()
+        treestore.sync( pkg2, testdir, cb )
+        self.assertEqual( contents(), DATA2 )
+        self.assertEqual( os.stat( path ).st_ino, inode )
+        self.assertEqual( sum(cb.recorded), len(DATA2) )
+
+        # A file that doesn't match its recorded content is rewritten in full
+        treestore.sync( pkg1, testdir, CaptureInstallProgress() )
+        with open( path, 'r+b' ) as f:
+            f.write( b'X' )
+        cb = CaptureInstallProgress()
+        treestore.sync( pkg2, testdir, cb )
+        self.assertEqual( contents(), DATA2 )
+        # ...and its progress is only counted once
+        self.assertEqual( sum(cb.recorded), len(DATA2) )
+
+    def test_staged_install(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 100, True ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg1 = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+        pkg2 = treestore.upload( 'v1.1', '', creationTime, self.srcTree2, CaptureUploadProgress() )
+        pkg3 = treestore.upload( 'v1.2', '', creationTime, self.srcTree3, CaptureUploadProgress() )
+        for pkg in [pkg1, pkg2, pkg3]:
+            treestore.download( pkg, CaptureDownloadProgress() )
+
+        def assertInstalled( srcTree, pkg ):
+            self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} -x {2} {3} {4}/'.format(S3TS_PROPERTIES,S3TS_MANIFEST,S3TS_PACKAGEFILE,srcTree,destTree), shell=True ), 0 )
+            self.assertEqual( readInstallProperties( destTree ).treeName, pkg.name )
+
+        # The install is a symlink to the current version
+        destTree = os.path.join( self.workdir, 'dest' )
+        version1 = treestore.installStaged( pkg1, destTree, CaptureInstallProgress(), keep=1 )
+        self.assertEqual( os.path.realpath( destTree ), version1 )
+        assertInstalled( self.srcTree, pkg1 )
+
+        # Unchanged files are linked from the previous version, which is left untouched
+        version2 = treestore.installStaged( pkg2, destTree, CaptureInstallProgress(), keep=1 )
+        self.assertEqual( os.path.realpath( destTree ), version2 )
+        assertInstalled( self.srcTree2, pkg2 )
+        self.assertEqual( os.stat( os.path.join( version1, 'code', 'file1.py' ) ).st_ino,
+                          os.stat( os.path.join( version2, 'code', 'file1.py' ) ).st_ino )
+        self.assertEqual( treestore.compareInstall( pkg1, version1 ).diffs, set() )
+
+        # A failed install leaves the current version in place
+        with self.assertRaises(RuntimeError):
+            treestore.installStaged( pkg3, os.path.join( version2, 'code', 'file1.py' ), CaptureInstallProgress() )
+        for path in localCache.list( 'chunks' ):
+            localCache.remove( os.path.join( 'chunks', path ) )
+        with self.assertRaises(KeyError):
+            treestore.installStaged( pkg3, destTree, CaptureInstallProgress(), keep=1 )
+        self.assertEqual( os.path.realpath( destTree ), version2 )
+        assertInstalled( self.srcTree2, pkg2 )
+        self.assertEqual( [os.path.basename( path ) for n,path in staging.listVersions( destTree )], ['000001', '000002'] )
+
+        # Rolling back returns to the previous version, which can't be rolled back
+        self.assertEqual( staging.rollback( destTree ), version1 )
+        assertInstalled( self.srcTree, pkg1 )
+        with self.assertRaises(RuntimeError):
+            staging.rollback( destTree )
+
+        # Older versions are removed, keeping the number asked for
+        for pkg in [pkg1, pkg2, pkg3]:
+            treestore.download( pkg, CaptureDownloadProgress() )
+        version3 = treestore.installStaged( pkg3, destTree, CaptureInstallProgress(), keep=1 )
+        assertInstalled( self.srcTree3, pkg3 )
+        self.assertEqual( [path for n,path in staging.listVersions( destTree )], [version1, version3] )
+
+        # Installs through a symlinked directory link to the versions beside them
+        realParent = makeEmptyDir( os.path.join( self.workdir, 'real', 'parent' ) )
+        os.symlink( realParent, os.path.join( self.workdir, 'linked' ) )
+        destTree = os.path.join( self.workdir, 'linked', 'dest' )
+        version = treestore.installStaged( pkg3, destTree, CaptureInstallProgress() )
+        self.assertEqual( os.path.realpath( destTree ), version )
+        assertInstalled( self.srcTree3, pkg3 )
+
+    def test_seeded_install(self):
+        fileStore = FailingFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 100, True ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg1 = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+        pkg2 = treestore.upload( 'v1.1', '', creationTime, self.srcTree2, CaptureUploadProgress() )
+        treestore.download( pkg1, CaptureDownloadProgress() )
+        treestore.download( pkg2, CaptureDownloadProgress() )
+        seedTree = os.path.join( self.workdir, 'seed' )
+        treestore.install( pkg1, seedTree, CaptureInstallProgress() )
+
+        # Files common to the seed needn't be in the cache
+        for pf in pkg1.files:
+            for chunk in pf.chunks:
+                localCache.remove( os.path.join( 'chunks', chunk.encoding, chunk.sha1[:2], chunk.sha1[2:] ) )
+        treestore.setSeedDirs( [os.path.join( self.workdir, 'missing' ), seedTree] )
+        for installMode in [INSTALL_HARDLINK, INSTALL_REFLINK]:
+            treestore.setInstallMode( installMode )
+            destTree = os.path.join( self.workdir, 'dest-' + installMode )
+            treestore.install( pkg2, destTree, CaptureInstallProgress() )
+            self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree2,destTree), shell=True ), 0 )
+        self.assertEqual( os.stat( os.path.join( seedTree, 'code', 'file1.py' ) ).st_ino,
+                          os.stat( os.path.join( self.workdir, 'dest-hardlink', 'code', 'file1.py' ) ).st_ino )
+
+        # Nor need they be downloaded
+        seeded = set( pf.sha1 for pf in pkg1.files )
+        fileStore.failing = set( os.path.join( 'chunks', chunk.encoding, chunk.sha1[:2], chunk.sha1[2:] )
+                                 for pf in pkg2.files if pf.sha1 in seeded for chunk in pf.chunks )
+        self.assertTrue( fileStore.failing )
+        for path in localCache.list( 'chunks' ):
+            localCache.remove( os.path.join( 'chunks', path ) )
+        with self.assertRaises(IOError):
+            treestore.download( pkg2, CaptureDownloadProgress() )
+        fetchPkg = treestore.unseeded( pkg2 )
+        self.assertEqual( set( pf.path for pf in fetchPkg.files ), set( pf.path for pf in pkg2.files if pf.sha1 not in seeded ) )
+        treestore.download( fetchPkg, CaptureDownloadProgress() )
+        treestore.verifyLocal( fetchPkg )
+        destTree = os.path.join( self.workdir, 'dest-fetched' )
+        treestore.install( pkg2, destTree, CaptureInstallProgress() )
+        self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree2,destTree), shell=True ), 0 )
+
+        # Seed files changed since they were installed aren't used
+        with open( os.path.join( seedTree, 'code', 'file1.py' ), 'ab' ) as f:
+            f.write( b'# changed' )
+        with self.assertRaises(KeyError):
+            treestore.install( pkg2, os.path.join( self.workdir, 'dest-changed' ), CaptureInstallProgress() )
+
+    def test_zero_chunks(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 10, True ) )
+
+        DATA = bytes(25) + b'0123456789' + bytes(15)
+        fs = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'src-a' ) ) )
+        fs.put( 'disk.img', DATA )
+
+        # Zero chunks don't need any stored objects
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg = treestore.upload( 'v1', '', creationTime, os.path.join( self.workdir, 'src-a' ), CaptureUploadProgress() )
+        self.assertEqual( [c.encoding for c in pkg.files[0].chunks], ['zero', 'zero', 'raw', 'raw', 'zero'] )
+        self.assertEqual( len(fileStore.list( 'chunks' )), 2 )
+
+        treestore.download( pkg, CaptureDownloadProgress() )
+        treestore.verifyLocal( pkg )
+        destTree = os.path.join( self.workdir, 'dest-1' )
+        treestore.install( pkg, destTree, CaptureInstallProgress() )
+        with open( os.path.join( destTree, 'disk.img' ), 'rb' ) as f:
+            self.assertEqual( f.read(), DATA )
+        result = treestore.compareInstall( pkg, destTree )
+        self.assertEqual( result.diffs, set() )
+
+        # Comparison doesn't need the store config
+        result = TreeStore.forHttpOnly( localCache ).compareInstall( pkg, destTree )
+        self.assertEqual( result.diffs, set() )
+
+        with open( os.path.join( destTree, 'disk.img' ), 'r+b' ) as f:
+            f.write( b'x' )
+        result = treestore.compareInstall( pkg, destTree )
+        self.assertEqual( result.diffs, set(['disk.img']) )
+
+    def test_io_profile(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 10, True ) )
+        treestore.configureLocalCache( LocalCacheConfig( True ) )
+        with self.assertRaises(RuntimeError):
+            treestore.setIoProfile( 'bursty' )
+        treestore.setIoProfile( IO_PROFILE_STREAMING )
+
+        DATA = bytes(25) + b'0123456789' + bytes(15)
+        fs = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'src-a' ) ) )
+        fs.put( 'disk.img', DATA )
+        fs.put( 'file.txt', b'abcdefghijklmnopqrstuvwxyz' )
+
+        # Drop what is written from the page cache every few bytes, with and without holes
+        savedSize = filewriter.STREAMING_DROP_SIZE
+        filewriter.STREAMING_DROP_SIZE = 10
+        try:
+            creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+            pkg = treestore.upload( 'v1', '', creationTime, os.path.join( self.workdir, 'src-a' ), CaptureUploadProgress() )
+            treestore.download( pkg, CaptureDownloadProgress() )
+            destTree = os.path.join( self.workdir, 'dest' )
+            treestore.install( pkg, destTree, CaptureInstallProgress() )
+        finally:
+            filewriter.STREAMING_DROP_SIZE = savedSize
+        self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,os.path.join( self.workdir, 'src-a' ),destTree), shell=True ), 0 )
+        self.assertEqual( treestore.compareInstall( pkg, destTree ).diffs, set() )
+
+    def test_kernel_copy_fallback(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 10, True ) )
+        # Raw chunks in the cache are installed with appendFromFile
+        treestore.configureLocalCache( LocalCacheConfig( True ) )
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+        treestore.download( pkg, CaptureDownloadProgress() )
+
+        calls = []
+        def failingCopy( name, errno_ ):
+            def copy( srcFd, targetFd, offset, count ):
+                calls.append( name )
+                raise OSError( errno_, os.strerror( errno_ ) )
+            return copy
+        def partialCopy( name, copy ):
+            # Copy a few bytes of each chunk, then fail
+            def partial( srcFd, targetFd, offset, count ):
+                calls.append( name )
+                if offset > 0:
+                    raise OSError( errno.EXDEV, os.strerror( errno.EXDEV ) )
+                return copy( srcFd, targetFd, offset, min( count, 3 ) )
+            return partial
+
+        savedCopyFileRange = filewriter._copyFileRange
+        savedSendfile = filewriter._sendfile
+        cases = [
+            # copy_file_range fails across filesystems, and sendfile takes over
+            ('sendfile', failingCopy( 'copy_file_range', errno.EXDEV ), savedSendfile),
+            # Neither is supported, and the bytes are written from the mmap
+            ('write', failingCopy( 'copy_file_range', errno.ENOSYS ), failingCopy( 'sendfile', errno.ENOSYS )),
+            # Each copy picks up where the last one failed
+            ('partial', partialCopy( 'copy_file_range', savedCopyFileRange ), partialCopy( 'sendfile', savedSendfile )),
+        ]
+        try:
+            for name, copyFileRange, sendfile in cases:
+                del calls[:]
+                filewriter._copyFileRange = copyFileRange
+                filewriter._sendfile = sendfile
+                destTree = os.path.join( self.workdir, 'dest-' + name )
+                treestore.install( pkg, destTree, CaptureInstallProgress() )
+                self.assertTrue( 'copy_file_range' in calls )
+                self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree,destTree), shell=True ), 0 )
+                self.assertEqual( treestore.compareInstall( pkg, destTree ).diffs, set() )
+        finally:
+            filewriter._copyFileRange = savedCopyFileRange
+            filewriter._sendfile = savedSendfile
+
+    def test_fast_verify(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 10, True ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+        treestore.download( pkg, CaptureDownloadProgress() )
+        testdir = os.path.join( self.workdir, 'test' )
+        treestore.sync( pkg, testdir, CaptureInstallProgress() )
+        self.assertEqual( treestore.compareInstall( pkg, testdir, full=False ).diffs, set() )
+
+        # Modified files are found from their stat signature...
+        path = os.path.join( testdir, 'code', 'file1.py' )
+        st = os.stat( path )
+        with open( path, 'r+b' ) as f:
+            f.write( b'X' )
+        self.assertEqual( treestore.compareInstall( pkg, testdir, full=False ).diffs, set(['code/file1.py']) )
+
+        # ... unless that is preserved, when only a full comparison finds them
+        os.utime( path, ns=(st.st_atime_ns, st.st_mtime_ns) )
+        self.assertEqual( treestore.compareInstall( pkg, testdir, full=False ).diffs, set() )
+        self.assertEqual( treestore.compareInstall( pkg, testdir ).diffs, set(['code/file1.py']) )
+
+    def test_verify_levels(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        cacheDir = makeEmptyDir( os.path.join( self.workdir, 'cache' ) )
+        localCache = LocalFileStore( cacheDir )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 100, True ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+        pf = [pf for pf in pkg.files if pf.path == 'code/file1.py'][0]
+        chunkPath = os.path.join( 'chunks', pf.chunks[0].encoding, pf.sha1[:2], pf.sha1[2:] )
+        destTree = os.path.join( self.workdir, 'dest' )
+
+        # Chunks are marked as verified on download, after which they are trusted
+        treestore.setVerifyLevel( VERIFY_ONCE )
+        treestore.download( pkg, CaptureDownloadProgress() )
+        self.assertEqual( len(localCache.list( 'verified' )), 5 )
+        localCache.put( chunkPath, b'corrupted' )
+        treestore.install( pkg, destTree, CaptureInstallProgress() )
+
+        # Validating the cache removes the marker of the corrupted chunk
+        self.assertEqual( len(treestore.validateLocalCache()), 1 )
+        self.assertEqual( len(localCache.list( 'verified' )), 4 )
+        with self.assertRaises(RuntimeError):
+            treestore.install( pkg, destTree, CaptureInstallProgress() )
+        treestore.setVerifyLevel( VERIFY_ALWAYS )
+        with self.assertRaises(RuntimeError):
+            treestore.install( pkg, destTree, CaptureInstallProgress() )
+
+        # With file level checks, corruption is only found on install
+        treestore.setVerifyLevel( VERIFY_FILE )
+        localCache.remove( chunkPath )
+        fileStore.put( chunkPath, b'corrupted' )
+        treestore.download( pkg, CaptureDownloadProgress() )
+        with self.assertRaises(RuntimeError):
+            treestore.install( pkg, destTree, CaptureInstallProgress() )
+
+        # Linked files are checked in the same way, and not left installed
+        treestore.setInstallMode( INSTALL_HARDLINK )
+        with self.assertRaises(RuntimeError):
+            treestore.install( pkg, destTree, CaptureInstallProgress() )
+        self.assertFalse( os.path.exists( os.path.join( destTree, 'code', 'file1.py' ) ) )
+
+    def test_durability(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        cacheDir = makeEmptyDir( os.path.join( self.workdir, 'cache' ) )
+        localCache = SyncRecordingFileStore( cacheDir, DURABILITY_BATCH )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 100, True ) )
+        with self.assertRaises(RuntimeError):
+            treestore.setDurability( 'eventually' )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg1 = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+        pkg2 = treestore.upload( 'v1.1', '', creationTime, self.srcTree2, CaptureUploadProgress() )
+
+        # Chunks are only marked as verified once the cache has been synced
+        treestore.setVerifyLevel( VERIFY_ONCE )
+        treestore.download( pkg1, CaptureDownloadProgress() )
+        self.assertEqual( localCache.synced, [0] )
+        self.assertEqual( len(localCache.list( 'verified' )), 5 )
+
+        for durability in DURABILITY_MODES:
+            treestore.setDurability( durability )
+            destTree = os.path.join( self.workdir, 'dest-' + durability )
+            treestore.install( pkg1, destTree, CaptureInstallProgress() )
+            self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree,destTree), shell=True ), 0 )
+            treestore.download( pkg2, CaptureDownloadProgress() )
+            treestore.sync( pkg2, destTree, CaptureInstallProgress() )
+            self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} -x {2} {3} {4}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,S3TS_PACKAGEFILE,self.srcTree2,destTree), shell=True ), 0 )
+
+        # Pack file caches sync each record, or the packs written
+        for durability in DURABILITY_MODES:
+            packCache = PackFileStore( makeEmptyDir( os.path.join( self.workdir, 'pack-' + durability ) ), durability )
+            TreeStore.open( fileStore, packCache ).download( pkg1, CaptureDownloadProgress() )
+            self.assertEqual( packCache.unsyncedPacks, set() )
+            TreeStore.open( fileStore, packCache ).verifyLocal( pkg1 )
+
+    def test_streamed_download(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        cacheDir = makeEmptyDir( os.path.join( self.workdir, 'cache' ) )
+        localCache = LocalFileStore( cacheDir )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 100, True ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+        pf = [pf for pf in pkg.files if pf.path == 'code/file1.py'][0]
+        chunkPath = os.path.join( 'chunks', pf.chunks[0].encoding, pf.sha1[:2], pf.sha1[2:] )
+
+        # Transfer and decode chunks in pieces much smaller than the chunks
+        savedSizes = treestoreModule.STREAM_PIECE_SIZE, treestoreModule.DECODE_PIECE_SIZE
+        treestoreModule.STREAM_PIECE_SIZE, treestoreModule.DECODE_PIECE_SIZE = 7, 5
+        try:
+            treestore.download( pkg, CaptureDownloadProgress() )
+            destTree = os.path.join( self.workdir, 'dest' )
+            treestore.install( pkg, destTree, CaptureInstallProgress() )
+            result = treestore.compareInstall( pkg, destTree )
+            self.assertEqual( result.missing | result.extra | result.diffs, set() )
+        finally:
+            treestoreModule.STREAM_PIECE_SIZE, treestoreModule.DECODE_PIECE_SIZE = savedSizes
+
+        # A corrupt chunk is never committed to the local cache
+        localCache.remove( chunkPath )
+        fileStore.put( chunkPath, fileStore.get( chunkPath )[:-1] + b'x' )
+        with self.assertRaises(Exception):
+            treestore.download( pkg, CaptureDownloadProgress() )
+        with self.assertRaises(KeyError):
+            localCache.get( chunkPath )
+        self.assertEqual( os.listdir( os.path.dirname( os.path.join( cacheDir, chunkPath ) ) ), [] )
+
+    def test_download_journal(self):
+        fileStore = InterruptingFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        cacheDir = makeEmptyDir( os.path.join( self.workdir, 'cache' ) )
+        localCache = CheckRecordingFileStore( cacheDir )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 100, False ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+
+        # Interrupt the download part way through a chunk
+        savedSize = treestoreModule.STREAM_PIECE_SIZE
+        treestoreModule.STREAM_PIECE_SIZE = 10
+        try:
+            fileStore.failAfter = 170
+            with self.assertRaises(IOError):
+                treestore.download( pkg, CaptureDownloadProgress() )
+            self.assertEqual( len(localCache.list( 'journals' )), 1 )
+            self.assertEqual( len(localCache.list( 'partial' )), 1 )
+
+            # The rerun skips the existence checks for completed chunks, and resumes the partial one
+            fileStore.failAfter = None
+            fileStore.offsets = []
+            localCache.checked = []
+            cb = CaptureDownloadProgress()
+            treestore.download( pkg, cb )
+        finally:
+            treestoreModule.STREAM_PIECE_SIZE = savedSize
+        self.assertEqual( sum(cb.recorded), pkg.size() )
+        self.assertEqual( fileStore.offsets[0], 70 )
+        firstChunk = pkg.files[0].chunks[0]
+        self.assertEqual( [p for p in localCache.checked if firstChunk.sha1[2:] in p], [] )
+        self.assertEqual( localCache.list( 'journals' ), [] )
+        self.assertEqual( localCache.list( 'partial' ), [] )
+
+        treestore.verifyLocal( pkg )
+        destTree = os.path.join( self.workdir, 'dest' )
+        treestore.install( pkg, destTree, CaptureInstallProgress() )
+        self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree,destTree), shell=True ), 0 )
+
+    def test_rate_limits(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 100, False ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+
+        # Five chunk requests, at 10 per second after a burst of 10, aren't throttled
+        rateLimiter = RateLimiter( requestsPerSec=10 )
+        treestore.setRateLimiter( rateLimiter )
+        treestore.download( pkg, CaptureDownloadProgress() )
+        self.assertEqual( rateLimiter.throttledSecs, 0 )
+
+        # Downloading a package of more than 300 bytes at 200 bytes per second is throttled
+        rateLimiter = RateLimiter( bytesPerSec=200 )
+        localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+        treestore = TreeStore.open( fileStore, localCache )
+        treestore.setRateLimiter( rateLimiter )
+        startTime = time.time()
+        treestore.download( pkg, CaptureDownloadProgress() )
+        self.assertTrue( rateLimiter.throttledSecs > 0.3 )
+        self.assertTrue( time.time() - startTime > 0.3 )
+
+    def test_cache_locks(self):
+        fileStore = SlowFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        cacheDir = makeEmptyDir( os.path.join( self.workdir, 'cache' ) )
+        treestore = TreeStore.create( fileStore, LocalFileStore( cacheDir ), TreeStoreConfig( 100, True ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg1 = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+        pkg2 = treestore.upload( 'v1.1', '', creationTime, self.srcTree3, CaptureUploadProgress() )
+
+        # Concurrent downloads of the same package fetch each chunk only once
+        fileStore.streams = 0
+        threads = [threading.Thread( target=TreeStore.open( fileStore, LocalFileStore( cacheDir ) ).download,
+                                     args=(pkg1, CaptureDownloadProgress()) ) for i in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual( fileStore.streams, 5 )
+        treestore.verifyLocal( pkg1 )
+        # Lock files are removed once they are released
+        self.assertEqual( [files for root, dirs, files in os.walk( os.path.join( cacheDir, 'locks' ) ) if files], [] )
+
+        # Chunks in use aren't flushed
+        treestore.download( pkg2, CaptureDownloadProgress() )
+        pf = [pf for pf in pkg1.files if pf.path == 'code/file2.py'][0]
+        localCache = LocalFileStore( cacheDir )
+        with localCache.lock( os.path.join( 'chunks', pf.sha1[:2], pf.sha1[2:] ), shared=True ):
+            removed = treestore.flushLocalCache( ['v1.1'] )
+            self.assertFalse( (pf.chunks[0].encoding, pf.sha1) in removed )
+        removed = treestore.flushLocalCache( ['v1.1'] )
+        self.assertEqual( removed, {(pf.chunks[0].encoding, pf.sha1)} )
+        treestore.verifyLocal( pkg2 )
+
+        # The journals of downloads in progress aren't flushed
+        journalPath = os.path.join( 'journals', hashlib.sha1( b'v1.1' ).hexdigest() )
+        localCache.put( journalPath, b'{}' )
+        with localCache.lock( journalPath, shared=True ):
+            treestore.flushLocalCache( ['v1.1'] )
+            self.assertTrue( localCache.exists( journalPath ) )
+        treestore.flushLocalCache( ['v1.1'] )
+        self.assertFalse( localCache.exists( journalPath ) )
+
+        # Nor are the partial transfers of chunks being fetched
+        partialPath = os.path.join( 'partial', pf.chunks[0].encoding, pf.sha1[:2], pf.sha1[2:] )
+        localCache.put( partialPath, b'partial' )
+        with localCache.lock( os.path.join( 'chunks', pf.sha1[:2], pf.sha1[2:] ) ):
+            treestore.flushLocalCache( ['v1.1'] )
+            self.assertTrue( localCache.exists( partialPath ) )
+        treestore.flushLocalCache( ['v1.1'] )
+        self.assertFalse( localCache.exists( partialPath ) )
+
+    def test_sharded_cache(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        roots = [makeEmptyDir( os.path.join( self.workdir, 'cache-{}'.format(i) ) ) for i in range(4)]
+        localCache = ShardedFileStore( roots[:3], [None, None, 150] )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 100, True ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+        treestore.download( pkg, CaptureDownloadProgress() )
+        treestore.verifyLocal( pkg )
+        self.assertEqual( len(localCache.list( 'chunks' )), 5 )
+        self.assertTrue( sum( 1 for root in roots if os.listdir( root ) ) > 1 )
+        self.assertTrue( sum( os.path.getsize( os.path.join( d, f ) )
+                              for d, _, files in os.walk( roots[2] ) for f in files ) <= 150 )
+
+        destTree = os.path.join( self.workdir, 'dest' )
+        treestore.install( pkg, destTree, CaptureInstallProgress() )
+        self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree,destTree), shell=True ), 0 )
+
+        # Files are linked from wherever their decoded copies were placed:
+        # the directory first in line for a compressed file can't hold it
+        linkTree = makeEmptyDir( os.path.join( self.workdir, 'src-link' ) )
+        LocalFileStore( linkTree ).put( 'file', b'x' * 90 )
+        linkPkg = treestore.upload( 'v1.1', '', creationTime, linkTree, CaptureUploadProgress() )
+        self.assertEqual( linkPkg.files[0].chunks[0].encoding, ENCODING_ZLIB )
+        linkRoots = [makeEmptyDir( os.path.join( self.workdir, 'link-cache-{}'.format(i) ) ) for i in range(2)]
+        rpath = os.path.join( CHUNKS_PATH, ENCODING_RAW, linkPkg.files[0].sha1[:2], linkPkg.files[0].sha1[2:] )
+        first = ShardedFileStore( linkRoots ).localPath( rpath )
+        capacities = [1 if first.startswith( os.path.abspath( root ) + os.sep ) else None for root in linkRoots]
+        treestore = TreeStore.open( fileStore, ShardedFileStore( linkRoots, capacities ) )
+        treestore.download( linkPkg, CaptureDownloadProgress() )
+        treestore.setInstallMode( INSTALL_HARDLINK )
+        destTree = os.path.join( self.workdir, 'dest-hardlink' )
+        treestore.install( linkPkg, destTree, CaptureInstallProgress() )
+        self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,linkTree,destTree), shell=True ), 0 )
+
+        # Adding a directory only moves values onto it
+        store3 = ShardedFileStore( roots[:3] )
+        store4 = ShardedFileStore( roots )
+        paths = ['chunks/raw/{:02x}/{}'.format( i, i ) for i in range(200)]
+        moved = [p for p in paths if store3.localPath( p ) != store4.localPath( p )]
+        self.assertTrue( 0 < len(moved) < 100 )
+        self.assertTrue( all( store4.localPath( p ).startswith( os.path.abspath( roots[3] ) ) for p in moved ) )
+
+    def test_pack_cache(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        cacheDir = makeEmptyDir( os.path.join( self.workdir, 'cache' ) )
+        localCache = PackFileStore( cacheDir )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 100, True ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg1 = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+        pkg2 = treestore.upload( 'v1.1', '', creationTime, self.srcTree3, CaptureUploadProgress() )
+        treestore.download( pkg1, CaptureDownloadProgress() )
+        treestore.download( pkg2, CaptureDownloadProgress() )
+        treestore.verifyLocal( pkg1 )
+        chunks1 = set( chunk.sha1 for pf in pkg1.files for chunk in pf.chunks )
+        chunks2 = set( chunk.sha1 for pf in pkg2.files for chunk in pf.chunks )
+        self.assertEqual( os.listdir( os.path.join( cacheDir, 'packs' ) ), ['00000001.pack'] )
+        self.assertEqual( len(localCache.list( 'chunks' )), len(chunks1 | chunks2) )
+        self.assertEqual( treestore.validateLocalCache(), [] )
+
+        destTree = os.path.join( self.workdir, 'dest' )
+        treestore.install( pkg1, destTree, CaptureInstallProgress() )
+        self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree,destTree), shell=True ), 0 )
+
+        # Flushed chunks are only reclaimed on compaction
+        self.assertEqual( len(treestore.flushLocalCache( ['v1.1'] )), len(chunks1 - chunks2) )
+        self.assertEqual( len(localCache.list( 'chunks' )), len(chunks2) )
+        self.assertTrue( localCache.compact() > 0 )
+        treestore.verifyLocal( pkg2 )
+
+        # The index is rebuilt from the packs if it is lost
+        os.unlink( os.path.join( cacheDir, 'index' ) )
+        localCache = PackFileStore( cacheDir )
+        self.assertEqual( len(localCache.list( 'chunks' )), len(chunks2) )
+        TreeStore.open( fileStore, localCache ).verifyLocal( pkg2 )
+
+        # The index grows as required
+        for i in range(2000):
+            localCache.put( os.path.join( 'test', str(i) ), str(i).encode() )
+        self.assertEqual( localCache.get( os.path.join( 'test', '1234' ) ), b'1234' )
+        self.assertEqual( len(localCache.list( 'test' )), 2000 )
+        with localCache.getStream( os.path.join( 'test', '1234' ), 2 ) as f:
+            self.assertEqual( f.read(), b'34' )
+
+        # A damaged index is rebuilt, cutting off a record left incomplete
+        # at the end of a pack, so that records appended later are kept
+        packPath = os.path.join( cacheDir, 'packs', max( os.listdir( os.path.join( cacheDir, 'packs' ) ) ) )
+        with open( packPath, 'ab' ) as f:
+            f.write( RECORD.pack( RECORD_MAGIC, RECORD_PUT, 4, 100, 0 ) + b'torn' + bytes(10) )
+        open( os.path.join( cacheDir, 'index' ), 'wb' ).close()
+        localCache = PackFileStore( cacheDir )
+        self.assertEqual( len(localCache.list( 'test' )), 2000 )
+        localCache.put( os.path.join( 'test', 'after' ), b'after' )
+        localCache.rebuildIndex()
+        self.assertEqual( localCache.get( os.path.join( 'test', 'after' ) ), b'after' )
+        self.assertFalse( localCache.exists( 'torn' ) )
+
+        # A record written after the end recorded in the index is picked up by the
+        # next append, and a torn one after it cut off
+        with open( packPath, 'ab' ) as f:
+            f.write( RECORD.pack( RECORD_MAGIC, RECORD_PUT, 6, 6, 0 ) + b'orphan' + b'orphan' )
+            f.write( RECORD.pack( RECORD_MAGIC, RECORD_PUT, 4, 100, 0 ) + b'torn' )
+        localCache.put( os.path.join( 'test', 'next' ), b'next' )
+        self.assertEqual( localCache.get( 'orphan' ), b'orphan' )
+        localCache.rebuildIndex()
+        self.assertEqual( localCache.get( os.path.join( 'test', 'next' ) ), b'next' )
+        self.assertEqual( len(localCache.list( 'test' )), 2002 )
+
+        # Paths are locked through a fixed set of lock files
+        with contextlib.ExitStack() as stack:
+            for i in range(300):
+                stack.enter_context( localCache.lock( os.path.join( 'test', str(i) ), shared=True ) )
+            self.assertTrue( len(os.listdir( os.path.join( cacheDir, 'locks', 'stripes', 'test' ) )) <= 256 )
+
+    def test_peer_cache(self):
+        fileStore = InterruptingFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        peerCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'peer-cache' ) ) )
+        treestore = TreeStore.create( fileStore, peerCache, TreeStoreConfig( 100, True ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+        pf = [pf for pf in pkg.files if pf.path == 'code/file1.py'][0]
+        treestore.download( pkg, CaptureDownloadProgress() )
+        peerCache.remove( os.path.join( 'chunks', pf.chunks[0].encoding, pf.sha1[:2], pf.sha1[2:] ) )
+
+        server = CacheServer( peerCache, ('127.0.0.1', 0) )
+        threading.Thread( target=server.serve_forever, daemon=True ).start()
+        try:
+            # Chunks come from the peer where it has them, and otherwise from the store
+            peerUrl = 'http://127.0.0.1:{}'.format( server.server_address[1] )
+            badPeerUrl = 'http://127.0.0.1:1'
+            peerStore = PeerFileStore( [badPeerUrl, peerUrl], fileStore, [CHUNKS_PATH] )
+            localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+            peerTreestore = TreeStore.open( peerStore, localCache )
+            fileStore.offsets = []
+            cb = CaptureDownloadProgress()
+            peerTreestore.download( pkg, cb )
+            self.assertEqual( sum(cb.recorded), pkg.size() )
+            self.assertEqual( len(fileStore.offsets), 1 )
+            self.assertTrue( badPeerUrl in peerStore.downUntil )
+
+            # Only chunks are served
+            self.assertEqual( requests.get( peerUrl + '/config' ).status_code, 404 )
+            self.assertEqual( requests.get( peerUrl + '/chunks/../config' ).status_code, 404 )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        peerTreestore.verifyLocal( pkg )
+        destTree = os.path.join( self.workdir, 'dest' )
+        peerTreestore.install( pkg, destTree, CaptureInstallProgress() )
+        self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree,destTree), shell=True ), 0 )
+
+    def test_download_http(self):
+        fsDir = makeEmptyDir( os.path.join( self.workdir, 'fs' ) )
+        fileStore = LocalFileStore( fsDir )
+        localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 100, True ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+
+        with FlakyFileServer( fsDir ) as server:
+            for pf in pkg.files:
+                for chunk in pf.chunks:
+                    chunk.url = server.url + '/'.join( ['chunks', chunk.encoding, chunk.sha1[:2], chunk.sha1[2:]] )
+
+            # Each chunk is fetched once, with the rest of an interrupted transfer fetched by range
+            httpStore = TreeStore.forHttpOnly( localCache )
+            httpStore.setWorkers( 4 )
+            cb = CaptureDownloadProgress()
+            with HttpDownloader( 4, backoff=0, readSize=8 ) as httpDownloader:
+                httpStore.setHttpDownloader( httpDownloader )
+                httpStore.downloadHttp( pkg, cb )
+            self.assertEqual( sum(cb.recorded), pkg.size() )
+            nChunks = len( set( path for path, _ in server.requests ) )
+            self.assertEqual( len(server.requests), 2 * nChunks )
+            self.assertEqual( len([r for r in server.requests if r[1]]), nChunks )
+
+        httpStore.verifyLocal( pkg )
+        destTree = os.path.join( self.workdir, 'dest' )
+        httpStore.install( pkg, destTree, CaptureInstallProgress() )
+        self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree,destTree), shell=True ), 0 )
+
+    def test_decoded_cache(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 100, True ) )
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg = treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+        self.assertTrue( 'zlib' in [c.encoding for pf in pkg.files for c in pf.chunks] )
+
+        # The configuration persists with the cache
+        treestore.configureLocalCache( LocalCacheConfig( True ) )
+        treestore = TreeStore.open( fileStore, localCache )
+        self.assertTrue( treestore.cacheConfig.decodeChunks )
+
+        treestore.download( pkg, CaptureDownloadProgress() )
+        self.assertEqual( localCache.list( os.path.join( 'chunks', 'zlib' ) ), [] )
+        treestore.verifyLocal( pkg )
+        cb = CaptureDownloadProgress()
+        treestore.download( pkg, cb )
+        self.assertEqual( sorted(cb.recorded), [30, 45, 47, 100, 100] )
+
+        destTree = os.path.join( self.workdir, 'dest-1' )
+        treestore.install( pkg, destTree, CaptureInstallProgress() )
+        self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree,destTree), shell=True ), 0 )
+        self.assertEqual( len(treestore.validateLocalCache()), 0 )
+        self.assertEqual( len(treestore.flushLocalCache(['v1.0'])), 0 )
+
+    def test_chunk_buffers(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        localCache = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'cache' ) ) )
+
+        # Local values are read through a buffer over the file, without a copy
+        localCache.put( 'value', b'abc' )
+        localCache.put( 'empty', b'' )
+        with localCache.getBuffer( 'value' ) as buf:
+            self.assertTrue( isinstance( buf, memoryview ) )
+            self.assertEqual( bytes(buf), b'abc' )
+        with localCache.getBuffer( 'empty' ) as buf:
+            self.assertEqual( bytes(buf), b'' )
+        with self.assertRaises(KeyError):
+            with localCache.getBuffer( 'missing' ) as buf:
+                pass
+
+        # zlib chunks are decoded from their buffers in pieces of bounded size
+        DATA = b'0123456789' * 1000
+        srcTree = makeEmptyDir( os.path.join( self.workdir, 'src' ) )
+        LocalFileStore( srcTree ).put( 'data.txt', DATA )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( len(DATA), True ) )
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        pkg = treestore.upload( 'v1.0', '', creationTime, srcTree, CaptureUploadProgress() )
+        self.assertEqual( [c.encoding for pf in pkg.files for c in pf.chunks], ['zlib'] )
+        treestore.download( pkg, CaptureDownloadProgress() )
+        savedSize = treestoreModule.DECODE_PIECE_SIZE
+        treestoreModule.DECODE_PIECE_SIZE = 100
+        try:
+            destTree = os.path.join( self.workdir, 'dest' )
+            treestore.install( pkg, destTree, CaptureInstallProgress() )
+            self.assertEqual( len(treestore.validateLocalCache()), 0 )
+        finally:
+            treestoreModule.DECODE_PIECE_SIZE = savedSize
+        with open( os.path.join( destTree, 'data.txt' ), 'rb' ) as f:
+            self.assertEqual( f.read(), DATA )
+
+    def test_linked_install(self):
+        fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
+        cacheDir = makeEmptyDir( os.path.join( self.workdir, 'cache' ) )
+        localCache = LocalFileStore( cacheDir )
+        treestore = TreeStore.create( fileStore, localCache, TreeStoreConfig( 100, True ) )
+
+        creationTime = datetimeFromIso( '2015-01-01T00:00:00.0' )
+        treestore.upload( 'v1.0', '', creationTime, self.srcTree, CaptureUploadProgress() )
+        pkg = treestore.findPackage( 'v1.0' )
+        treestore.download( pkg, CaptureDownloadProgress() )
+
+        for installMode in [INSTALL_HARDLINK, INSTALL_REFLINK]:
+            treestore.setInstallMode( installMode )
+            destTree = os.path.join( self.workdir, 'dest-' + installMode )
+            treestore.install( pkg, destTree, CaptureInstallProgress() )
+            self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree,destTree), shell=True ), 0 )
+
+        # Single chunk files share storage with the cache when hardlinked
+        pf = [pf for pf in pkg.files if pf.path == 'code/file1.py'][0]
+        cachePath = os.path.join( cacheDir, 'chunks', 'raw', pf.sha1[:2], pf.sha1[2:] )
+        installedPath = os.path.join( self.workdir, 'dest-hardlink', 'code', 'file1.py' )
+        self.assertEqual( os.stat(cachePath).st_ino, os.stat(installedPath).st_ino )
+
+        # Reinstalling over a linked file must leave the cache intact
+        treestore.setInstallMode( 'copy' )
+        treestore.install( pkg, os.path.join( self.workdir, 'dest-hardlink' ), CaptureInstallProgress() )
+        self.assertEqual( len(treestore.validateLocalCache()), 0 )
+
     def test_metapackages(self):
         # Create a file system backed treestore
         fileStore = LocalFileStore( makeEmptyDir( os.path.join( self.workdir, 'fs' ) ) )
@@ -351,7 +1348,7 @@ class TestTreeStore(unittest.TestCase):
             treestore.install( pkg, destTree, CaptureInstallProgress() )
 
             # Check that the installed tree is the same as the source tree
-            self.assertEqual( subprocess.call( 'diff -r -x {0} {1} {2}'.format(S3TS_PROPERTIES,self.srcTree,destTree), shell=True ), 0 )
+            self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree,destTree), shell=True ), 0 )
             self.assertEqual( readInstallProperties(destTree).treeName, 'v1.0' )
 
             # Use the compareInstall function to confirm the installed package is ok, and
@@ -400,7 +1397,7 @@ class TestTreeStore(unittest.TestCase):
             treestore2.install( pkg, destTree2, CaptureInstallProgress() )
 
             # Check that the new installed tree is the same as the source tree
-            self.assertEqual( subprocess.call( 'diff -r -x {0} {1} {2}'.format(S3TS_PROPERTIES,self.srcTree,destTree2), shell=True ), 0 )
+            self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree,destTree2), shell=True ), 0 )
 
             # Rename the tree, and check that installing that is the same
             treestore.rename( 'v1.0', 'v1.0x' )
@@ -408,7 +1405,7 @@ class TestTreeStore(unittest.TestCase):
             treestore.download( pkg, CaptureDownloadProgress() )
             destTree = os.path.join( self.workdir, 'dest-3' )
             treestore.install( pkg, destTree, CaptureInstallProgress() )
-            self.assertEqual( subprocess.call( 'diff -r -x {0} {1} {2}'.format(S3TS_PROPERTIES,self.srcTree,destTree), shell=True ), 0 )
+            self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree,destTree), shell=True ), 0 )
 
             # Remove the tree
             treestore.remove( 'v1.0x' )
@@ -517,8 +1514,8 @@ class TestTreeStore(unittest.TestCase):
             treestore.install( pkg, destTree, CaptureInstallProgress() )
 
             # Check that the installed tree is the same as the source tree
-            self.assertEqual( subprocess.call( 'diff -r -x {0} {1} {2}'.format(S3TS_PROPERTIES,self.srcTree + '/assets',destTree + '/assets'), shell=True ), 0 )
-            self.assertEqual( subprocess.call( 'diff -r -x {0} {1} {2}'.format(S3TS_PROPERTIES,self.srcTree + '/code',destTree + '/code'), shell=True ), 0 )
+            self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree + '/assets',destTree + '/assets'), shell=True ), 0 )
+            self.assertEqual( subprocess.call( 'diff -r -x {0} -x {1} {2} {3}'.format(S3TS_PROPERTIES,S3TS_MANIFEST,self.srcTree + '/code',destTree + '/code'), shell=True ), 0 )
 
 
             self.assertEqual( readInstallProperties(destTree).treeName, 'v1.0:kiosk-01' )
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Measure the per chunk cost of writing small chunks to a LocalFileStore,
+and of checking for their existence, against the original implementation
+(which resolved full paths, and checked/created directories, every time)
+
+The paths are spread over all of the sharded prefixes of a local cache,
+as the number of directories they make up decides whether they can all
+be kept open (see filestore.MAX_DIR_FDS).
+"""
+import os, sys, time, shutil, tempfile, hashlib, argparse
+
+sys.path.insert( 0, os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), '..', 'src' ) )
+
+from s3ts.filestore import LocalFileStore
+from s3ts import filestore, filewriter
+
+# The sharded prefixes of a local cache
+PREFIXES = [
+    os.path.join( 'chunks', 'raw' ),
+    os.path.join( 'chunks', 'zlib' ),
+    'verified',
+    os.path.join( 'partial', 'raw' ),
+    os.path.join( 'partial', 'zlib' ),
+]
+
+class BaselineFileStore(object):
+    """The original LocalFileStore put and exists"""
+
+    def __init__( self, root ):
+        self.root = root
+
+    def exists( self, path ):
+        return os.path.exists( os.path.join( self.root, path ) )
+
+    def put( self, path, body ):
+        path = os.path.join( self.root, path )
+        dir = os.path.dirname( path )
+        if not os.path.isdir( dir ):
+            os.makedirs( dir )
+        with filewriter.atomicFileWriter(path) as f:
+            f.write(body)
+
+def chunkPaths( n ):
+    paths = []
+    for i in range(n):
+        sha1 = hashlib.sha1( str(i).encode() ).hexdigest()
+        paths.append( os.path.join( PREFIXES[i % len(PREFIXES)], sha1[:2], sha1[2:] ) )
+    return paths
+
+def bench( storeClass, workdir, paths, body ):
+    root = os.path.join( workdir, storeClass.__name__ )
+    store = storeClass( root )
+    start = time.perf_counter()
+    for path in paths:
+        store.put( path, body )
+    putSecs = time.perf_counter() - start
+    start = time.perf_counter()
+    for path in paths:
+        store.exists( path )
+    existsSecs = time.perf_counter() - start
+    if hasattr( store, 'close' ):
+        store.close()
+    shutil.rmtree( root )
+    return putSecs, existsSecs
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=20000, help='The number of chunks written')
+    parser.add_argument('--chunk-size', dest='chunkSize', type=int, default=4096, help='The size of each chunk')
+    parser.add_argument('--dir', default=None, help='The directory to write to (a temporary directory by default)')
+    parser.add_argument('--repeat', type=int, default=5, help='The number of runs, of which the best is reported')
+    parser.add_argument('--max-dir-fds', dest='maxDirFds', type=int, default=filestore.MAX_DIR_FDS,
+                        help='The most directories kept open (default {})'.format( filestore.MAX_DIR_FDS ))
+    args = parser.parse_args()
+    filestore.MAX_DIR_FDS = args.maxDirFds
+
+    workdir = tempfile.mkdtemp( dir=args.dir )
+    try:
+        paths = chunkPaths( args.chunks )
+        body = os.urandom( args.chunkSize )
+        results = {}
+        for i in range(args.repeat):
+            # Alternate, so that both see the same background noise
+            for storeClass in (BaselineFileStore, LocalFileStore):
+                putSecs, existsSecs = bench( storeClass, workdir, paths, body )
+                best = results.get( storeClass, (putSecs, existsSecs) )
+                results[storeClass] = min( best[0], putSecs ), min( best[1], existsSecs )
+        for storeClass in (BaselineFileStore, LocalFileStore):
+            putSecs, existsSecs = results[storeClass]
+            print( "{:20} put {:7.1f} us/chunk   exists {:5.1f} us/chunk".format(
+                storeClass.__name__, putSecs * 1e6 / len(paths), existsSecs * 1e6 / len(paths) ) )
+    finally:
+        shutil.rmtree( workdir )
+
+if __name__ == '__main__':
+    main()